@@ -0,0 +1,127 @@
+"""
+Load time of a busy list page: one <img> per detection against contact
+sheets.
+
+A child process stands in for Frigate and serves event thumbnails with
+--latency-ms of delay each. The web UI runs in a threaded server, pointed
+at --db (build one with gen_db.py) and a fresh thumbnail cache, and the
+busiest hour's /detections/by_hour page is loaded the way a browser
+would: the HTML, then every thumbnail or sheet URL in it, six at a time.
+Each mode is loaded cold (empty thumbnail cache) and then warm.
+
+    python bench/bench_contact_sheet.py --db bench/data/large.db
+"""
+import argparse
+import io
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+
+# browsers open about this many connections per host
+BROWSER_CONNECTIONS = 6
+
+
+def serve_thumbnails(port_queue, latency, counter):
+    from PIL import Image
+    import numpy as np
+    rng = np.random.default_rng(0)
+    thumbs = []
+    for _ in range(16):
+        out = io.BytesIO()
+        Image.fromarray(rng.integers(0, 255, (175, 175, 3), dtype=np.uint8)).save(out, 'JPEG', quality=70)
+        thumbs.append(out.getvalue())
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            with counter.get_lock():
+                counter.value += 1
+            body = thumbs[hash(self.path) % len(thumbs)]
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def load_page(session, base, path):
+    """(seconds, image requests, image bytes) to load `path` and every image it references."""
+    started = time.perf_counter()
+    html = session.get(base + path).text
+    urls = sorted(set(re.findall(r"""(/(?:frigate/[^'"]+/thumbnail\.jpg|contact_sheets/[^'"]+\.jpg))""", html)))
+    with ThreadPoolExecutor(BROWSER_CONNECTIONS) as pool:
+        sizes = list(pool.map(lambda url: len(session.get(base + url).content), urls))
+    return time.perf_counter() - started, len(urls), sum(sizes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--db', default=os.path.join(ROOT, 'bench', 'data', 'large.db'))
+    parser.add_argument('--latency-ms', type=float, default=30.0, help="Frigate's time per thumbnail request")
+    args = parser.parse_args()
+
+    db_path = os.path.abspath(args.db)
+    if not os.path.exists(db_path):
+        sys.exit(f"{db_path} not found; build one with bench/gen_db.py")
+    counter = multiprocessing.Value('i', 0)
+    port_queue = multiprocessing.Queue()
+    multiprocessing.Process(target=serve_thumbnails, args=(port_queue, args.latency_ms / 1000, counter),
+                            daemon=True).start()
+    frigate_port = port_queue.get()
+
+    os.chdir(ROOT)  # webui reads config/ relative to the working directory
+    import requests
+    from werkzeug.serving import make_server
+    import queries
+    import thumbnails
+    import webui
+    queries.DBPATH = webui.DATABASE = db_path
+    cache_dir = tempfile.mkdtemp(prefix='thumbs-')
+    webui.thumbnail_cache = thumbnails.ThumbnailCache(webui.session, f"http://127.0.0.1:{frigate_port}", cache_dir)
+    webui.contact_sheets = thumbnails.ContactSheets(webui.thumbnail_cache)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, webui.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+
+    conn = sqlite3.connect(db_path)
+    day, hour, count = conn.execute("SELECT day, hour, count FROM activity_hours ORDER BY count DESC LIMIT 1").fetchone()
+    conn.close()
+    path = f"/detections/by_hour/{day}/{hour}"
+    print(f"{path}: {count} detections, Frigate latency {args.latency_ms:.0f} ms")
+    print(f"{'mode':<16} {'cache':<6} {'s':>7} {'requests':>9} {'KB':>8} {'frigate':>8}")
+
+    session = requests.Session()
+    for mode, sheets in (('one img each', False), ('contact sheets', True)):
+        webui.THUMBNAIL_CFG['contact_sheets'] = sheets
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        for cache in ('cold', 'warm'):
+            webui._page_cache.clear()
+            before = counter.value
+            seconds, requests_made, size = load_page(session, base, path)
+            print(f"{mode:<16} {cache:<6} {seconds:>7.2f} {requests_made + 1:>9} {size / 1024:>8.0f} "
+                  f"{counter.value - before:>8}")
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
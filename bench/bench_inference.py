@@ -0,0 +1,87 @@
+"""
+Microbenchmark for the inference path.
+
+Compares the old copy-in/copy-out top-5 code with InterpreterEngine and
+reports wall time and Python-visible allocations per call (tracemalloc).
+
+    python bench/bench_inference.py --model models/birds_V1_3.tflite \
+        --labels models/birds_V1_labelmap.txt
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from classifier import InterpreterEngine  # noqa: E402
+
+
+def legacy_top5(interpreter, labels, arr):
+    """The pre-engine implementation, kept here for comparison."""
+    input_details = interpreter.get_input_details()
+    output_details = interpreter.get_output_details()
+    tensor = np.expand_dims(arr, axis=0).astype(input_details[0]['dtype'])
+    interpreter.set_tensor(input_details[0]['index'], tensor)
+    interpreter.invoke()
+    raw_output = interpreter.get_tensor(output_details[0]['index'])
+    scale, zero_point = output_details[0]['quantization']
+    probs = np.squeeze(scale * (raw_output.astype(np.float32) - zero_point))
+    top5_idx = np.argsort(probs)[-5:][::-1]
+    return [(labels[i], float(probs[i])) for i in top5_idx]
+
+
+def measure(fn, iterations):
+    # warm up so one-off allocations (caches, first invoke) are excluded
+    for _ in range(5):
+        fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    elapsed = (time.perf_counter() - start) / iterations
+
+    tracemalloc.start()
+    fn()
+    before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    for _ in range(iterations):
+        fn()
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, (after - before) / iterations, peak - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--model', default='models/birds_V1_3.tflite')
+    parser.add_argument('--labels', default='models/birds_V1_labelmap.txt')
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    img = Image.fromarray(rng.integers(0, 255, (224, 224, 3), dtype=np.uint8))
+    arr = np.array(img)
+
+    engine = InterpreterEngine(args.model, args.labels)
+    legacy = InterpreterEngine(args.model, args.labels)
+
+    # labels can differ on exact score ties, the ranked scores must not
+    assert [s for _, s in engine.classify(img)] == \
+        [s for _, s in legacy_top5(legacy.interpreter, legacy.labels, arr)]
+
+    rows = [
+        ('legacy copy path', lambda: legacy_top5(legacy.interpreter, legacy.labels, arr)),
+        ('engine classify', lambda: engine.classify(img)),
+        ('engine invoke+top5', lambda: (engine.invoke(), engine.top_k(5))),
+    ]
+    print(f"{'path':<20} {'ms/call':>9} {'retained B/call':>16} {'peak B':>10}")
+    for name, fn in rows:
+        elapsed, retained, peak = measure(fn, args.iterations)
+        print(f"{name:<20} {elapsed * 1000:>9.2f} {retained:>16.1f} {peak:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""
+Memory check for the ingest path: replays a compressed day of events and
+watches the process RSS.
+
+A child process serves synthetic Frigate snapshots (4K and 1080p cameras,
+textured frames that compress like real ones) over HTTP. The replay follows
+the diurnal curve from gen_db.py, sends each event as 1-3 updates, and
+pushes them through speciesid's EventDispatcher and process_event with the
+real model, as fast as the workers go. After every simulated hour it
+records the RSS and the peak RSS during that hour. RSS after the morning
+warm-up should stay flat for the rest of the day; the run fails if it
+grows by more than --tolerance-mb.
+
+    python bench/bench_ingest_memory.py --workers 4 --events-per-day 2000
+"""
+import argparse
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+from gen_db import DIURNAL  # noqa: E402
+
+CAMERAS = {'feeder': (3840, 2160), 'deck': (1920, 1080)}
+FRAMES_PER_CAMERA = 6
+WARMUP_HOURS = 9  # through the morning peak
+
+
+def make_frame(size, seed):
+    """A JPEG with smooth structure plus sensor-like noise."""
+    w, h = size
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:h, 0:w].astype(np.float32)
+    base = np.stack([
+        128 + 60 * np.sin(x / rng.uniform(40, 200) + c) * np.cos(y / rng.uniform(40, 200) - c)
+        for c in range(3)], axis=-1)
+    base += rng.normal(0, 6, base.shape)
+    buf = io.BytesIO()
+    Image.fromarray(np.clip(base, 0, 255).astype(np.uint8)).save(buf, 'JPEG', quality=85)
+    return buf.getvalue()
+
+
+def serve_frames(port_queue):
+    frames = {camera: [make_frame(size, i) for i in range(FRAMES_PER_CAMERA)]
+              for camera, size in CAMERAS.items()}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            # /api/<camera>/recordings/<event>/snapshot.jpg
+            parts = self.path.split('/')
+            camera_frames = frames.get(parts[2]) if len(parts) > 4 else None
+            if camera_frames is None:
+                self.send_error(404)
+                return
+            body = camera_frames[zlib.crc32(parts[4].encode()) % len(camera_frames)]
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    port_queue.put((server.server_address[1], {c: sum(map(len, f)) // len(f) for c, f in frames.items()}))
+    server.serve_forever()
+
+
+def rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+class PeakSampler(threading.Thread):
+    def __init__(self, interval=0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = 0.0
+
+    def take(self):
+        peak, self.peak = self.peak, rss_mb()
+        return peak
+
+    def run(self):
+        while True:
+            self.peak = max(self.peak, rss_mb())
+            time.sleep(self.interval)
+
+
+def make_update(rng, day_start, hour, camera):
+    w, h = CAMERAS[camera]
+    side = rng.randint(h // 12, h // 3)
+    aspect = rng.uniform(0.6, 1.6)
+    bw, bh = min(int(side * aspect), w), side
+    x1, y1 = rng.randrange(0, w - bw), rng.randrange(0, h - bh)
+    start = day_start + hour * 3600 + rng.uniform(0, 3600)
+    return {'id': f"{start:.6f}-{rng.getrandbits(24):06x}", 'label': 'bird', 'camera': camera,
+            'has_snapshot': True, 'start_time': start, 'snapshot': {'box': [x1, y1, x1 + bw, y1 + bh]}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--hours', type=int, default=24)
+    parser.add_argument('--events-per-day', type=int, default=2000)
+    parser.add_argument('--tolerance-mb', type=float, default=8.0,
+                        help="allowed RSS growth between the end of warm-up and the end of the replay")
+    parser.add_argument('--model', default=os.path.join(ROOT, 'models', 'birds_V1_3.tflite'))
+    parser.add_argument('--labels', default=os.path.join(ROOT, 'models', 'birds_V1_labelmap.txt'))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help="also write the per-hour results here")
+    args = parser.parse_args()
+
+    # Start the frame server before the model is loaded so it doesn't inherit it
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve_frames, args=(port_queue,), daemon=True)
+    server.start()
+    port, frame_sizes = port_queue.get()
+
+    os.chdir(ROOT)  # speciesid reads config/ relative to the working directory
+    import speciesid
+    from classifier import ClassificationContext
+    logging.getLogger().setLevel(logging.WARNING)
+
+    tmp = tempfile.mkdtemp(prefix='ingest-mem-')
+    speciesid.DBPATH = os.path.join(tmp, 'speciesid.db')
+    speciesid.setupdb()
+    cls_cfg = dict(speciesid.cfg_full['classification'], model=args.model, labels=args.labels, num_threads=1)
+    speciesid.context = ClassificationContext(cls_cfg, os.path.join(ROOT, 'config', 'northeast_birds.txt'),
+                                              os.path.join(ROOT, 'birdnames.db'))
+    speciesid.base_url = f"http://127.0.0.1:{port}"
+    # full frames: the decode path is what this measures
+    speciesid.ingest_cfg = dict(speciesid.cfg_full.get('ingest') or {}, workers=args.workers, server_crop=False)
+    speciesid.start_snapshot_loader()
+    dispatcher = speciesid.EventDispatcher(speciesid.handle_event, workers=args.workers)
+
+    print(f"{args.workers} workers; snapshots "
+          + ", ".join(f"{c} {CAMERAS[c][0]}x{CAMERAS[c][1]} ~{s / 1e6:.1f} MB" for c, s in frame_sizes.items()))
+    print(f"{'hour':>4} {'events':>7} {'updates':>8} {'s':>6} {'rss MB':>8} {'peak MB':>8}")
+
+    rng = random.Random(args.seed)
+    day_start = time.time() - args.hours * 3600
+    sampler = PeakSampler()
+    sampler.start()
+    rows = []
+    started = time.perf_counter()
+    for hour in range(args.hours):
+        events = round(args.events_per_day * DIURNAL[hour % 24] / sum(DIURNAL))
+        sampler.take()
+        t = time.perf_counter()
+        updates = 0
+        for _ in range(events):
+            after = make_update(rng, day_start, hour, rng.choice(list(CAMERAS)))
+            for _ in range(rng.randint(1, 3)):
+                dispatcher.submit(after['id'], after, camera=after['camera'])
+                updates += 1
+        dispatcher.join()
+        row = {'hour': hour, 'events': events, 'updates': updates, 'seconds': round(time.perf_counter() - t, 1),
+               'rss_mb': round(rss_mb(), 1), 'peak_mb': round(sampler.take(), 1)}
+        rows.append(row)
+        print(f"{hour:>4} {events:>7} {updates:>8} {row['seconds']:>6} {row['rss_mb']:>8} {row['peak_mb']:>8}",
+              flush=True)
+
+    conn = sqlite3.connect(speciesid.DBPATH)
+    stored, = conn.execute("SELECT COUNT(*) FROM detections").fetchone()
+    conn.close()
+    warm = rows[min(WARMUP_HOURS, len(rows)) - 1]['rss_mb']
+    final = rows[-1]['rss_mb']
+    peak = max(r['peak_mb'] for r in rows)
+    print(f"\n{sum(r['updates'] for r in rows)} updates in {time.perf_counter() - started:.0f}s, {stored} stored; "
+          f"RSS after warm-up {warm} MB, at end {final} MB, peak {peak} MB")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'workers': args.workers, 'hours': rows}, f, indent=1)
+    if final - warm > args.tolerance_mb:
+        print(f"RSS grew {final - warm:.1f} MB after warm-up (tolerance {args.tolerance_mb} MB)")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
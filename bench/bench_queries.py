@@ -0,0 +1,270 @@
+"""
+Query/route performance regression check against a large database.
+
+Times every queries.py function that reads the detections database and
+every page/JSON route that only reads it (Frigate proxies, contact sheets
+and the admin/status routes excluded), captures the SQL each one runs,
+and reports the EXPLAIN QUERY PLAN of every statement that scans a big
+table -- including a walk over a whole (covering) index, which is what a
+DATE(detection_time) = ? predicate turns into. Results are compared with a
+baseline saved on the same machine against the same file; the run fails if
+a tracked case got slower than baseline * (1 + tolerance), or scans a big
+table it didn't scan before.
+
+    python bench/gen_db.py --rows 2000000 --out bench/data/large.db
+    python bench/bench_queries.py --db bench/data/large.db --save-baseline
+    python bench/bench_queries.py --db bench/data/large.db       # later, e.g. before a release
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+
+# tables too large to scan on every request
+BIG_TABLES = ('detections', 'detection_choices', 'detection_rollups', 'detection_vectors')
+# below this a slowdown is timer noise, not a regression
+NOISE_FLOOR_MS = 2.0
+# a case that looks slower is measured again this many times before it counts
+RETRIES = 2
+
+_captured = []
+_real_connect = sqlite3.connect
+
+
+def _tracing_connect(*args, **kwargs):
+    conn = _real_connect(*args, **kwargs)
+    conn.set_trace_callback(_captured.append)
+    return conn
+
+
+SCAN_RE = re.compile(r"SCAN (\w+)( USING (COVERING )?INDEX)?")
+
+
+def full_scans(db_path, statements):
+    """{statement: [plan lines]} for statements that read all of a BIG_TABLE or its index.
+
+    An index walk cut short by LIMIT (latest N rows) is not a full scan.
+    """
+    conn = _real_connect(db_path)
+    found = {}
+    for sql in statements:
+        if not sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+            continue
+        try:
+            plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+        except sqlite3.Error:
+            continue
+        limited = re.search(r"\bLIMIT\b", sql, re.I)
+        scans = [m for m in map(SCAN_RE.match, plan)
+                 if m and m.group(1) in BIG_TABLES and not (m.group(2) and limited)]
+        if scans:
+            found[' '.join(sql.split())[:300]] = plan
+    conn.close()
+    return found
+
+
+def sample_args(db_path):
+    """Realistic arguments: the busiest day/hour/species in the file, and today."""
+    conn = _real_connect(db_path)
+    day, hour = conn.execute("""
+        SELECT day, hour FROM activity_hours ORDER BY count DESC LIMIT 1
+    """).fetchone()
+    species, = conn.execute("""
+        SELECT display_name FROM species_days GROUP BY display_name ORDER BY SUM(count) DESC LIMIT 1
+    """).fetchone()
+    events = [r[0] for r in conn.execute("SELECT frigate_event FROM detections ORDER BY id DESC LIMIT 50")]
+    conn.close()
+    return {'day': date.fromisoformat(day), 'hour': hour, 'species': species, 'events': events}
+
+
+def build_cases(a):
+    import queries
+    day, hour, species = a['day'], a['hour'], a['species']
+    today = date.today()
+    cases = {
+        'q:recent_detections': lambda: queries.recent_detections(5),
+        'q:get_detection_choices': lambda: queries.get_detection_choices(a['events'][0]),
+        'q:get_daily_summary': lambda: queries.get_daily_summary(datetime.combine(day, datetime.min.time())),
+        'q:get_daily_summary(today)': lambda: queries.get_daily_summary(datetime.now()),
+        'q:get_records_for_date_hour': lambda: queries.get_records_for_date_hour(day, hour),
+        'q:get_records_for_scientific_name_and_date': lambda: queries.get_records_for_scientific_name_and_date(
+            species, day),
+        'q:get_records_for_scientific_name_and_date(30d)': lambda: queries.get_records_for_scientific_name_and_date(
+            species, day - timedelta(days=29), day),
+        'q:get_earliest_detection_date': queries.get_earliest_detection_date,
+        'q:get_generation_signature': lambda: queries.get_generation_signature(day, day),
+        'q:get_detections_for_events': lambda: queries.get_detections_for_events(a['events']),
+        'q:get_species_week_trend': lambda: queries.get_species_week_trend(today - timedelta(days=364), today),
+        'q:get_species_week_trend(3y)': lambda: queries.get_species_week_trend(today - timedelta(days=3 * 365), today),
+        'q:get_activity_heatmap': lambda: queries.get_activity_heatmap(today - timedelta(days=3 * 365), today),
+        'q:get_activity_heatmap(species)': lambda: queries.get_activity_heatmap(
+            today - timedelta(days=3 * 365), today, species),
+        'q:get_first_last_seen': queries.get_first_last_seen,
+        'q:get_reviewed_detections': queries.get_reviewed_detections,
+        'q:get_unreviewed_detections': queries.get_unreviewed_detections,
+    }
+
+    import webui
+    client = webui.app.test_client()
+
+    def get(url):
+        def run():
+            webui._page_cache.clear()  # time the render, not the page cache
+            r = client.get(url)
+            if r.status_code != 200:
+                raise RuntimeError(f"{url} -> {r.status_code}")
+            r.get_data()
+        return run
+
+    d = day.isoformat()
+    for name, url in [
+        ('/', '/'),
+        ('/daily_summary/<date>', f'/daily_summary/{d}'),
+        ('/detections/by_hour/<date>/<hour>', f'/detections/by_hour/{d}/{hour}'),
+        ('/detections/by_scientific_name/<name>/<date>', f'/detections/by_scientific_name/{species}/{d}'),
+        ('/events/<id>/choices', f'/events/{a["events"][0]}/choices'),
+        ('/detections/<id>/similar', f'/detections/{a["events"][0]}/similar'),
+        ('/trends', '/trends'),
+        ('/api/trends', '/api/trends'),
+        ('/api/heatmap', '/api/heatmap'),
+        ('/api/species_seen', '/api/species_seen'),
+        ('/api/export (1 day, ndjson)', f'/api/export?format=ndjson&start={d}&end={d}'),
+    ]:
+        cases['r:' + name] = get(url)
+    return cases
+
+
+class Calibration:
+    """Best-of time for a fixed in-memory SQLite workload. Taken next to each
+    case and saved with it, so a baseline recorded while the machine was
+    faster or slower (CPU frequency, noisy neighbours) can be scaled."""
+
+    def __init__(self):
+        self.conn = _real_connect(':memory:')
+        self.conn.execute("CREATE TABLE t (day TEXT, name TEXT, n INTEGER)")
+        self.conn.executemany("INSERT INTO t VALUES (?, ?, ?)",
+                              ((f"2024-01-{i % 28 + 1:02d}", f"s{i % 97}", i) for i in range(50000)))
+        self.conn.execute("CREATE INDEX t_day ON t (day, name)")
+
+    def _work(self):
+        self.conn.execute("SELECT name, COUNT(*), SUM(n) FROM t WHERE day >= '2024-01-10' GROUP BY name").fetchall()
+
+    def __call__(self, repeat=5):
+        return measure(self._work, repeat)
+
+
+def measure(fn, repeat):
+    """Best of `repeat` runs in ms; the minimum is the least noisy estimate on a busy machine."""
+    fn()  # warm caches and imports
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t) * 1000)
+    return min(times)
+
+
+def timed(fn, calibration, repeat):
+    """(ms, calibration ms) for one case, calibrating on both sides of it."""
+    calibration_ms = calibration()
+    ms = measure(fn, repeat)
+    return ms, min(calibration_ms, calibration())
+
+
+def regressed(ms, base_ms, tolerance):
+    return ms > base_ms * (1 + tolerance) and ms - base_ms > NOISE_FLOOR_MS
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--db', default=os.path.join(ROOT, 'bench', 'data', 'large.db'))
+    parser.add_argument('--baseline', default=os.path.join(ROOT, 'bench', 'query_baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown, 0.25 = 25%%")
+    parser.add_argument('--model', default=os.path.join(ROOT, 'models', 'birds_V1_3.tflite'),
+                        help="model whose vectors gen_db wrote")
+    parser.add_argument('--labels', default=os.path.join(ROOT, 'models', 'birds_V1_labelmap.txt'))
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--filter', default='', help="only cases containing this text")
+    parser.add_argument('--plans', action='store_true', help="print the full plan for every scan")
+    args = parser.parse_args()
+
+    db_path = os.path.abspath(args.db)
+    if not os.path.exists(db_path):
+        sys.exit(f"{db_path} not found; build one with bench/gen_db.py")
+    os.chdir(ROOT)  # webui reads config/ relative to the working directory
+    sqlite3.connect = _tracing_connect
+    import queries
+    import webui
+    import vectorstore
+    queries.DBPATH = db_path
+    webui.DATABASE = db_path
+    # gen_db writes the similarity route's vectors next to the database
+    vectorstore.VECTOR_DIR = os.path.join(os.path.dirname(db_path), 'vectors')
+    model, labels = os.path.abspath(args.model), os.path.abspath(args.labels)
+    webui._active_model = lambda: (model, labels)
+
+    cases = build_cases(sample_args(db_path))
+    results = {}
+    calibration = Calibration()
+    baseline = {}
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['cases']
+    print(f"{'case':<52} {'ms':>9} {'base':>9}  scans   (base = baseline scaled to current machine speed)")
+
+    failures = []
+    for name, fn in cases.items():
+        if args.filter not in name:
+            continue
+        del _captured[:]
+        try:
+            ms, calibration_ms = timed(fn, calibration, args.repeat)
+        except Exception as e:
+            failures.append(f"{name}: {e}")
+            print(f"{name:<52} {'ERROR':>9}  {e}")
+            continue
+        scans = full_scans(db_path, set(_captured))
+        results[name] = {'ms': round(ms, 3), 'calibration_ms': round(calibration_ms, 3), 'scans': sorted(scans)}
+        base = baseline.get(name)
+        # baseline time as it would be on the machine as fast as it is right now
+        base_ms = base['ms'] * calibration_ms / base['calibration_ms'] if base else float('nan')
+        for _ in range(RETRIES if base else 0):
+            if not regressed(ms, base_ms, args.tolerance):
+                break
+            again, again_calibration = timed(fn, calibration, args.repeat)
+            again_base = base['ms'] * again_calibration / base['calibration_ms']
+            if again / again_base < ms / base_ms:
+                ms, calibration_ms, base_ms = again, again_calibration, again_base
+        print(f"{name:<52} {ms:>9.2f} {base_ms:>9.2f}  {len(scans) or ''}")
+        if args.plans:
+            for sql, plan in scans.items():
+                print(f"    {sql}\n      " + "\n      ".join(plan))
+        if base:
+            if regressed(ms, base_ms, args.tolerance):
+                failures.append(f"{name}: {ms:.2f} ms vs baseline {base_ms:.2f} ms")
+            new_scans = set(scans) - set(base['scans'])
+            if new_scans:
+                failures.append(f"{name}: new full scan(s): " + '; '.join(new_scans))
+
+    if args.save_baseline:
+        conn = _real_connect(db_path)
+        rows, = conn.execute("SELECT COUNT(*) FROM detections").fetchone()
+        conn.close()
+        with open(args.baseline, 'w') as f:
+            json.dump({'db': os.path.basename(db_path), 'detections': rows, 'cases': results}, f, indent=1)
+        print(f"Baseline written to {args.baseline}")
+    if failures:
+        print("\nRegressions:\n  " + "\n  ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+Scaling check for multi-node ingest against a broker stand-in.
+
+A fake broker delivers the event stream the way each scaling mode sees it
+(see ingest.py): with --mode shared it hands each message to one member of
+a shared-subscription group in turn, as an MQTT v5 broker does; with
+--mode partition every node gets every message and keeps the events
+ingest.partition_of assigns to it. Either way a fraction of messages is
+re-delivered (QoS 1 duplicates) and update order is shuffled within an
+event. Every node routes its messages through ingest.EventDispatcher, runs
+the model on a crop (InterpreterEngine, one per worker thread; --service-ms
+swaps in a fixed sleep) and writes with ingest.store_detection into one
+database set up by schema.setupdb. Prints throughput per node count and
+verifies the table ends up with exactly one row per event at its best
+score; in partition mode also that each event was handled by one node,
+with its updates in delivery order.
+
+    python bench/bench_shared_ingest.py --mode partition --nodes 1 2 4
+"""
+import argparse
+import itertools
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import schema  # noqa: E402
+from ingest import EventDispatcher, partition_of, store_detection  # noqa: E402
+
+
+class SharedGroupBroker:
+    """Round-robin delivery to the members of one shared subscription."""
+
+    def __init__(self, duplicate_rate: float, seed: int = 0):
+        self.members = []
+        self.duplicate_rate = duplicate_rate
+        self.rng = random.Random(seed)
+
+    def subscribe(self, callback):
+        self.members.append(callback)
+
+    def publish_all(self, messages):
+        members = itertools.cycle(self.members)
+        for message in messages:
+            next(members)(message)
+            if self.rng.random() < self.duplicate_rate:
+                next(members)(message)
+
+
+class FanOutBroker(SharedGroupBroker):
+    """Plain subscriptions: every member gets every message."""
+
+    def publish_all(self, messages):
+        for message in messages:
+            copies = 2 if self.rng.random() < self.duplicate_rate else 1
+            for _ in range(copies):
+                for member in self.members:
+                    member(message)
+
+
+class Node:
+    def __init__(self, db_path: str, work, workers: int, partition=None):
+        self.db_path = db_path
+        self.work = work
+        self.partition = partition    # (index, partitions), or None for shared mode
+        self.local = threading.local()
+        self.handled = {}             # event id -> delivery sequence numbers, in handling order
+        self.lock = threading.Lock()
+        self.dispatcher = EventDispatcher(self.handle, workers=workers)
+
+    def on_message(self, message):
+        if self.partition and partition_of(message['id'], self.partition[1]) != self.partition[0]:
+            return
+        self.dispatcher.submit(message['id'], message)
+
+    def handle(self, message):
+        with self.lock:
+            self.handled.setdefault(message['id'], []).append(message['seq'])
+        self.work(self.local)
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.db_path, timeout=30)
+        with conn:
+            store_detection(conn.cursor(), '2025-01-01 08:00:00', message['index'], message['score'],
+                            f"Bird {message['index']}", '/m/0', message['id'], 'feeder',
+                            [(f"Bird {message['index']}", message['score'])] * 5)
+
+
+def model_work(model: str, labels: str):
+    """Per-thread inference on a random crop, what each update costs a real node."""
+    from classifier import InterpreterEngine
+    crop = Image.fromarray(np.random.default_rng(0).integers(0, 256, (224, 224, 3), dtype=np.uint8))
+
+    def work(local):
+        engine = getattr(local, 'engine', None)
+        if engine is None:
+            engine = local.engine = InterpreterEngine(model, labels, num_threads=1)
+        engine.classify(crop)
+    return work
+
+
+def make_messages(events: int, updates: int, seed: int = 1):
+    rng = random.Random(seed)
+    messages, best = [], {}
+    for e in range(events):
+        event_id = f"1700000000.{e:06d}-bench"
+        batch = [{'id': event_id, 'index': rng.randrange(965), 'score': rng.random()} for _ in range(updates)]
+        best[event_id] = max(m['score'] for m in batch)
+        rng.shuffle(batch)
+        messages.extend(batch)
+    for seq, message in enumerate(messages):
+        message['seq'] = seq
+    return messages, best
+
+
+def check_order(members, best):
+    """Each event handled by exactly one node, its updates in delivery order (duplicates may repeat)."""
+    owners = {}
+    for i, node in enumerate(members):
+        for event_id, seqs in node.handled.items():
+            assert event_id not in owners, f"{event_id} handled by nodes {owners[event_id]} and {i}"
+            owners[event_id] = i
+            assert seqs == sorted(seqs), f"{event_id} handled out of order: {seqs}"
+    assert set(owners) == set(best), f"{len(set(best) - set(owners))} events never handled"
+
+
+def run(mode: str, nodes: int, messages, best, work, duplicate_rate: float, workers: int) -> float:
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'bench.db')
+        schema.setupdb(db_path)
+
+        broker = (FanOutBroker if mode == 'partition' else SharedGroupBroker)(duplicate_rate)
+        members = [Node(db_path, work, workers, (i, nodes) if mode == 'partition' else None)
+                   for i in range(nodes)]
+        for node in members:
+            broker.subscribe(node.on_message)
+
+        start = time.perf_counter()
+        broker.publish_all(messages)
+        for node in members:
+            node.dispatcher.join()
+        elapsed = time.perf_counter() - start
+
+        conn = sqlite3.connect(db_path)
+        stored = dict(conn.execute("SELECT frigate_event, score FROM detections"))
+        conn.close()
+        assert len(stored) == len(best), f"{len(stored)} rows for {len(best)} events"
+        assert all(abs(stored[e] - s) < 1e-9 for e, s in best.items()), "row is not the best update"
+        if mode == 'partition':
+            check_order(members, best)
+        return len(messages) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--mode', choices=('shared', 'partition'), default='shared')
+    parser.add_argument('--nodes', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--events', type=int, default=300)
+    parser.add_argument('--updates', type=int, default=3, help="updates per event")
+    parser.add_argument('--model', default='models/birds_V1_3.tflite')
+    parser.add_argument('--labels', default='models/birds_V1_labelmap.txt')
+    parser.add_argument('--service-ms', type=float, default=None,
+                        help="sleep this long per update instead of running the model")
+    parser.add_argument('--duplicates', type=float, default=0.1, help="fraction re-delivered")
+    parser.add_argument('--workers', type=int, default=1, help="worker threads per node")
+    args = parser.parse_args()
+
+    if args.service_ms is not None:
+        def work(local):
+            time.sleep(args.service_ms / 1000)
+    else:
+        work = model_work(args.model, args.labels)
+
+    messages, best = make_messages(args.events, args.updates)
+    baseline = None
+    print(f"{args.mode}: {'nodes':>5} {'msg/s':>9} {'speedup':>8}")
+    for n in args.nodes:
+        rate = run(args.mode, n, messages, best, work, args.duplicates, args.workers)
+        baseline = baseline or rate / n
+        print(f"{' ' * len(args.mode)}  {n:>5} {rate:>9.1f} {rate / baseline:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
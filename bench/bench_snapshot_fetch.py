@@ -0,0 +1,167 @@
+"""
+Bytes and time per event for the ingest snapshot fetch, server-side crop
+against full frame.
+
+A child process stands in for Frigate: /api/config gives the camera
+resolutions, /api/<camera>/recordings/<id>/snapshot.jpg the full frame, and
+/api/events/<id>/snapshot.jpg honours crop=1, height= and quality= the way
+Frigate does (same crop region, width rounded down). --ended-share of the
+events answer that endpoint with the uncropped frame, as Frigate does for
+events that already ended; their updates say so (end_time, as catch-up
+updates do), and fetch_crop goes straight to the recordings frame for them.
+Each event goes through speciesid.fetch_crop with server cropping on and
+then off; the run reports bytes and ms per
+event for both, and fails if the two model inputs differ by more than
+--max-diff (mean absolute difference, 0-255).
+
+    python bench/bench_snapshot_fetch.py --events 200
+"""
+import argparse
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+from bench_ingest_memory import CAMERAS, FRAMES_PER_CAMERA, make_frame, make_update  # noqa: E402
+from snapshots import frigate_crop_region  # noqa: E402
+
+
+def has_ended(event_id: str, ended_share: float) -> bool:
+    return zlib.crc32(event_id.encode()) % 1000 < ended_share * 1000
+
+
+def serve_frigate(port_queue, ended_share):
+    frames = {camera: [make_frame(size, i) for i in range(FRAMES_PER_CAMERA)]
+              for camera, size in CAMERAS.items()}
+    decoded = {}
+    boxes = {}  # event id -> (camera, box); the bench registers events before fetching them
+
+    def frame_for(camera, event_id):
+        return frames[camera][zlib.crc32(event_id.encode()) % FRAMES_PER_CAMERA]
+
+    class Handler(BaseHTTPRequestHandler):
+        def send_body(self, body, content_type='image/jpeg'):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            # /register/<event>/<camera>/<x1>,<y1>,<x2>,<y2>
+            _, _, event_id, camera, box = self.path.split('/')
+            boxes[event_id] = (camera, [int(v) for v in box.split(',')])
+            self.send_body(b'{}', 'application/json')
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            parts = url.path.split('/')
+            if url.path == '/api/config':
+                cameras = {c: {'detect': {'width': w, 'height': h}} for c, (w, h) in CAMERAS.items()}
+                self.send_body(json.dumps({'cameras': cameras}).encode(), 'application/json')
+            elif len(parts) > 4 and parts[3] == 'recordings' and parts[2] in frames:
+                # the frame time is the event id's prefix; find the event it belongs to
+                event_id = next((e for e in boxes if e.split('-')[0] == parts[4]), parts[4])
+                self.send_body(frame_for(parts[2], event_id))
+            elif len(parts) > 4 and parts[2] == 'events' and parts[3] in boxes:
+                event_id = parts[3]
+                camera, box = boxes[event_id]
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                body = frame_for(camera, event_id)
+                if has_ended(event_id, ended_share):
+                    self.send_body(body)  # ended: the stored full frame
+                    return
+                key = (camera, body)
+                if key not in decoded:
+                    decoded[key] = Image.open(io.BytesIO(body)).convert('RGB')
+                img = decoded[key]
+                if query.get('crop') == '1':
+                    img = img.crop(frigate_crop_region(img.size, box))
+                if query.get('height'):
+                    height = int(query['height'])
+                    img = img.resize((int(height * img.size[0] / img.size[1]), height), Image.Resampling.BOX)
+                out = io.BytesIO()
+                img.save(out, 'JPEG', quality=int(query.get('quality', 70)))
+                self.send_body(out.getvalue())
+            else:
+                self.send_error(404)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--events', type=int, default=200)
+    parser.add_argument('--ended-share', type=float, default=0.1,
+                        help="share of events whose snapshot comes back uncropped")
+    parser.add_argument('--max-diff', type=float, default=6.0)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve_frigate, args=(port_queue, args.ended_share), daemon=True)
+    server.start()
+    port = port_queue.get()
+
+    os.chdir(ROOT)  # speciesid reads config/ relative to the working directory
+    import speciesid
+    logging.getLogger().setLevel(logging.WARNING)
+    speciesid.base_url = f"http://127.0.0.1:{port}"
+    speciesid.ingest_cfg = dict(speciesid.cfg_full.get('ingest') or {})
+
+    rng = random.Random(args.seed)
+    events = [make_update(rng, time.time() - 86400, rng.randrange(24), rng.choice(list(CAMERAS)))
+              for _ in range(args.events)]
+    for after in events:
+        box = ','.join(map(str, after['snapshot']['box']))
+        speciesid.session.post(f"{speciesid.base_url}/register/{after['id']}/{after['camera']}/{box}")
+
+    results, rois = {}, {}
+    for mode, server_crop in (('crop', True), ('frame', False)):
+        speciesid.ingest_cfg['server_crop'] = server_crop
+        speciesid.start_snapshot_loader()
+        started = time.perf_counter()
+        rois[mode] = [speciesid.fetch_crop(after['id'], after['id'].split('-')[0], after['camera'],
+                                           after['snapshot']['box'], ended=has_ended(after['id'], args.ended_share))
+                      for after in events]
+        seconds = time.perf_counter() - started
+        transfers = speciesid.snapshot_loader.status()['transfers']
+        total = sum(kind['bytes'] for kinds in transfers.values() for kind in kinds.values())
+        results[mode] = (total / len(events), seconds * 1000 / len(events), transfers)
+
+    for mode, (per_event, ms, transfers) in results.items():
+        kinds = ', '.join(f"{camera} {kind} {t['snapshots']} x {t['mean_kb']} KB"
+                          for camera, camera_kinds in transfers.items() for kind, t in camera_kinds.items())
+        print(f"{mode:>6}: {per_event / 1024:8.1f} KB/event {ms:7.1f} ms/event   ({kinds})")
+    print(f"server crop: {results['frame'][0] / results['crop'][0]:.1f}x fewer bytes, "
+          f"{results['frame'][1] / results['crop'][1]:.1f}x faster")
+
+    diffs = []
+    for a, b in zip(rois['crop'], rois['frame']):
+        if a.size != b.size:
+            b = b.resize(a.size)
+        diffs.append(float(np.abs(np.asarray(a, np.float32) - np.asarray(b, np.float32)).mean()))
+    print(f"model input difference: mean {np.mean(diffs):.2f}, worst {max(diffs):.2f} (0-255)")
+    if max(diffs) > args.max_diff:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Regression check for `vectorstore.py reevaluate` across a model change.
+
+Builds a throwaway database with the production schema, classifies a few
+events under one model's vector store and one under another's (a model
+swap), then re-evaluates with the new model. Detections made under the old
+model have no vector in the new model's file, only a zero-filled hole, and
+must be left alone; an event seen again after the swap must get its row
+written to the new file. Exits non-zero if either goes wrong.
+
+    python bench/check_reevaluate.py
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import schema  # noqa: E402
+from ingest import store_detection  # noqa: E402
+from vectorstore import VectorStore, reevaluate  # noqa: E402
+
+WIDTH = 8
+TABLES = {'common': [f"bird {i}" for i in range(WIDTH)], 'category': [f"cat {i}" for i in range(WIDTH)],
+          'choice': [f"bird {i}" for i in range(WIDTH)]}
+
+
+def classify(conn, store, event_id, best):
+    """What process_event does for one accepted event: register, write the vector, store the detection."""
+    scores = np.full(WIDTH, 5, dtype=np.uint8)
+    scores[best] = 200
+    cursor = conn.cursor()
+    slot, is_new = store.register(cursor, event_id, 'cam', '2024-05-01 08:00:00')
+    if is_new:
+        store.write(slot, scores)
+    store_detection(cursor, '2024-05-01 08:00:00', best, 200 / 255, TABLES['common'][best],
+                    TABLES['category'][best], event_id, 'cam',
+                    [(TABLES['choice'][best], 200 / 255)])
+    conn.commit()
+    return is_new
+
+
+def main():
+    tmp = tempfile.mkdtemp(prefix='reevaluate-')
+    failures = []
+    try:
+        db = os.path.join(tmp, 'speciesid.db')
+        schema.setupdb(db)
+        conn = sqlite3.connect(db)
+        old = VectorStore(os.path.join(tmp, 'old_model.u8'), WIDTH)
+        new = VectorStore(os.path.join(tmp, 'new_model.u8'), WIDTH)
+        for i in range(3):
+            classify(conn, old, f"old-{i}", 1)
+        classify(conn, new, 'new-0', 2)
+
+        mask = np.ones(WIDTH, dtype=bool)
+        summary = reevaluate(conn, new, TABLES, mask, 100, 1 / 255, 0)
+        kept = conn.execute("SELECT COUNT(*) FROM detections").fetchone()[0]
+        print(f"after the swap: {summary}, {kept} detections kept")
+        if summary['removed'] or kept != 4:
+            failures.append("re-evaluating the new model removed detections made under the old one")
+        if summary['events'] != 1:
+            failures.append(f"new model re-evaluated {summary['events']} events, it only wrote 1")
+
+        # an old event updated after the swap is new to this model's file
+        if not classify(conn, new, 'old-0', 1):
+            failures.append("an event registered under the old model wasn't written to the new store")
+        summary = reevaluate(conn, new, TABLES, mask, 100, 1 / 255, 0, dry_run=True)
+        if summary['events'] != 2 or summary['removed']:
+            failures.append(f"after rewriting old-0: {summary}")
+        old.close()
+        new.close()
+        conn.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print("ok")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+Build a large synthetic speciesid database for query benchmarks.
+
+Rows look like what ingest writes: display/category names and top-5 choice
+names come from the real model label set, species are drawn from the
+whitelist with a long-tailed popularity and their own seasonal peak,
+detections follow a dawn/afternoon diurnal curve, and a few percent are
+reviewed or relabelled. The schema, indexes, triggers and aggregate tables
+come from schema.setupdb, so the result behaves like a production file.
+The latest --vectors detections also get a synthetic model output vector,
+in vectors/<model>.u8 next to the database, for the similarity route.
+
+    python bench/gen_db.py --rows 2000000 --days 1095 --out bench/data/large.db
+"""
+import argparse
+import itertools
+import math
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+from classifier import read_model_labels, lookup_common_names, load_whitelist, build_allowed_mask  # noqa: E402
+import schema  # noqa: E402
+from vectorstore import VectorStore, vector_path_for  # noqa: E402
+
+BATCH = 50000
+
+# relative detections per hour of day: nothing at night, peaks after dawn and mid-afternoon
+DIURNAL = [0, 0, 0, 0, 0, 1, 6, 14, 16, 12, 9, 7, 6, 6, 7, 9, 11, 10, 6, 2, 0, 0, 0, 0]
+
+
+def load_labels(model, labels):
+    display, category = read_model_labels(model, labels)
+    birdnames = os.path.join(ROOT, 'birdnames.db')
+    common = lookup_common_names(display, birdnames)
+    with open(labels) as f:
+        choice_names = lookup_common_names([line.strip() for line in f], birdnames)
+    mask = build_allowed_mask(display, common, load_whitelist(os.path.join(ROOT, 'config', 'northeast_birds.txt')))
+    allowed = [i for i in range(len(display)) if mask[i]]
+    return common, category, choice_names, allowed
+
+
+def create_schema(path):
+    """Empty database with the production schema, minus the write triggers."""
+    schema.setupdb(path)
+    conn = sqlite3.connect(path)
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall():
+        conn.execute(f"DROP TRIGGER {name}")
+    conn.execute("DELETE FROM maintenance_meta WHERE key = 'rollups_seeded'")
+    conn.commit()
+    return conn
+
+
+def generate(conn, rows, days, cameras, labels, seed):
+    common, category, choice_names, allowed = labels
+    rng = random.Random(seed)
+    # long-tailed popularity; each species peaks at its own time of year
+    weights = [1 / (rank + 1) ** 0.9 for rank in range(len(allowed))]
+    rng.shuffle(weights)
+    peaks = [rng.uniform(0, 365) for _ in allowed]
+    week_weights = [[w * (1.3 + math.cos(2 * math.pi * (d - p) / 365)) for w, p in zip(weights, peaks)]
+                    for d in range(0, 366, 7)]
+    cum_week_weights = [list(itertools.accumulate(w)) for w in week_weights]
+    species = range(len(allowed))
+    day_weights = [1 + 0.5 * math.sin(2 * math.pi * (d % 365) / 365) for d in range(days)]
+    first_day = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days)
+
+    written = 0
+    started = time.perf_counter()
+    while written < rows:
+        n = min(BATCH, rows - written)
+        det, choices = [], []
+        day_offsets = rng.choices(range(days), weights=day_weights, k=n)
+        hours = rng.choices(range(24), weights=DIURNAL, k=n)
+        for day_offset, hour in zip(day_offsets, hours):
+            ts = first_day + timedelta(days=day_offset, hours=hour, seconds=rng.randrange(3600))
+            week = (ts.timetuple().tm_yday - 1) // 7
+            k = rng.choices(species, cum_weights=cum_week_weights[week])[0]
+            index = allowed[k]
+            score = rng.uniform(0.3, 0.98)
+            event = f"{ts.timestamp():.6f}-{rng.getrandbits(24):06x}"
+            reviewed = 1 if rng.random() < 0.05 else 0
+            user_label = common[allowed[rng.randrange(len(allowed))]] if rng.random() < 0.02 else ''
+            det.append((ts.strftime('%Y-%m-%d %H:%M:%S'), index, score, common[index], category[index],
+                        event, rng.choice(cameras), user_label, reviewed))
+            rest = sorted((rng.uniform(0, score) for _ in range(4)), reverse=True)
+            others = rng.sample(range(len(choice_names)), 4)
+            choices.append((event, 1, choice_names[index], score))
+            choices.extend((event, rank, choice_names[i], s) for rank, (i, s) in enumerate(zip(others, rest), start=2))
+        with conn:
+            conn.executemany("""
+                INSERT OR IGNORE INTO detections (detection_time, detection_index, score, display_name,
+                    category_name, frigate_event, camera_name, user_label, reviewed)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, det)
+            conn.executemany("INSERT OR IGNORE INTO detection_choices VALUES (?, ?, ?, ?)", choices)
+        written += n
+        rate = written / (time.perf_counter() - started)
+        print(f"\r{written:,}/{rows:,} rows ({rate:,.0f}/s)", end='', flush=True)
+    print()
+
+
+def write_vectors(conn, path, width, count, seed):
+    """Output vectors for the latest `count` detections: low noise, a peak at the detected label."""
+    if os.path.exists(path):
+        os.remove(path)
+    store = VectorStore(path, width)
+    rng = np.random.default_rng(seed)
+    rows = conn.execute("""
+        SELECT frigate_event, camera_name, detection_time, detection_index
+          FROM detections ORDER BY id DESC LIMIT ?
+    """, (count,)).fetchall()[::-1]
+    with conn:
+        cursor = conn.cursor()
+        for event, camera, detection_time, index in rows:
+            scores = rng.integers(0, 8, width, dtype=np.uint8)
+            scores[rng.integers(0, width, 4)] = rng.integers(10, 100, 4, dtype=np.uint8)
+            scores[index] = rng.integers(120, 250, dtype=np.uint8)
+            slot, _ = store.register(cursor, event, camera, detection_time)
+            store.write(slot, scores)
+    store.close()
+    print(f"{len(rows):,} vectors: {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--days', type=int, default=3 * 365)
+    parser.add_argument('--cameras', default='feeder,deck')
+    parser.add_argument('--model', default=os.path.join(ROOT, 'models', 'birds_V1_3.tflite'))
+    parser.add_argument('--labels', default=os.path.join(ROOT, 'models', 'birds_V1_labelmap.txt'))
+    parser.add_argument('--vectors', type=int, default=50000, help="latest detections given a vector")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', default=os.path.join(ROOT, 'bench', 'data', 'large.db'))
+    args = parser.parse_args()
+
+    if os.path.exists(args.out):
+        sys.exit(f"{args.out} exists; remove it first")
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    labels = load_labels(args.model, args.labels)
+    conn = create_schema(args.out)
+    generate(conn, args.rows, args.days, args.cameras.split(','), labels, args.seed)
+    if args.vectors:
+        vectors = os.path.join(os.path.dirname(os.path.abspath(args.out)), 'vectors',
+                               os.path.basename(vector_path_for(args.model)))
+        write_vectors(conn, vectors, len(labels[0]), args.vectors, args.seed)
+    conn.close()
+
+    # setupdb again restores the triggers and backfills day_generations and the rollups
+    started = time.perf_counter()
+    schema.setupdb(args.out)
+    print(f"Indexes/aggregates rebuilt in {time.perf_counter() - started:.1f}s: {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""
+Failure handling for calls to Frigate, used by both the web UI and ingest.
+
+  * CircuitBreaker, one per kind of Frigate endpoint (snapshot, thumbnail,
+    clip, and api for the JSON API: the config, the event list and
+    sub_label posts): after `failures` consecutive connection errors, timeouts or
+    5xx answers it opens, and calls fail at once with FrigateUnavailable
+    instead of each holding a thread until its own timeout. After `reset`
+    seconds one call goes through as a probe; if it succeeds the breaker
+    closes, if not it stays open for another `reset`.
+  * NegativeCache: media Frigate answered 404 for, or sent as invalid
+    image data (an event whose media has expired), is not asked for again
+    for `ttl` seconds; callers serve the placeholder straight away.
+
+Both are per process. What a caller does when a breaker is open is up to
+it: the web UI serves the placeholder, ingest defers the event and queues
+it again once the breaker may let calls through.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class FrigateUnavailable(ConnectionError):
+    """A Frigate call failed, or wasn't made because its breaker is open."""
+
+
+class CircuitOpen(FrigateUnavailable):
+    """The call wasn't made: its breaker is open."""
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name: str, failures: int = 5, reset: float = 30.0):
+        self.name = name
+        self.threshold = failures
+        self.reset = reset
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0        # consecutive
+        self.opened_at = 0.0
+        self.probe_at = 0.0
+        self.rejected = 0
+        self.trips = 0
+
+    def allow(self) -> bool:
+        """Whether a call may go to Frigate now. In half-open state only the probe may."""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            # a probe that never reported back doesn't keep the breaker shut for good
+            ready = self.opened_at if self.state == self.OPEN else self.probe_at
+            if now - ready >= self.reset:
+                self.state = self.HALF_OPEN
+                self.probe_at = now
+                return True
+            self.rejected += 1
+            return False
+
+    def retry_in(self) -> float:
+        """Seconds until the breaker lets a probe through (0 when closed)."""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return 0.0
+            ready = self.opened_at if self.state == self.OPEN else self.probe_at
+            return max(ready + self.reset - time.monotonic(), 0.0)
+
+    def success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+                if self.state == self.CLOSED:
+                    self.trips += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def status(self) -> dict:
+        with self.lock:
+            return {'state': self.state, 'failures': self.failures, 'trips': self.trips,
+                    'rejected': self.rejected}
+
+
+class Breakers:
+    """One CircuitBreaker per endpoint kind, created on first use."""
+
+    def __init__(self, failures: int = 5, reset: float = 30.0):
+        self.failures = failures
+        self.reset = reset
+        self.lock = threading.Lock()
+        self.breakers = {}
+
+    def __getitem__(self, name: str) -> CircuitBreaker:
+        with self.lock:
+            b = self.breakers.get(name)
+            if b is None:
+                b = self.breakers[name] = CircuitBreaker(name, self.failures, self.reset)
+            return b
+
+    def status(self) -> dict:
+        with self.lock:
+            breakers = dict(self.breakers)
+        return {name: b.status() for name, b in sorted(breakers.items())}
+
+
+class NegativeCache:
+    """Keys that recently came back missing, forgotten after `ttl` seconds."""
+
+    def __init__(self, ttl: float = 300.0, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # key -> expiry
+
+    def __contains__(self, key) -> bool:
+        with self.lock:
+            expires = self.entries.get(key)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self.entries[key]
+                return False
+            return True
+
+    def add(self, key):
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            self.entries[key] = time.monotonic() + self.ttl
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def guarded_get(session, url: str, breaker: CircuitBreaker, **kwargs):
+    """
+    session.get(url) through `breaker`. Raises CircuitOpen if the breaker is
+    open, and FrigateUnavailable if the request fails or Frigate answers
+    5xx. Any other answer (404 included) means Frigate is up and is returned.
+    """
+    return _guarded(session.get, url, breaker, **kwargs)
+
+
+def guarded_post(session, url: str, breaker: CircuitBreaker, **kwargs):
+    """session.post(url) through `breaker`, as guarded_get."""
+    return _guarded(session.post, url, breaker, **kwargs)
+
+
+def _guarded(request, url: str, breaker: CircuitBreaker, **kwargs):
+    if not breaker.allow():
+        raise CircuitOpen(f"{breaker.name}: circuit open")
+    try:
+        r = request(url, **kwargs)
+    except OSError as e:
+        breaker.failure()
+        raise FrigateUnavailable(f"{breaker.name}: {e}") from e
+    if r.status_code >= 500:
+        breaker.failure()
+        r.close()
+        raise FrigateUnavailable(f"{breaker.name}: HTTP {r.status_code}")
+    breaker.success()
+    return r
@@ -0,0 +1,224 @@
+"""
+Catch-up for bird events that happened while ingest wasn't listening.
+
+Live classification only sees MQTT messages, so without this every event
+during a restart or a broker outage is lost. Each ingest node keeps a
+high-water mark in maintenance_meta: a start time before which every event
+has been handled. It is the earliest of
+
+  * now while connected, or the moment the connection dropped,
+  * the oldest event still queued or being classified, and
+  * the oldest event a catch-up run hasn't queued yet,
+
+and is saved every `save_interval` seconds. On startup and on every
+reconnect, CatchUp lists bird events with a snapshot from Frigate's
+/api/events since the mark (less `overlap` seconds, for events whose first
+update came late), leaves out the ones already classified, and queues the
+rest with the dispatcher as backlog, oldest first and at most
+`max_pending` at a time. Backlog only runs on workers live updates leave
+idle, so live messages keep flowing while it drains.
+"""
+import logging
+import sqlite3
+import threading
+import time
+
+from breaker import CircuitBreaker, guarded_get
+from retention import get_meta, set_meta
+
+logger = logging.getLogger(__name__)
+
+MARK_KEY = 'ingest_mark:{node}'
+# event ids per IN (...) lookup
+LOOKUP_CHUNK = 500
+
+
+def event_to_update(event: dict, frame_size) -> dict:
+    """
+    An /api/events entry in the shape of an MQTT update's `after`, or None
+    without a usable box or the camera's resolution.
+
+    The crop is cut from the event's snapshot, so the box has to be the
+    snapshot's. The API has no separate snapshot box: `data.box` and
+    `data.region` are written from the event's last update. The box is
+    only used when it lies inside that region, the part of the frame the
+    detector looked at for it; a box outside it belongs to another frame
+    and the event is left out, like one without a box. The API's boxes are
+    relative [x, y, w, h]; updates carry pixels of the detect frame.
+    """
+    data = event.get('data') or {}
+    box, region = data.get('box'), data.get('region')
+    size = frame_size(event['camera'])
+    if not box or not size or (region and not _inside(box, region)):
+        return None
+    x, y, w, h = box
+    width, height = size
+    return {'id': event['id'], 'camera': event['camera'], 'label': event['label'],
+            'has_snapshot': True, 'start_time': event['start_time'], 'end_time': event.get('end_time'),
+            'snapshot': {'box': [round(x * width), round(y * height),
+                                 round((x + w) * width), round((y + h) * height)]}}
+
+
+def _inside(box, region, slack: float = 0.01) -> bool:
+    """Whether relative [x, y, w, h] `box` lies within `region`, give or take rounding."""
+    return (box[0] >= region[0] - slack and box[1] >= region[1] - slack
+            and box[0] + box[2] <= region[0] + region[2] + slack
+            and box[1] + box[3] <= region[1] + region[3] + slack)
+
+
+class CatchUp(threading.Thread):
+    """Replays events missed while offline through `dispatcher` (see module docstring)."""
+
+    def __init__(self, session, base_url: str, db_path: str, dispatcher, node: str, frame_size,
+                 accept=None, overlap: float = 300, max_hours: float = 24, max_pending: int = 4,
+                 page_size: int = 100, save_interval: float = 30, retry: float = 60,
+                 breaker: CircuitBreaker = None):
+        super().__init__(name='catchup', daemon=True)
+        self.session = session
+        self.breaker = breaker or CircuitBreaker('api')
+        self.url = f"{base_url}/api/events"
+        self.db_path = db_path
+        self.dispatcher = dispatcher
+        self.key = MARK_KEY.format(node=node)
+        self.frame_size = frame_size
+        self.accept = accept or (lambda event_id: True)
+        self.overlap = overlap
+        self.max_hours = max_hours
+        self.page_size = page_size
+        self.save_interval = save_interval
+        self.retry = retry
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.online = False
+        self.cursor = None         # start time of the next backlog event to queue
+        self.since = None          # mark to catch up from on the next run
+        conn = sqlite3.connect(db_path, timeout=30)
+        stored = get_meta(conn, self.key)
+        conn.close()
+        self.covered = float(stored) if stored is not None else time.time()
+        self.last_run = None
+
+    # -- called from the MQTT callbacks ---------------------------------
+
+    def connected(self):
+        """Catch up from the mark, which holds still until now."""
+        with self.lock:
+            mark = self.mark()
+            self.online = True
+            self.since = mark if self.since is None else min(self.since, mark)
+        self.wake.set()
+
+    def disconnected(self):
+        with self.lock:
+            if self.online:
+                self.online = False
+                self.covered = time.time()
+
+    # -- high-water mark ------------------------------------------------
+
+    def mark(self) -> float:
+        covered = time.time() if self.online else self.covered
+        pending = self.dispatcher.oldest_pending(lambda after: after['start_time'])
+        return min(t for t in (covered, pending, self.cursor, self.since) if t is not None)
+
+    def save_mark(self):
+        with self.lock:
+            mark = self.mark()
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                set_meta(conn, self.key, repr(mark))
+        except sqlite3.Error as e:
+            logger.warning("Could not save the ingest high-water mark: %s", e)
+        finally:
+            conn.close()
+
+    # -- catch-up runs --------------------------------------------------
+
+    def run(self):
+        while True:
+            self.wake.wait(self.save_interval)
+            self.wake.clear()
+            with self.lock:
+                since, self.since = self.since, None
+                if since is not None:
+                    self.cursor = since
+            if since is not None:
+                try:
+                    self.catch_up(since)
+                except (OSError, ValueError, KeyError, sqlite3.Error) as e:
+                    logger.warning("Catch-up from %.0f failed, retrying in %.0fs: %s", since, self.retry, e)
+                    with self.lock:
+                        self.since = since if self.since is None else min(self.since, since)
+                    self.save_mark()
+                    time.sleep(self.retry)
+                    self.wake.set()
+                    continue
+                finally:
+                    with self.lock:
+                        self.cursor = None
+            self.save_mark()
+
+    def catch_up(self, since: float):
+        started = time.time()
+        after = max(since - self.overlap, started - self.max_hours * 3600)
+        events = [e for e in self._list(after) if self.accept(e['id'])]
+        known = self._known([e['id'] for e in events])
+        missed = sorted((e for e in events if e['id'] not in known), key=lambda e: e['start_time'])
+        queued = unusable = 0
+        for event in missed:
+            update = event_to_update(event, self.frame_size)
+            if update is None:
+                unusable += 1
+                continue
+            self.slots.acquire()
+            with self.lock:
+                self.cursor = event['start_time']
+            self.dispatcher.submit(event['id'], update, camera=event['camera'], backlog=True,
+                                   done=self.slots.release)
+            queued += 1
+        self.last_run = {'at': started, 'from': after, 'listed': len(events), 'known': len(known),
+                         'queued': queued, 'unusable': unusable, 'seconds': round(time.time() - started, 1)}
+        if missed:
+            logger.info("Catch-up since %s: %d events listed, %d already classified, %d queued, %d without a usable box",
+                        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(after)),
+                        len(events), len(known), queued, unusable)
+
+    def _list(self, after: float) -> list:
+        """Bird events with a snapshot that started after `after`, newest first."""
+        params = {'after': after, 'label': 'bird', 'has_snapshot': 1, 'include_thumbnails': 0,
+                  'limit': self.page_size}
+        events = {}
+        while True:
+            r = guarded_get(self.session, self.url, self.breaker, params=params, timeout=30)
+            r.raise_for_status()
+            page = r.json()
+            for event in page:
+                events.setdefault(event['id'], event)
+            if len(page) < self.page_size:
+                return list(events.values())
+            params['before'] = min(event['start_time'] for event in page)
+
+    def _known(self, event_ids) -> set:
+        """Events that already have a vector slot (every classified event does) or a detection."""
+        known = set()
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            for i in range(0, len(event_ids), LOOKUP_CHUNK):
+                chunk = event_ids[i:i + LOOKUP_CHUNK]
+                marks = ','.join('?' * len(chunk))
+                known.update(row[0] for row in conn.execute(f"""
+                    SELECT frigate_event FROM detection_vectors WHERE frigate_event IN ({marks})
+                    UNION
+                    SELECT frigate_event FROM detections WHERE frigate_event IN ({marks})
+                """, chunk + chunk))
+        finally:
+            conn.close()
+        return known
+
+    def status(self) -> dict:
+        with self.lock:
+            mark = self.mark()
+        return {'mark': mark, 'online': self.online, 'catching_up': self.cursor is not None,
+                'last_run': self.last_run}
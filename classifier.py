@@ -0,0 +1,336 @@
+import os
+import json
+import queue
+import hashlib
+import sqlite3
+import threading
+import zipfile
+from contextlib import contextmanager
+from datetime import datetime
+import numpy as np
+from PIL import Image
+import tflite_runtime.interpreter as tflite
+
+# Display names the model uses for its "no bird" output
+BACKGROUND_LABELS = {'None', 'background', '__background__'}
+
+
+class InterpreterEngine:
+    """
+    Thin wrapper around a TFLite interpreter that works on the interpreter's
+    own tensor buffers instead of copying arrays in and out.
+
+    The input/output accessors returned by `interpreter.tensor()` are kept for
+    the life of the engine; the NumPy views they hand back are only held for
+    the duration of a single write or read, because TFLite refuses to invoke
+    while a view into its arena is still alive.
+    """
+
+    def __init__(self, model_path: str, label_path: str, num_threads: int = None):
+        self.interpreter = tflite.Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+
+        input_details = self.interpreter.get_input_details()[0]
+        output_details = self.interpreter.get_output_details()[0]
+        _, self.height, self.width, _ = input_details['shape']
+        self.input_dtype = input_details['dtype']
+        self.scale, self.zero_point = output_details['quantization']
+
+        # Callables returning views into the interpreter arena (no copies)
+        self._input = self.interpreter.tensor(input_details['index'])
+        self._output = self.interpreter.tensor(output_details['index'])
+        # Staging for set_image: Pillow keeps RGB pixels 4 bytes wide, so an
+        # RGBX image mapped onto this array takes a paste of an RGB image
+        # as a plain copy, and the tensor is filled from a view of it
+        self._pixels = np.zeros((self.height, self.width, 4), dtype=np.uint8)
+        self._staging = Image.frombuffer('RGBX', (self.width, self.height), self._pixels, 'raw', 'RGBX', 0, 1)
+
+        with open(label_path) as f:
+            self.labels = [line.strip() for line in f]
+
+    def set_image(self, img: Image.Image):
+        """
+        Write `img` centred on a black background straight into the input
+        tensor. The image must already fit inside the model's input size;
+        this reproduces the crop → thumbnail → pad step without building the
+        padded image.
+        """
+        w, h = img.size
+        if w > self.width or h > self.height:
+            raise ValueError(f"image {w}x{h} larger than model input {self.width}x{self.height}")
+        left = (self.width - w) // 2
+        top = (self.height - h) // 2
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        # The core paste writes into the mapped array (Image.paste would
+        # copy the read-only mapping first); no array is built from `img`
+        img.load()
+        self._staging.im.paste(img.im, (left, top, left + w, top + h))
+        buf = self._input()[0]
+        buf.fill(0)
+        buf[top:top + h, left:left + w] = self._pixels[top:top + h, left:left + w, :3]
+        del buf
+
+    def invoke(self):
+        self.interpreter.invoke()
+
+    def raw_scores(self) -> np.ndarray:
+        """
+        View of the quantized output vector for the last invoke. Callers must
+        drop the reference before the next invoke().
+        """
+        return self._output()[0]
+
+    def top_k(self, k: int = 5):
+        """
+        Return [(index, score), ...] for the k highest outputs, best first.
+        Selection runs on the raw quantized scores; only the k winners are
+        dequantized.
+        """
+        raw = self._output()[0]
+        idx = np.argpartition(raw, -k)[-k:]
+        ranked = sorted(((int(raw[i]), int(i)) for i in idx), reverse=True)
+        del raw
+        return [(i, self.scale * (q - self.zero_point)) for q, i in ranked]
+
+    def classify(self, img: Image.Image, k: int = 5):
+        """Run one image and return [(label, score), ...] for the top k."""
+        self.set_image(img)
+        self.invoke()
+        return [(self.labels[i], score) for i, score in self.top_k(k)]
+
+
+def read_model_labels(model_path: str, label_path: str):
+    """
+    Return (display_names, category_names) in output order.
+
+    The AIY models carry their label files inside the .tflite (it is also a
+    zip archive); those are what tflite_support used to report as
+    display_name/category_name. Fall back to the plain label map, dropping
+    the "(Common Name)" suffix, for models without metadata.
+    """
+    try:
+        with zipfile.ZipFile(model_path) as z:
+            display = z.read('probability-labels-en.txt').decode().splitlines()
+            category = z.read('probability-labels.txt').decode().splitlines()
+        return display, category
+    except (zipfile.BadZipFile, KeyError, OSError):
+        pass
+    with open(label_path) as f:
+        display = [line.strip().split(' (')[0] for line in f]
+    return display, list(display)
+
+
+def load_whitelist(path: str) -> set:
+    """Read the allowed common names (lowercased), ignoring # comments."""
+    with open(path, 'r') as f:
+        return {line.strip().lower() for line in f if line.strip() and not line.strip().startswith('#')}
+
+
+def lookup_common_names(names, birdnames_path: str):
+    """Map scientific names to common names with a single birdnames.db query."""
+    conn = sqlite3.connect(birdnames_path)
+    try:
+        found = dict(conn.execute(
+            "SELECT scientific_name, common_name FROM birdnames WHERE scientific_name IN ({})"
+            .format(','.join('?' * len(set(names)))),
+            tuple(set(names))
+        ).fetchall())
+    except sqlite3.Error as e:
+        print(f"Warning: failed to load common names: {e}")
+        found = {}
+    finally:
+        conn.close()
+    return [found.get(n) or n for n in names]
+
+
+def build_allowed_mask(display_names, common_names, allowed) -> np.ndarray:
+    """Boolean mask over the model outputs that may become a detection."""
+    return np.array([
+        d not in BACKGROUND_LABELS and c.lower() in allowed
+        for d, c in zip(display_names, common_names)
+    ], dtype=bool)
+
+
+def threshold_to_quantized(threshold: float, scale: float, zero_point: int) -> int:
+    """Smallest raw output value whose dequantized score is >= threshold."""
+    return max(int(np.ceil(threshold / scale + zero_point - 1e-6)), 0)
+
+
+def pick_best(scores: np.ndarray, mask: np.ndarray, min_q: int):
+    """
+    Return the output index of the highest-scoring allowed label for one raw
+    score vector, or -1 if none reaches `min_q`.
+    """
+    allowed_idx = np.flatnonzero(mask)
+    if allowed_idx.size == 0:
+        return -1
+    best = allowed_idx[np.argmax(scores[allowed_idx])]
+    return int(best) if scores[best] >= min_q else -1
+
+
+def pick_best_batch(matrix: np.ndarray, mask: np.ndarray, min_q: int) -> np.ndarray:
+    """
+    Vectorised pick_best over an (N, labels) uint8 matrix. Only the allowed
+    columns are gathered, so the work scales with the whitelist size rather
+    than the label count.
+    """
+    allowed_idx = np.flatnonzero(mask)
+    if allowed_idx.size == 0:
+        return np.full(len(matrix), -1, dtype=np.int64)
+    sub = matrix[:, allowed_idx]
+    col = np.argmax(sub, axis=1)
+    best_q = sub[np.arange(len(sub)), col]
+    return np.where(best_q >= min_q, allowed_idx[col], -1)
+
+
+class ClassificationContext:
+    """
+    Everything on_message needs to turn an image into a decision: engine,
+    label tables, whitelist mask, quantized threshold and vector store.
+
+    It is built completely before it is published, so a reload swaps it
+    with a single assignment; messages already in flight keep the context
+    they started with.
+    """
+
+    def __init__(self, cls_cfg: dict, whitelist_path: str, birdnames_path: str, previous=None):
+        from vectorstore import VectorStore, vector_path_for
+
+        self.model_path = cls_cfg['model']
+        self.label_path = cls_cfg['labels']
+        self.threshold = float(cls_cfg['threshold'])
+        self.whitelist_path = whitelist_path
+        self.num_threads = cls_cfg.get('num_threads', 4)
+        self.model_key = (self.model_path, os.path.getmtime(self.model_path),
+                          self.label_path, os.path.getmtime(self.label_path))
+
+        if previous is not None and previous.model_key == self.model_key:
+            # Same model: keep the loaded interpreters and the open store
+            self.engines = previous.engines
+            self.vectors = previous.vectors
+            self.scale, self.zero_point = previous.scale, previous.zero_point
+            self.display_names = previous.display_names
+            self.category_names = previous.category_names
+            self.common_names = previous.common_names
+            self.choice_names = previous.choice_names
+        else:
+            # Interpreters aren't thread-safe: one per concurrent worker,
+            # created on demand and returned to this pool after each event
+            self.engines = queue.SimpleQueue()
+            first = InterpreterEngine(self.model_path, self.label_path, num_threads=self.num_threads)
+            self.engines.put(first)
+            self.scale, self.zero_point = first.scale, first.zero_point
+            self.vectors = VectorStore(vector_path_for(self.model_path), len(first.labels))
+            self.display_names, self.category_names = read_model_labels(self.model_path, self.label_path)
+            self.common_names = lookup_common_names(self.display_names, birdnames_path)
+            # detection_choices have always stored the label map entry's lookup
+            self.choice_names = lookup_common_names(first.labels, birdnames_path)
+
+        try:
+            self.allowed = load_whitelist(whitelist_path)
+        except FileNotFoundError:
+            print(f"Whitelist file not found: {whitelist_path}")
+            self.allowed = set()
+        self.allowed_mask = build_allowed_mask(self.display_names, self.common_names, self.allowed)
+        self.min_q = threshold_to_quantized(self.threshold, self.scale, self.zero_point)
+
+        digest = hashlib.sha1(repr((self.model_key, self.threshold, sorted(self.allowed))).encode())
+        self.version = digest.hexdigest()[:12]
+        self.loaded_at = datetime.now().isoformat(timespec='seconds')
+
+    def acquire(self) -> bool:
+        """Count an event as using this context; False once its vector store has been closed."""
+        return self.vectors.acquire()
+
+    def release(self):
+        self.vectors.release()
+
+    def retire(self, successor):
+        """
+        `successor` has been published in this context's place: close the
+        vector store, unless the successor shares it, once the events still
+        using this context are done.
+        """
+        if successor.vectors is not self.vectors:
+            self.vectors.retire()
+
+    @contextmanager
+    def engine(self):
+        """Borrow an interpreter for one event."""
+        try:
+            engine = self.engines.get_nowait()
+        except queue.Empty:
+            engine = InterpreterEngine(self.model_path, self.label_path, num_threads=self.num_threads)
+        try:
+            yield engine
+        finally:
+            self.engines.put(engine)
+
+    def status(self) -> dict:
+        return {
+            'version': self.version,
+            'loaded_at': self.loaded_at,
+            'model': self.model_path,
+            'labels': self.label_path,
+            'threshold': self.threshold,
+            'whitelist': self.whitelist_path,
+            'allowed_labels': int(self.allowed_mask.sum()),
+        }
+
+
+class ContextReloader(threading.Thread):
+    """
+    Polls the config file, whitelist, model, label map and a trigger file,
+    and rebuilds the classification context when any of them change (or when
+    trigger() is called, e.g. from a SIGHUP handler). A context that fails to
+    build is logged and the current one stays active.
+    """
+
+    def __init__(self, build, publish, watch_paths, status_path: str, interval: float = 5.0):
+        super().__init__(name='context-reloader', daemon=True)
+        self.build = build
+        self.publish = publish
+        self.watch_paths = watch_paths
+        self.status_path = status_path
+        self.interval = interval
+        self.wake = threading.Event()
+        self.mtimes = self._mtimes()
+
+    def _mtimes(self):
+        paths = self.watch_paths() if callable(self.watch_paths) else self.watch_paths
+        result = {}
+        for path in paths:
+            try:
+                result[path] = os.path.getmtime(path)
+            except OSError:
+                result[path] = None
+        return result
+
+    def trigger(self):
+        self.wake.set()
+
+    def write_status(self, ctx):
+        os.makedirs(os.path.dirname(self.status_path) or '.', exist_ok=True)
+        tmp = self.status_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(ctx.status(), f)
+        os.replace(tmp, self.status_path)
+
+    def run(self):
+        while True:
+            forced = self.wake.wait(self.interval)
+            self.wake.clear()
+            mtimes = self._mtimes()
+            if not forced and mtimes == self.mtimes:
+                continue
+            self.mtimes = mtimes
+            try:
+                ctx = self.build()
+            except Exception as e:
+                print(f"Classification reload failed, keeping current context: {e}", flush=True)
+                continue
+            self.publish(ctx)
+            self.write_status(ctx)
+            print(f"Classification context {ctx.version} active", flush=True)
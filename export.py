@@ -0,0 +1,240 @@
+"""
+Streaming export of detections, with their top-5 choices, for analysis
+outside the app. Rows come from a server-side cursor in fixed-size batches
+and are written out as they're read, so memory use doesn't depend on how
+much history is exported.
+
+Formats: csv, ndjson, and parquet (columnar, zstd-compressed; needs the
+optional `pyarrow` package). csv/ndjson can additionally be gzipped.
+
+    python export.py --format parquet --start 2024-01-01 --end 2024-12-31 -o 2024.parquet
+    python export.py --format csv --species "Blue Jay" --gzip > blue_jay.csv.gz
+
+The web UI serves the same thing at /api/export?format=...&start=...
+"""
+import argparse
+import csv
+import io
+import json
+import sqlite3
+import sys
+import zlib
+from datetime import date, timedelta
+
+DBPATH = './data/speciesid.db'
+
+# detections read per fetchmany() and rows per parquet row group
+BATCH_ROWS = 2000
+CHOICES = 5
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+DETECTION_COLUMNS = ['id', 'detection_time', 'camera_name', 'display_name', 'category_name', 'score',
+                     'detection_index', 'frigate_event', 'user_label', 'reviewed']
+COLUMNS = DETECTION_COLUMNS + [f"choice{r}_{field}" for r in range(1, CHOICES + 1) for field in ('name', 'score')]
+
+
+def _where(start=None, end=None, camera=None, species=None, reviewed=None, min_score=None):
+    """WHERE clause for the filters; date bounds are ranges so idx_detections_time applies."""
+    clauses, params = [], []
+    if start:
+        clauses.append("d.detection_time >= ?")
+        params.append(start.isoformat())
+    if end:
+        clauses.append("d.detection_time < ?")
+        params.append((end + timedelta(days=1)).isoformat())
+    if camera:
+        clauses.append("d.camera_name = ?")
+        params.append(camera)
+    if species:
+        clauses.append("d.display_name = ?")
+        params.append(species)
+    if reviewed is not None:
+        clauses.append("d.reviewed = ?")
+        params.append(1 if reviewed else 0)
+    if min_score is not None:
+        clauses.append("d.score >= ?")
+        params.append(min_score)
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+
+def iter_batches(conn, batch_rows: int = BATCH_ROWS, **filters):
+    """
+    Yield lists of flat rows (in COLUMNS order), at most `batch_rows` long,
+    ordered by detection time. Choices are joined in the same query and
+    folded into their detection's row as the cursor advances.
+    """
+    where, params = _where(**filters)
+    cur = conn.execute(f"""
+        SELECT {', '.join('d.' + c for c in DETECTION_COLUMNS)}, c.rank, c.display_name, c.score
+          FROM detections d
+          LEFT JOIN detection_choices c ON c.event_id = d.frigate_event AND c.rank <= {CHOICES}
+        {where}
+         ORDER BY d.detection_time, d.id, c.rank
+    """, params)
+
+    width = len(DETECTION_COLUMNS)
+    batch, row, current = [], None, None
+    while True:
+        chunk = cur.fetchmany(batch_rows)
+        if not chunk:
+            break
+        for r in chunk:
+            if r[0] != current:
+                if row is not None:
+                    batch.append(row)
+                    if len(batch) >= batch_rows:
+                        yield batch
+                        batch = []
+                current = r[0]
+                row = list(r[:width]) + [None] * (2 * CHOICES)
+            rank = r[width]
+            if rank is not None:
+                row[width + 2 * (rank - 1)] = r[width + 1]
+                row[width + 2 * (rank - 1) + 1] = r[width + 2]
+    if row is not None:
+        batch.append(row)
+    if batch:
+        yield batch
+
+
+def _csv_chunks(batches):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(COLUMNS)
+    for batch in batches:
+        writer.writerows(batch)
+        yield buf.getvalue().encode()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode()
+
+
+def _ndjson_chunks(batches):
+    for batch in batches:
+        yield ''.join(json.dumps(dict(zip(COLUMNS, row))) + '\n' for row in batch).encode()
+
+
+class _ChunkSink:
+    """Write-only file object that hands back whatever was written since the last drain()."""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data, self.parts = b''.join(self.parts), []
+        return data
+
+
+def _parquet_chunks(batches):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("parquet export needs pyarrow (pip install pyarrow)")
+
+    types = {'id': pa.int64(), 'detection_index': pa.int32(), 'reviewed': pa.int8(),
+             'score': pa.float32(), 'detection_time': pa.string()}
+    schema = pa.schema([(c, pa.float32() if c.endswith('_score') else types.get(c, pa.string()))
+                        for c in COLUMNS])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    for batch in batches:
+        columns = list(zip(*batch))
+        writer.write_table(pa.Table.from_arrays(
+            [pa.array(col, type=field.type) for col, field in zip(columns, schema)], schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_export(db_path: str, fmt: str, gzip: bool = False, **filters):
+    """
+    Generator of encoded output chunks for `fmt`. Opens (and closes) its own
+    connection so it can outlive the request that started it.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown export format {fmt!r}")
+    if fmt == 'parquet':
+        # fail before the first byte is sent, not halfway through a response
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise RuntimeError("parquet export needs pyarrow (pip install pyarrow)")
+
+    def generate():
+        conn = sqlite3.connect(db_path, timeout=30)
+        try:
+            batches = iter_batches(conn, **filters)
+            chunks = {'csv': _csv_chunks, 'ndjson': _ndjson_chunks, 'parquet': _parquet_chunks}[fmt](batches)
+            # parquet pages are already compressed
+            yield from (_gzip_chunks(chunks) if gzip and fmt != 'parquet' else chunks)
+        finally:
+            conn.close()
+    return generate()
+
+
+def export_filename(fmt: str, gzip: bool = False, start=None, end=None) -> str:
+    span = '_'.join(d.isoformat() for d in (start, end) if d) or 'all'
+    return f"detections_{span}.{fmt}" + ('.gz' if gzip and fmt != 'parquet' else '')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export detections with their top-5 choices")
+    parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+    parser.add_argument('--start', type=date.fromisoformat, help="first day (YYYY-MM-DD)")
+    parser.add_argument('--end', type=date.fromisoformat, help="last day, inclusive")
+    parser.add_argument('--camera')
+    parser.add_argument('--species', help="common name as shown in the UI")
+    parser.add_argument('--reviewed', type=int, choices=[0, 1])
+    parser.add_argument('--min-score', type=float)
+    parser.add_argument('--gzip', action='store_true', help="gzip csv/ndjson output")
+    parser.add_argument('--db', default=DBPATH)
+    parser.add_argument('-o', '--output', help="file to write (default: stdout)")
+    args = parser.parse_args()
+
+    chunks = stream_export(args.db, args.format, gzip=args.gzip, start=args.start, end=args.end,
+                           camera=args.camera, species=args.species,
+                           reviewed=None if args.reviewed is None else bool(args.reviewed),
+                           min_score=args.min_score)
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for chunk in chunks:
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,360 @@
+"""
+Ingest plumbing shared by every node: routing Frigate events to worker
+threads, partitioning events across nodes, and the idempotent detection
+write.
+
+Scaling out works in one of two ways (config `ingest:`):
+
+  * shared_group: every node joins the MQTT v5 shared subscription
+    $share/<group>/frigate/events and the broker spreads messages across
+    them. The broker doesn't keep one event on one node, so the write below
+    is order-independent: a stored row only ever moves to a higher score.
+  * partitions/partition_index: every node receives the full stream and
+    keeps only the events that hash to its partition, so all updates for an
+    event are handled by one node, in order.
+
+The two can't be combined: under a shared subscription each message reaches
+one node only, and a node would drop the events outside its partition.
+check_scaling() refuses such a config at startup.
+
+Within a node, EventDispatcher schedules classification work across
+cameras: one queue per camera, served in proportion to its weight and no
+faster than its max_rate, with the first update of an event ahead of
+refreshes of events already queued or classified (config `ingest.cameras`).
+Two updates for one event never run concurrently, and they run in order.
+Backlog work (events fetched from Frigate after downtime, see catchup.py,
+and events deferred while Frigate is unreachable, see breaker.py) only runs
+when no live update is waiting.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+
+def partition_of(event_id: str, partitions: int) -> int:
+    """Stable (process-independent) partition for an event id."""
+    return zlib.crc32(event_id.encode()) % partitions
+
+
+def check_scaling(ingest_cfg: dict):
+    """Raise ValueError for an `ingest:` config that would lose events (see module docstring)."""
+    partitions = ingest_cfg.get('partitions', 1)
+    if ingest_cfg.get('shared_group') and partitions > 1:
+        raise ValueError("ingest.shared_group and ingest.partitions > 1 can't be combined: "
+                         "each node only gets a share of the messages, so events outside "
+                         "its partition would never be classified")
+    if partitions > 1 and not 0 <= ingest_cfg.get('partition_index', 0) < partitions:
+        raise ValueError(f"ingest.partition_index must be between 0 and {partitions - 1}")
+
+
+class CameraQueue:
+    """Pending work and scheduling state for one camera."""
+
+    def __init__(self, name: str, weight: float = 1.0, max_rate: float = 0.0, burst: float = None,
+                 max_queued: int = 100):
+        self.name = name
+        self.weight = max(float(weight), 0.01)
+        self.max_rate = float(max_rate or 0)     # dispatches per second; 0 = unlimited
+        self.burst = float(burst or max(1.0, self.max_rate))
+        self.max_queued = max_queued
+        self.tokens = self.burst
+        self.refilled = time.monotonic()
+        self.vtime = 0.0                         # fair-queueing finish tag of the last dispatch
+        self.new = deque()                       # first update of an event
+        self.refresh = deque()                   # later updates
+        self.backlog = deque()                   # missed events being caught up
+        self.dispatched = 0
+        self.coalesced = 0
+        self.dropped = 0
+        # time spent queued, since the last status report
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def refill(self, now: float):
+        if self.max_rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.max_rate)
+        self.refilled = now
+
+    def token_in(self) -> float:
+        """Seconds until the next dispatch is allowed."""
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.max_rate
+
+    def record_wait(self, seconds: float):
+        self.wait_count += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    def status(self, reset: bool = False) -> dict:
+        status = {'weight': self.weight, 'max_rate': self.max_rate,
+                  'queued_new': len(self.new), 'queued_refresh': len(self.refresh),
+                  'queued_backlog': len(self.backlog),
+                  'dispatched': self.dispatched, 'coalesced': self.coalesced, 'dropped': self.dropped,
+                  'wait_ms_mean': round(self.wait_total * 1000 / self.wait_count, 1) if self.wait_count else None,
+                  'wait_ms_max': round(self.wait_max * 1000, 1) if self.wait_count else None}
+        if reset:
+            self.wait_count, self.wait_total, self.wait_max = 0, 0.0, 0.0
+        return status
+
+
+class _Job:
+    __slots__ = ('event_id', 'item', 'queue', 'enqueued', 'done', 'not_before')
+
+    def __init__(self, event_id, item, queue, enqueued, done=None, not_before=0.0):
+        self.event_id = event_id
+        self.item = item
+        self.queue = queue
+        self.enqueued = enqueued
+        self.done = done
+        self.not_before = not_before
+
+
+class EventDispatcher:
+    """
+    Runs `handler(item)` on `workers` threads.
+
+    Work is queued per camera and picked by start-time fair queueing, so each
+    camera with work waiting gets a share of the workers proportional to its
+    weight, and a camera that was idle doesn't bank credit. A camera's
+    max_rate is a token bucket on dispatches. The first update seen for an
+    event goes ahead of refresh updates, on every camera, and both go ahead
+    of backlog jobs (submit(backlog=True)). With `coalesce`, a
+    refresh that is still waiting is replaced by a newer one for the same
+    event instead of queued behind it (speciesid fetches the event's current
+    snapshot, not the one from the message, so the older update is
+    redundant). For the same reason a camera holding max_queued jobs sheds
+    its oldest refresh rather than fill the shared queue, so a rate-limited
+    camera that keeps sending can't block the others.
+
+    An event is never handled by two workers at once; its updates run in
+    arrival order. The queue of live updates is bounded; a full queue
+    blocks the caller (the MQTT network loop), which pushes back on the
+    broker instead of buffering without limit. Backlog jobs don't count
+    towards that bound and never block, so a worker can requeue its own
+    event; their callers bound them (catch-up's max_pending, the deferral
+    limits in speciesid). A backlog job with a `delay` isn't started before
+    that many seconds have passed.
+
+    `cameras` maps camera name to {weight, max_rate, burst, max_queued};
+    the `default` entry applies to cameras not listed. With `status_path`,
+    queue depth, dispatch counts and wait times per camera are written
+    there every `status_interval` seconds, along with the result of each
+    `status_sources` callable under its name.
+    """
+
+    SEEN_EVENTS = 10000
+
+    def __init__(self, handler, workers: int = 1, maxsize: int = 1000, cameras: dict = None,
+                 coalesce: bool = False, status_path: str = None, status_interval: float = 5.0,
+                 status_sources: dict = None):
+        self.handler = handler
+        self.maxsize = maxsize
+        self.camera_cfg = cameras or {}
+        self.coalesce = coalesce
+        self.status_sources = status_sources or {}
+        self.cond = threading.Condition()
+        self.cameras = {}
+        self.size = 0                # queued jobs
+        self.backlogged = 0          # of which backlog
+        self.unfinished = 0          # queued + running, for join()
+        self.waiting = {}            # event id -> queued refresh (coalesce only)
+        self.running = {}            # event id -> item being handled
+        self.seen = OrderedDict()    # recently submitted event ids
+        self.vclock = 0.0
+        self.threads = [
+            threading.Thread(target=self._run, name=f"ingest-worker-{i}", daemon=True)
+            for i in range(max(workers, 1))
+        ]
+        for t in self.threads:
+            t.start()
+        if status_path:
+            threading.Thread(target=self._report, args=(status_path, status_interval),
+                             name='ingest-status', daemon=True).start()
+
+    def _camera(self, name: str) -> CameraQueue:
+        q = self.cameras.get(name)
+        if q is None:
+            cfg = dict(self.camera_cfg.get('default') or {}, **(self.camera_cfg.get(name) or {}))
+            q = self.cameras[name] = CameraQueue(name, cfg.get('weight', 1.0), cfg.get('max_rate', 0),
+                                                 cfg.get('burst'), cfg.get('max_queued', 100))
+        return q
+
+    def submit(self, event_id: str, item, camera: str = None, backlog: bool = False, done=None,
+               delay: float = 0.0):
+        """
+        Queue `item`. Backlog items are never coalesced or shed, and wait
+        `delay` seconds before they may run; `done()` is called once the
+        item has been handled.
+        """
+        with self.cond:
+            job = None if backlog else self.waiting.get(event_id)
+            if job is not None:
+                job.item = item
+                job.queue.coalesced += 1
+                return
+            q = self._camera(camera or 'unknown')
+            if not backlog and self.coalesce and q.refresh and len(q.new) + len(q.refresh) >= q.max_queued:
+                dropped = q.refresh.popleft()
+                if self.waiting.get(dropped.event_id) is dropped:
+                    del self.waiting[dropped.event_id]
+                q.dropped += 1
+                self.size -= 1
+                self.unfinished -= 1
+            while not backlog and self.size - self.backlogged >= self.maxsize:
+                self.cond.wait()
+            now = time.monotonic()
+            job = _Job(event_id, item, q, now, done, now + delay if backlog else 0.0)
+            if backlog:
+                q.backlog.append(job)
+                self.backlogged += 1
+            elif event_id in self.seen:
+                self.seen.move_to_end(event_id)
+                q.refresh.append(job)
+                if self.coalesce:
+                    self.waiting[event_id] = job
+            else:
+                self.seen[event_id] = True
+                if len(self.seen) > self.SEEN_EVENTS:
+                    self.seen.popitem(last=False)
+                q.new.append(job)
+            self.size += 1
+            self.unfinished += 1
+            self.cond.notify()
+
+    def depth(self) -> int:
+        return self.size
+
+    def oldest_pending(self, key):
+        """The smallest key(item) over queued and running items, or None if idle."""
+        with self.cond:
+            items = list(self.running.values())
+            for q in self.cameras.values():
+                items.extend(job.item for jobs in (q.new, q.refresh, q.backlog) for job in jobs)
+        return min(map(key, items), default=None)
+
+    def join(self):
+        """Wait until everything submitted so far has been handled."""
+        with self.cond:
+            while self.unfinished:
+                self.cond.wait()
+
+    def status(self, reset: bool = False) -> dict:
+        with self.cond:
+            return {'workers': len(self.threads), 'queued': self.size, 'running': len(self.running),
+                    'cameras': {name: q.status(reset) for name, q in sorted(self.cameras.items())}}
+
+    def _next(self, now: float):
+        """Take the next job to run, or return the seconds until one may be ready (None: no work)."""
+        retry = None
+        for kind in ('new', 'refresh', 'backlog'):
+            best = best_index = None
+            for q in self.cameras.values():
+                jobs = getattr(q, kind)
+                if not jobs:
+                    continue
+                q.refill(now)
+                if q.tokens < 1:
+                    delay = q.token_in()
+                    retry = delay if retry is None else min(retry, delay)
+                    continue
+                index = None
+                for i, job in enumerate(jobs):
+                    if job.not_before > now:
+                        delay = job.not_before - now
+                        retry = delay if retry is None else min(retry, delay)
+                    elif job.event_id not in self.running:
+                        index = i
+                        break
+                if index is not None and (best is None or max(q.vtime, self.vclock) < max(best.vtime, self.vclock)):
+                    best, best_index = q, index
+            if best is not None:
+                jobs = getattr(best, kind)
+                job = jobs[best_index]
+                del jobs[best_index]
+                start = max(best.vtime, self.vclock)
+                best.vtime = start + 1 / best.weight
+                self.vclock = start
+                if best.max_rate:
+                    best.tokens -= 1
+                best.dispatched += 1
+                best.record_wait(now - max(job.enqueued, job.not_before))
+                if self.waiting.get(job.event_id) is job:
+                    del self.waiting[job.event_id]
+                self.size -= 1
+                if kind == 'backlog':
+                    self.backlogged -= 1
+                self.running[job.event_id] = job.item
+                self.cond.notify_all()  # room for a blocked submit()
+                return job
+        return retry
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    job = self._next(time.monotonic())
+                    if isinstance(job, _Job):
+                        break
+                    self.cond.wait(job)
+            try:
+                self.handler(job.item)
+            except Exception:
+                logger.exception("ingest worker failed to process message")
+            finally:
+                with self.cond:
+                    self.running.pop(job.event_id, None)
+                    self.unfinished -= 1
+                    self.cond.notify_all()
+                if job.done is not None:
+                    job.done()
+
+    def _report(self, path: str, interval: float):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        while True:
+            time.sleep(interval)
+            status = dict(self.status(reset=True), written_at=time.time())
+            for name, source in self.status_sources.items():
+                status[name] = source()
+            try:
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(status, f)
+                os.replace(path + '.tmp', path)
+            except OSError as e:
+                logger.warning("Could not write ingest status %s: %s", path, e)
+
+
+def store_detection(cursor, ts, index, score, common_name, category_name, full_id, camera, top5) -> bool:
+    """
+    Insert the detection for `full_id`, or replace it if `score` beats the
+    stored one, together with its top-5 choices. A single upsert makes this
+    safe under duplicate or out-of-order deliveries and concurrent nodes.
+    Returns True if the row was written.
+    """
+    cursor.execute("""
+        INSERT INTO detections (detection_time, detection_index, score,
+        display_name, category_name, frigate_event, camera_name) VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(frigate_event) DO UPDATE
+            SET detection_time = excluded.detection_time,
+                detection_index = excluded.detection_index,
+                score = excluded.score,
+                display_name = excluded.display_name,
+                category_name = excluded.category_name
+          WHERE excluded.score > detections.score
+    """, (ts, index, score, common_name, category_name, full_id, camera))
+    if cursor.rowcount != 1:
+        return False
+
+    cursor.executemany("""
+        INSERT INTO detection_choices(event_id, rank, display_name, score)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(event_id, rank) DO UPDATE
+            SET display_name=excluded.display_name,
+                score=excluded.score
+    """, [(full_id, rank, name, s) for rank, (name, s) in enumerate(top5, start=1)])
+    return True
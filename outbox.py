@@ -0,0 +1,134 @@
+"""
+Durable outbox for Frigate sub_label write-backs.
+
+Producers (on_message, set_label) only upsert a row into `sublabel_outbox`
+inside their own transaction; a background sender in the ingest process
+posts pending rows to Frigate with bounded concurrency and retries with
+exponential backoff. Rows are keyed by event, so a burst of updates for one
+event collapses into a single write of its latest label.
+"""
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from breaker import CircuitBreaker, CircuitOpen, guarded_post
+
+# A label the user picked is never replaced by a later model label
+SOURCE_MODEL = 'model'
+SOURCE_USER = 'user'
+# _post's status for a post the breaker didn't let through; not an attempt
+NOT_SENT = -1
+
+
+def enqueue_sub_label(conn, event_id: str, sub_label: str, source: str = SOURCE_MODEL):
+    """
+    Queue `sub_label` for `event_id` on `conn` (the caller commits). Returns
+    True if the outbox row now holds this label.
+    """
+    cur = conn.execute("""
+        INSERT INTO sublabel_outbox (event_id, sub_label, source, pending, attempts, next_attempt, updated_at)
+        VALUES (?, ?, ?, 1, 0, 0, ?)
+        ON CONFLICT(event_id) DO UPDATE
+            SET sub_label = excluded.sub_label,
+                source = excluded.source,
+                pending = excluded.sub_label IS NOT sublabel_outbox.sent_label,
+                attempts = 0,
+                next_attempt = 0,
+                updated_at = excluded.updated_at
+          WHERE sublabel_outbox.source != 'user' OR excluded.source = 'user'
+    """, (event_id, sub_label, source, time.time()))
+    return cur.rowcount == 1
+
+
+class SubLabelSender(threading.Thread):
+    """Drains `sublabel_outbox` into Frigate's /api/events/<id>/sub_label."""
+
+    def __init__(self, session, base_url: str, db_path: str, concurrency: int = 2,
+                 max_attempts: int = 10, backoff_base: float = 2.0, backoff_max: float = 300.0,
+                 poll_interval: float = 1.0, batch_size: int = 50, breaker: CircuitBreaker = None):
+        super().__init__(name='sublabel-sender', daemon=True)
+        self.session = session
+        self.base_url = base_url
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.breaker = breaker or CircuitBreaker('api')
+        self.pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='sublabel')
+        self.wake = threading.Event()
+
+    def notify(self):
+        """Wake the sender early, e.g. right after queueing a label."""
+        self.wake.set()
+
+    def _post(self, event_id: str, sub_label: str):
+        try:
+            r = guarded_post(self.session, f"{self.base_url}/api/events/{event_id}/sub_label", self.breaker,
+                             json={"subLabel": sub_label[:20]}, timeout=10)
+            r.close()
+            return r.status_code
+        except CircuitOpen:
+            return NOT_SENT
+        except Exception as e:
+            print(f"sub_label post for {event_id} failed: {e}", flush=True)
+            return None
+
+    def _due(self, conn):
+        return conn.execute("""
+            SELECT event_id, sub_label, attempts
+              FROM sublabel_outbox
+             WHERE pending = 1 AND next_attempt <= ?
+             ORDER BY updated_at
+             LIMIT ?
+        """, (time.time(), self.batch_size)).fetchall()
+
+    def _record(self, conn, event_id, sub_label, attempts, status):
+        if status == NOT_SENT:
+            return  # still due; sent once the breaker lets calls through
+        if status is not None and 200 <= status < 300:
+            # If the label changed while we were sending, the row stays pending
+            conn.execute("""
+                UPDATE sublabel_outbox
+                   SET sent_label = ?, pending = (sub_label IS NOT ?), attempts = 0
+                 WHERE event_id = ?
+            """, (sub_label, sub_label, event_id))
+        elif status == 404 or attempts + 1 >= self.max_attempts:
+            print(f"Giving up on sub_label for {event_id} (status {status})", flush=True)
+            conn.execute("UPDATE sublabel_outbox SET pending = 0 WHERE event_id = ? AND sub_label = ?",
+                         (event_id, sub_label))
+        else:
+            delay = min(self.backoff_base * 2 ** attempts, self.backoff_max) * random.uniform(0.5, 1.0)
+            conn.execute("""
+                UPDATE sublabel_outbox SET attempts = attempts + 1, next_attempt = ?
+                 WHERE event_id = ? AND sub_label = ?
+            """, (time.time() + delay, event_id, sub_label))
+
+    def drain_once(self, conn) -> int:
+        """Send one batch of due rows; returns how many were attempted."""
+        if self.breaker.retry_in() > 0:
+            return 0  # Frigate is down; don't fetch a batch only to skip it
+        due = self._due(conn)
+        futures = [(row, self.pool.submit(self._post, row[0], row[1])) for row in due]
+        # wait for every post before writing: the write lock is held from the
+        # first UPDATE, and posts can take up to their timeout each
+        results = [(row, future.result()) for row, future in futures]
+        with conn:
+            for (event_id, sub_label, attempts), status in results:
+                self._record(conn, event_id, sub_label, attempts, status)
+        return len(due)
+
+    def run(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        while True:
+            try:
+                sent = self.drain_once(conn)
+            except sqlite3.Error as e:
+                print(f"sub_label outbox error: {e}", flush=True)
+                sent = 0
+            if sent < self.batch_size:
+                self.wake.wait(self.poll_interval)
+                self.wake.clear()
@@ -0,0 +1,362 @@
+"""
+Opt-in profiling for the ingest and web processes.
+
+Three things, all written under `profiling.dir` (default data/profile):
+
+  * Timings: every traced unit of work (an ingest event, a web request) is
+    timed for wall and CPU time, overall and per stage. Per-name totals go
+    to stats-<role>-<pid>.json.
+  * Slowest: the N slowest traces with their stage breakdown go to
+    slowest-<role>-<pid>.trace.json, in Chrome trace-event format (open it
+    in Perfetto, chrome://tracing or speedscope).
+  * Sampling: while switched on, a background thread samples every
+    thread's Python stack and writes <role>-<pid>-<time>.folded on stop,
+    in the folded format flamegraph.pl and speedscope read.
+  * Memory (`profiling.memory: true`, costly): every stage also records
+    its net and peak Python allocations (tracemalloc, which includes NumPy
+    arrays) and its change in RSS, which is where Pillow's image memory
+    shows up. Both are process-wide, so the per-stage numbers are only
+    exact with one ingest worker.
+
+Sampling is switched on for every process at once by writing
+data/profile/control.json, which POST /admin/profile does; each process
+polls that file. The ingest process also toggles it on SIGUSR2.
+
+Code marks its work with:
+
+    with profiling.trace('event', 'process_event', camera=camera):
+        ...
+        profiling.lap('fetch')   # time since the previous lap/trace start
+        profiling.annotate(snapshot_bytes=n)   # shown with the trace
+        ...
+"""
+import heapq
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+PROFILE_DIR = './data/profile'
+CONTROL_FILE = 'control.json'
+
+# longest sampling run a single request can start
+MAX_SAMPLING_SECONDS = 600
+
+# Python 3.8 can't reset the peak; stage peaks then cover the trace so far
+_reset_peak = getattr(tracemalloc, 'reset_peak', lambda: None)
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def rss_bytes() -> int:
+    """Resident set size of this process (Linux; 0 elsewhere)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+class Profiler:
+    def __init__(self, role: str, out_dir: str = PROFILE_DIR, slowest: int = 20,
+                 sample_interval: float = 0.01, flush_interval: float = 30.0, memory: bool = False):
+        self.role = role
+        self.out_dir = out_dir
+        self.keep_slowest = slowest
+        self.sample_interval = sample_interval
+        self.flush_interval = flush_interval
+        self.memory = memory
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = None
+        self.stats = {}        # "kind name" / "kind name:stage" -> [count, wall, cpu, max wall]
+        self.mem_stats = {}    # same keys -> [net alloc, max peak, rss change, max rss rise] (bytes)
+        self.slowest = []      # min-heap of (wall, seq, trace record)
+        self.seq = itertools.count()
+        self.dirty = False
+        self.samples = Counter()
+        self.sampling_until = None
+        self.sampling_started = None
+        self.control_mtime = None
+
+    def ensure_running(self):
+        """Start the background thread in this process (again, after a fork)."""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self._reset()
+            self.pid = os.getpid()
+            os.makedirs(self.out_dir, exist_ok=True)
+            if self.memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+            threading.Thread(target=self._run, name='profiler', daemon=True).start()
+
+    # -- timings --------------------------------------------------------
+
+    def begin(self, kind: str, name: str, **attrs):
+        self.ensure_running()
+        now = time.perf_counter()
+        record = {'kind': kind, 'name': name, 'start': time.time(), 'attrs': attrs, 'stages': [],
+                  '_t0': now, '_c0': time.thread_time(), '_lap': (now, time.thread_time())}
+        if self.memory:
+            _reset_peak()
+            record['_mem'] = record['_mem0'] = (tracemalloc.get_traced_memory()[0], rss_bytes())
+            record['_peak'] = 0
+        self.local.trace = record
+        return record
+
+    def lap(self, stage: str):
+        """Attribute the time since the last lap (or trace start) to `stage`."""
+        record = getattr(self.local, 'trace', None)
+        if record is None:
+            return
+        now, cpu = time.perf_counter(), time.thread_time()
+        last, last_cpu = record['_lap']
+        mem = None
+        if '_mem' in record:
+            # (net Python allocation, Python peak above the stage start, RSS change)
+            current, peak = tracemalloc.get_traced_memory()
+            rss = rss_bytes()
+            last_current, last_rss = record['_mem']
+            mem = (current - last_current, peak - last_current, rss - last_rss)
+            _reset_peak()
+            record['_mem'] = (current, rss)
+            record['_peak'] = max(record['_peak'], peak)
+        record['stages'].append((stage, last - record['_t0'], now - last, cpu - last_cpu, mem))
+        record['_lap'] = (now, cpu)
+
+    def annotate(self, **attrs):
+        """Add attributes to this thread's current trace."""
+        record = getattr(self.local, 'trace', None)
+        if record is not None:
+            record['attrs'].update(attrs)
+
+    def end(self, record):
+        if record is None:
+            return
+        self.local.trace = None
+        wall = time.perf_counter() - record.pop('_t0')
+        cpu = time.thread_time() - record.pop('_c0')
+        record.pop('_lap')
+        record['wall'], record['cpu'] = wall, cpu
+        mem = None
+        if '_mem' in record:
+            current, peak = tracemalloc.get_traced_memory()
+            start, start_rss = record['_mem0']
+            mem = (current - start, max(record['_peak'], peak) - start, rss_bytes() - start_rss)
+            for name in ('_mem', '_mem0', '_peak'):
+                del record[name]
+        key = f"{record['kind']} {record['name']}"
+        with self.lock:
+            self._add(key, wall, cpu, mem)
+            for stage, _, s_wall, s_cpu, s_mem in record['stages']:
+                self._add(f"{key}:{stage}", s_wall, s_cpu, s_mem)
+            entry = (wall, next(self.seq), record)
+            if len(self.slowest) < self.keep_slowest:
+                heapq.heappush(self.slowest, entry)
+            elif wall > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, entry)
+            self.dirty = True
+
+    def _add(self, key, wall, cpu, mem=None):
+        s = self.stats.get(key)
+        if s is None:
+            s = self.stats[key] = [0, 0.0, 0.0, 0.0]
+        s[0] += 1
+        s[1] += wall
+        s[2] += cpu
+        s[3] = max(s[3], wall)
+        if mem is not None:
+            m = self.mem_stats.get(key)
+            if m is None:
+                m = self.mem_stats[key] = [0, 0, 0, 0]
+            m[0] += mem[0]
+            m[1] = max(m[1], mem[1])
+            m[2] += mem[2]
+            m[3] = max(m[3], mem[2])
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            stats = {key: {'count': c, 'wall_ms': round(w * 1000, 3), 'cpu_ms': round(u * 1000, 3),
+                           'mean_ms': round(w * 1000 / c, 3), 'max_ms': round(m * 1000, 3)}
+                     for key, (c, w, u, m) in sorted(self.stats.items())}
+            for key, (alloc, peak, rss, rss_max) in self.mem_stats.items():
+                count = self.stats[key][0]
+                stats[key].update({'py_alloc_kb': round(alloc / 1024 / count, 1), 'py_peak_kb': round(peak / 1024, 1),
+                                   'rss_kb': round(rss / 1024 / count, 1), 'rss_max_kb': round(rss_max / 1024, 1)})
+            return stats
+
+    def write_stats(self):
+        stats = self.snapshot()
+        with self.lock:
+            slowest = sorted(self.slowest, reverse=True)
+            self.dirty = False
+        _write_json(os.path.join(self.out_dir, f"stats-{self.role}-{self.pid}.json"),
+                    {'role': self.role, 'pid': self.pid, 'written_at': time.time(), 'stats': stats})
+        _write_json(os.path.join(self.out_dir, f"slowest-{self.role}-{self.pid}.trace.json"),
+                    chrome_trace([record for _, _, record in slowest], self.pid))
+
+    # -- sampling -------------------------------------------------------
+
+    def start_sampling(self, duration: float = 30.0):
+        self.ensure_running()
+        duration = min(max(duration, 1.0), MAX_SAMPLING_SECONDS)
+        if self.sampling_until is None:
+            self.sampling_started = time.time()
+            self.samples = Counter()
+            print(f"Profiler ({self.role}): sampling for {duration:.0f}s", flush=True)
+        self.sampling_until = time.monotonic() + duration
+
+    def stop_sampling(self):
+        self.sampling_until = time.monotonic()
+
+    def toggle_sampling(self, duration: float = 30.0):
+        if self.sampling_until is None:
+            self.start_sampling(duration)
+        else:
+            self.stop_sampling()
+
+    def _sample(self, me):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.samples[';'.join(reversed(stack))] += 1
+
+    def _finish_sampling(self):
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.sampling_started))
+        path = os.path.join(self.out_dir, f"{self.role}-{self.pid}-{stamp}.folded")
+        with open(path + '.tmp', 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        os.replace(path + '.tmp', path)
+        print(f"Profiler ({self.role}): {sum(self.samples.values())} samples written to {path}", flush=True)
+        self.samples = Counter()
+        self.sampling_until = None
+        self.write_stats()
+
+    # -- background thread ----------------------------------------------
+
+    def _check_control(self):
+        path = os.path.join(self.out_dir, CONTROL_FILE)
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return
+        if mtime == self.control_mtime:
+            return
+        first_look = self.control_mtime is None
+        self.control_mtime = mtime
+        try:
+            with open(path) as f:
+                control = json.load(f)
+        except (OSError, ValueError):
+            return
+        remaining = (control.get('until') or 0) - time.time()
+        if control.get('sampling') and remaining > 0:
+            self.start_sampling(remaining)
+        elif not first_look and self.sampling_until is not None:
+            self.stop_sampling()
+
+    def _run(self):
+        me = threading.get_ident()
+        next_control = next_flush = 0.0
+        while True:
+            now = time.monotonic()
+            if now >= next_control:
+                self._check_control()
+                next_control = now + 1.0
+            if self.sampling_until is not None:
+                if now >= self.sampling_until:
+                    self._finish_sampling()
+                else:
+                    self._sample(me)
+            if now >= next_flush:
+                if self.dirty:
+                    self.write_stats()
+                next_flush = now + self.flush_interval
+            time.sleep(self.sample_interval if self.sampling_until is not None else 0.5)
+
+
+def chrome_trace(records, pid) -> dict:
+    """Trace records as Chrome trace events, one row (tid) per record."""
+    events = []
+    for tid, record in enumerate(records, start=1):
+        ts = record['start'] * 1e6
+        args = dict(record['attrs'], cpu_ms=round(record['cpu'] * 1000, 3))
+        events.append({'name': record['name'], 'cat': record['kind'], 'ph': 'X', 'pid': pid, 'tid': tid,
+                       'ts': ts, 'dur': record['wall'] * 1e6, 'args': args})
+        for stage, offset, wall, cpu, mem in record['stages']:
+            stage_args = {'cpu_ms': round(cpu * 1000, 3)}
+            if mem:
+                stage_args.update(py_alloc_kb=round(mem[0] / 1024, 1), py_peak_kb=round(mem[1] / 1024, 1),
+                                  rss_kb=round(mem[2] / 1024, 1))
+            events.append({'name': stage, 'cat': record['kind'], 'ph': 'X', 'pid': pid, 'tid': tid,
+                           'ts': ts + offset * 1e6, 'dur': wall * 1e6, 'args': stage_args})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_control(out_dir: str, sampling: bool, duration: float = 30.0) -> dict:
+    """Switch sampling on/off for every process watching `out_dir`."""
+    duration = min(max(duration, 1.0), MAX_SAMPLING_SECONDS)
+    control = {'sampling': sampling, 'requested_at': time.time(),
+               'until': time.time() + duration if sampling else None}
+    os.makedirs(out_dir, exist_ok=True)
+    _write_json(os.path.join(out_dir, CONTROL_FILE), control)
+    return control
+
+
+def _write_json(path, data):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+# -- module-level hooks; no-ops until init() ----------------------------
+
+profiler = None
+
+
+def init(role: str, cfg: dict = None) -> Profiler:
+    """Create this process's profiler from the `profiling:` config section."""
+    global profiler
+    cfg = cfg or {}
+    profiler = Profiler(role, out_dir=cfg.get('dir', PROFILE_DIR), slowest=cfg.get('slowest', 20),
+                        sample_interval=cfg.get('sample_interval_ms', 10) / 1000,
+                        flush_interval=cfg.get('flush_interval', 30), memory=cfg.get('memory', False))
+    return profiler
+
+
+@contextmanager
+def trace(kind: str, name: str, **attrs):
+    record = profiler.begin(kind, name, **attrs) if profiler else None
+    try:
+        yield record
+    finally:
+        if record is not None:
+            profiler.end(record)
+
+
+def lap(stage: str):
+    if profiler:
+        profiler.lap(stage)
+
+
+def annotate(**attrs):
+    if profiler:
+        profiler.annotate(**attrs)
@@ -1,5 +1,5 @@
 import sqlite3
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 from collections import defaultdict
 from typing import List, Dict, Tuple, Optional
 
@@ -14,12 +14,22 @@ def _connect():
     return conn
 
 
+def _day_bounds(first: date, last: Optional[date] = None) -> Tuple[str, str]:
+    """
+    [start, end) detection_time strings covering the days first..last.
+    Comparing the column against these, rather than DATE(detection_time),
+    lets SQLite use the detection_time indexes.
+    """
+    return first.isoformat(), ((last or first) + timedelta(days=1)).isoformat()
+
+
 def get_common_name(scientific_name: str) -> str:
     """
     Look up the human‐friendly common name for a given scientific name.
     Returns the scientific name itself if no mapping is found.
     """
     conn = sqlite3.connect(NAMEDBPATH)
+    conn.row_factory = sqlite3.Row
     cur = conn.execute(
         "SELECT common_name FROM birdnames WHERE scientific_name = ?",
         (scientific_name,)
@@ -89,12 +99,26 @@ def get_daily_summary(day: date) -> Dict[str, object]:
                COUNT(*) AS cnt,
                STRFTIME('%H', detection_time) AS hr
           FROM detections
-         WHERE DATE(detection_time) = ?
+         WHERE detection_time >= ? AND detection_time < ?
          GROUP BY scientific_name, hr
         """,
-        (day.strftime('%Y-%m-%d'),)
+        _day_bounds(day.date() if isinstance(day, datetime) else day)
     )
-    for row in cur:
+    rows = cur.fetchall()
+    if not rows:
+        # Detail may have been archived (see retention.py); fall back to rollups
+        rows = conn.execute(
+            """
+            SELECT display_name AS scientific_name,
+                   SUM(count) AS cnt,
+                   hour AS hr
+              FROM detection_rollups
+             WHERE day = ?
+             GROUP BY scientific_name, hr
+            """,
+            (day.strftime('%Y-%m-%d'),)
+        ).fetchall()
+    for row in rows:
         sci = row['scientific_name']
         hr = int(row['hr'])
         cnt = row['cnt']
@@ -113,15 +137,15 @@ def get_records_for_date_hour(day: date, hour: int) -> List[Dict]:
     ordered by detection_time ascending.
     """
     conn = _connect()
+    start = datetime.combine(day, datetime.min.time()) + timedelta(hours=hour)
     cur = conn.execute(
         """
         SELECT *
           FROM detections
-         WHERE DATE(detection_time) = ?
-           AND STRFTIME('%H', detection_time) = ?
+         WHERE detection_time >= ? AND detection_time < ?
         ORDER BY detection_time ASC
         """,
-        (day.isoformat(), f"{hour:02d}")
+        (start.strftime('%Y-%m-%d %H:%M:%S'), (start + timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S'))
     )
     recs = [dict(r) for r in cur.fetchall()]
     conn.close()
@@ -136,28 +160,16 @@ def get_records_for_scientific_name_and_date(scientific_name: str,
     Return all detections of a given species for a date or date range.
     """
     conn = _connect()
-    if end_date:
-        cur = conn.execute(
-            """
-            SELECT *
-              FROM detections
-             WHERE display_name = ?
-               AND DATE(detection_time) BETWEEN ? AND ?
-            ORDER BY detection_time ASC
-            """,
-            (get_common_name(scientific_name), day.isoformat(), end_date.isoformat())
-        )
-    else:
-        cur = conn.execute(
-            """
-            SELECT *
-              FROM detections
-             WHERE display_name = ?
-               AND DATE(detection_time) = ?
-            ORDER BY detection_time ASC
-            """,
-            (get_common_name(scientific_name), day.isoformat())
-        )
+    cur = conn.execute(
+        """
+        SELECT *
+          FROM detections
+         WHERE display_name = ?
+           AND detection_time >= ? AND detection_time < ?
+        ORDER BY detection_time ASC
+        """,
+        (get_common_name(scientific_name),) + _day_bounds(day, end_date)
+    )
     recs = [dict(r) for r in cur.fetchall()]
     conn.close()
     return recs
@@ -168,13 +180,33 @@ def get_earliest_detection_date() -> date:
     Return the date of the very first detection in the db.
     """
     conn = _connect()
+    # DATE(MIN(...)) rather than MIN(DATE(...)) so the time index answers it
     row = conn.execute(
-        "SELECT MIN(DATE(detection_time)) AS d FROM detections"
+        "SELECT DATE(MIN(detection_time)) AS d FROM detections"
     ).fetchone()
     conn.close()
     return datetime.fromisoformat(row['d']).date() if row and row['d'] else date.today()
 
 
+def get_generation_signature(first: date, last: date) -> Tuple[int, int, Optional[str]]:
+    """
+    Return (days, generation total, last change UTC) for the days in
+    [first, last]. Any write to a detection on one of those days changes the
+    tuple, which makes it a cheap cache/ETag key for pages about that range.
+    """
+    conn = _connect()
+    row = conn.execute(
+        """
+        SELECT COUNT(*) AS days, IFNULL(SUM(generation), 0) AS total, MAX(updated_at) AS updated
+          FROM day_generations
+         WHERE day BETWEEN ? AND ?
+        """,
+        (first.isoformat(), last.isoformat())
+    ).fetchone()
+    conn.close()
+    return row['days'], row['total'], row['updated']
+
+
 # ——— New review-flag functions ——————————————————————————————————
 
 def get_reviewed_detections(limit: int = 50) -> List[Dict]:
@@ -216,3 +248,99 @@ def get_unreviewed_detections(limit: int = 50) -> List[Dict]:
     conn.close()
     return recs
 
+
+
+def get_detections_for_events(event_ids: List[str]) -> Dict[str, Dict]:
+    """
+    Fetch detections for a list of frigate_event ids, keyed by event id.
+    Events without a detection row are simply absent from the result.
+    """
+    if not event_ids:
+        return {}
+    conn = _connect()
+    cur = conn.execute(
+        "SELECT * FROM detections WHERE frigate_event IN ({})".format(','.join('?' * len(event_ids))),
+        tuple(event_ids)
+    )
+    recs = {r['frigate_event']: dict(r) for r in cur.fetchall()}
+    conn.close()
+    return recs
+
+
+def get_species_week_trend(first: date, last: date) -> Dict[str, object]:
+    """
+    Weekly detection counts per species over [first, last], from species_days.
+    Returns {'weeks': [Monday ISO dates], 'species': [display names],
+    'common_names': [...], 'counts': [[count per week] per species]}.
+    """
+    conn = _connect()
+    cur = conn.execute(
+        """
+        SELECT DATE(day, '-6 days', 'weekday 1') AS week, display_name, SUM(count) AS cnt
+          FROM species_days
+         WHERE day BETWEEN ? AND ?
+         GROUP BY week, display_name
+        """,
+        (first.isoformat(), last.isoformat())
+    )
+    rows = cur.fetchall()
+    conn.close()
+
+    start = first - timedelta(days=first.weekday())
+    weeks = [(start + timedelta(weeks=w)).isoformat() for w in range((last - start).days // 7 + 1)]
+    week_index = {w: i for i, w in enumerate(weeks)}
+    counts = defaultdict(lambda: [0] * len(weeks))
+    for row in rows:
+        counts[row['display_name']][week_index[row['week']]] = row['cnt']
+    species = sorted(counts, key=lambda s: -sum(counts[s]))
+    return {'weeks': weeks, 'species': species,
+            'common_names': [get_common_name(s) for s in species],
+            'counts': [counts[s] for s in species]}
+
+
+def get_activity_heatmap(first: date, last: date, species: Optional[str] = None) -> Dict[str, object]:
+    """
+    Detections by hour of day × day of year over [first, last] (years are
+    folded together), from the aggregate tables. Returns {'counts': 24 lists of 366
+    counts, index 0 = January 1st, 'max': largest cell}.
+    """
+    conn = _connect()
+    # activity_hours already sums over species; one species needs the rollups
+    sql = """
+        SELECT CAST(STRFTIME('%j', day) AS INTEGER) - 1 AS doy, hour, SUM(count) AS cnt
+          FROM {table}
+         WHERE day BETWEEN ? AND ?
+    """
+    params = [first.isoformat(), last.isoformat()]
+    if species:
+        sql = sql.format(table='detection_rollups') + " AND display_name = ?"
+        params.append(species)
+    else:
+        sql = sql.format(table='activity_hours')
+    cur = conn.execute(sql + " GROUP BY doy, hour", params)
+    counts = [[0] * 366 for _ in range(24)]
+    for row in cur:
+        counts[row['hour']][row['doy']] = row['cnt']
+    conn.close()
+    return {'counts': counts, 'max': max(max(hours) for hours in counts)}
+
+
+def get_first_last_seen() -> List[Dict]:
+    """
+    First and last day each species was seen, with its total count, from
+    species_days (which also covers archived days). Most recently seen first.
+    """
+    conn = _connect()
+    cur = conn.execute(
+        """
+        SELECT display_name, MIN(day) AS first_seen, MAX(day) AS last_seen, SUM(count) AS total
+          FROM species_days
+         GROUP BY display_name
+         ORDER BY last_seen DESC, total DESC
+        """
+    )
+    rows = [dict(r) for r in cur.fetchall()]
+    conn.close()
+    for r in rows:
+        r['common_name'] = get_common_name(r['display_name'])
+    return rows
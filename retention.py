@@ -0,0 +1,245 @@
+"""
+Retention and compaction for the detections database.
+
+Detail rows (detections + detection_choices) older than `retention.keep_days`
+are appended to gzipped NDJSON files, one per month
+(data/archive/detections-YYYY-MM.ndjson.gz, same columns as export.py), and
+then deleted in small batches. Their counts stay in `detection_rollups`
+(archiving deletes skip the rollup trigger), so summaries and trends for
+old days keep working after the detail is gone.
+
+Freed pages are handed back to the filesystem with PRAGMA incremental_vacuum
+in small steps. Every step is its own short transaction, so ingest writers
+only ever wait for one batch, never for a full VACUUM. New databases are
+created with auto_vacuum=INCREMENTAL; an existing one has to be converted
+once, while the app is stopped:
+
+    python retention.py vacuum --convert
+    python retention.py run          # one maintenance pass now
+"""
+import argparse
+import gzip
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, timedelta
+
+import yaml
+
+from export import COLUMNS, iter_batches
+
+DBPATH = './data/speciesid.db'
+ARCHIVE_DIR = './data/archive'
+
+# PRAGMA auto_vacuum values
+AUTO_VACUUM_NONE = 0
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def get_meta(conn, key, default=None):
+    row = conn.execute("SELECT value FROM maintenance_meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_meta(conn, key, value):
+    conn.execute("""
+        INSERT INTO maintenance_meta (key, value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+    """, (key, value))
+
+
+def rebuild_rollups(conn):
+    """
+    Recount detection_rollups for every day that still has detail rows, and
+    the species_days/activity_hours aggregates from it (the caller commits).
+    Days whose detail was archived keep their counts. Used once to seed the
+    tables; the triggers in schema.py keep them current after that.
+    """
+    conn.execute("""
+        DELETE FROM detection_rollups
+         WHERE day IN (SELECT DISTINCT DATE(detection_time) FROM detections)
+    """)
+    conn.execute("""
+        INSERT INTO detection_rollups (day, hour, display_name, camera_name, count)
+        SELECT DATE(detection_time), CAST(STRFTIME('%H', detection_time) AS INTEGER),
+               display_name, camera_name, COUNT(*)
+          FROM detections
+         GROUP BY 1, 2, 3, 4
+    """)
+    conn.execute("DELETE FROM species_days")
+    conn.execute("""
+        INSERT INTO species_days (day, display_name, count)
+        SELECT day, display_name, SUM(count) FROM detection_rollups GROUP BY 1, 2
+    """)
+    conn.execute("DELETE FROM activity_hours")
+    conn.execute("""
+        INSERT INTO activity_hours (day, hour, count)
+        SELECT day, hour, SUM(count) FROM detection_rollups GROUP BY 1, 2
+    """)
+
+
+def _append_archive(archive_dir: str, rows):
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(row[1][:7], []).append(row)
+    os.makedirs(archive_dir, exist_ok=True)
+    for month, month_rows in by_month.items():
+        path = os.path.join(archive_dir, f"detections-{month}.ndjson.gz")
+        # Appending makes a multi-member gzip file, which every gzip reader handles
+        with open(path, 'ab') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                f.write(''.join(json.dumps(dict(zip(COLUMNS, r))) + '\n' for r in month_rows).encode())
+            raw.flush()
+            os.fsync(raw.fileno())
+
+
+def archive_before(conn, cutoff: date, archive_dir: str = ARCHIVE_DIR, batch_size: int = 500,
+                   pause: float = 0.05, stop=None) -> int:
+    """
+    Move detail rows older than `cutoff` to the archive, `batch_size`
+    detections per transaction. Rows are written (and fsynced) to the archive
+    before they're deleted; a crash in between can leave a batch in the
+    archive twice, never lose it. Returns detections archived.
+    """
+    archived = 0
+    last_day = cutoff - timedelta(days=1)
+    while not (stop and stop.is_set()):
+        batches = iter_batches(conn, batch_rows=batch_size, end=last_day)
+        batch = next(batches, None)
+        batches.close()
+        if not batch:
+            break
+        _append_archive(archive_dir, batch)
+        events = [(row[7],) for row in batch]
+        with conn:
+            # Tells the rollup delete trigger these rows are archived, not
+            # removed; nobody outside this transaction ever sees the flag
+            set_meta(conn, 'archiving', '1')
+            conn.executemany("DELETE FROM detection_choices WHERE event_id = ?", events)
+            conn.executemany("""
+                DELETE FROM vector_models
+                 WHERE slot = (SELECT id FROM detection_vectors WHERE frigate_event = ?)
+            """, events)
+            conn.executemany("DELETE FROM detection_vectors WHERE frigate_event = ?", events)
+            conn.executemany("DELETE FROM detections WHERE frigate_event = ?", events)
+            conn.execute("DELETE FROM maintenance_meta WHERE key = 'archiving'")
+        archived += len(batch)
+        # Checkpoint here so ingest commits don't inherit the WAL growth
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+        time.sleep(pause)  # let queued ingest writes in between batches
+    return archived
+
+
+def delete_orphan_choices(conn, batch_size: int = 1000) -> int:
+    """Remove detection_choices rows whose detection no longer exists."""
+    removed = 0
+    while True:
+        # Find them outside a write transaction; the scan covers the whole table
+        rowids = conn.execute("""
+            SELECT c.rowid FROM detection_choices c
+              LEFT JOIN detections d ON d.frigate_event = c.event_id
+             WHERE d.id IS NULL
+             LIMIT ?
+        """, (batch_size,)).fetchall()
+        with conn:
+            conn.executemany("DELETE FROM detection_choices WHERE rowid = ?", rowids)
+        removed += len(rowids)
+        if len(rowids) < batch_size:
+            return removed
+
+
+def incremental_vacuum(conn, pages: int = 256, pause: float = 0.05, stop=None) -> int:
+    """Release free pages `pages` at a time. Returns pages released."""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+        return 0
+    released = 0
+    while not (stop and stop.is_set()):
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if not free:
+            break
+        # executescript steps the pragma to completion; execute() stops after one page
+        conn.executescript(f"PRAGMA incremental_vacuum({min(pages, free)});")
+        released += free - conn.execute("PRAGMA freelist_count").fetchone()[0]
+        time.sleep(pause)
+    return released
+
+
+def run_once(conn, keep_days: int = 0, archive_dir: str = ARCHIVE_DIR, batch_size: int = 500,
+             vacuum_pages: int = 256, stop=None) -> dict:
+    """One maintenance pass; keep_days 0 keeps all detail."""
+    summary = {'archived': 0}
+    if keep_days > 0:
+        cutoff = date.today() - timedelta(days=keep_days)
+        summary['archived'] = archive_before(conn, cutoff, archive_dir, batch_size, stop=stop)
+    summary['orphan_choices'] = delete_orphan_choices(conn)
+    summary['vacuumed_pages'] = incremental_vacuum(conn, vacuum_pages, stop=stop)
+    return summary
+
+
+class RetentionWorker(threading.Thread):
+    """Runs run_once() every `interval` seconds in the ingest process."""
+
+    def __init__(self, db_path: str, keep_days: int = 0, archive_dir: str = ARCHIVE_DIR,
+                 interval: float = 3600, batch_size: int = 500, vacuum_pages: int = 256):
+        super().__init__(name='retention', daemon=True)
+        self.db_path = db_path
+        self.keep_days = keep_days
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.stop = threading.Event()
+
+    def run(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            print("Database doesn't use incremental auto_vacuum; free space won't be returned "
+                  "to the filesystem until 'python retention.py vacuum --convert' is run", flush=True)
+        while not self.stop.is_set():
+            try:
+                started = time.perf_counter()
+                summary = run_once(conn, self.keep_days, self.archive_dir, self.batch_size,
+                                   self.vacuum_pages, stop=self.stop)
+                if any(summary.values()):
+                    print(f"Retention pass: {summary} in {time.perf_counter() - started:.1f}s", flush=True)
+            except sqlite3.Error as e:
+                print(f"Retention pass failed: {e}", flush=True)
+            self.stop.wait(self.interval)
+
+
+def convert_to_incremental(conn):
+    """Switch an existing database to auto_vacuum=INCREMENTAL (full VACUUM; stop the app first)."""
+    conn.execute(f"PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}")
+    conn.execute("VACUUM")
+
+
+def main():
+    cfg = yaml.safe_load(open('config/config.yml')).get('retention') or {}
+    parser = argparse.ArgumentParser(description="Archive old detections and compact the database")
+    sub = parser.add_subparsers(dest='command', required=True)
+    run_p = sub.add_parser('run', help="one retention/archive/vacuum pass")
+    run_p.add_argument('--keep-days', type=int, default=cfg.get('keep_days', 0))
+    run_p.add_argument('--archive-dir', default=cfg.get('archive_dir', ARCHIVE_DIR))
+    vac_p = sub.add_parser('vacuum', help="release free pages")
+    vac_p.add_argument('--convert', action='store_true',
+                       help="switch the database to incremental auto_vacuum first (full VACUUM)")
+    parser.add_argument('--db', default=DBPATH)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db, timeout=30)
+    started = time.perf_counter()
+    if args.command == 'run':
+        summary = run_once(conn, args.keep_days, args.archive_dir,
+                           cfg.get('batch_size', 500), cfg.get('vacuum_pages', 256))
+    else:
+        if args.convert:
+            convert_to_incremental(conn)
+        summary = {'vacuumed_pages': incremental_vacuum(conn, cfg.get('vacuum_pages', 256), pause=0)}
+    conn.close()
+    print(f"{summary} in {time.perf_counter() - started:.2f}s", flush=True)
+
+
+if __name__ == '__main__':
+    main()
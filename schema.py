@@ -0,0 +1,227 @@
+"""
+The speciesid database schema.
+
+setupdb() creates whatever is missing in the database at `db_path` and is
+safe to run on every start; it has no other side effects, so tools and
+benchmarks can build a database without importing the ingest service.
+"""
+import sqlite3
+
+from retention import rebuild_rollups
+
+
+def setupdb(db_path: str):
+    """Create the tables, indexes and triggers that are missing, and seed new aggregates."""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    # WAL lets the web UI read, and several ingest workers/nodes write,
+    # without blocking each other on the whole file
+    # Only takes effect on a new, empty database (and before WAL is set up);
+    # see retention.py for converting an existing one
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("""    
+        CREATE TABLE IF NOT EXISTS detections (    
+            id INTEGER PRIMARY KEY AUTOINCREMENT,  
+            detection_time TIMESTAMP NOT NULL,  
+            detection_index INTEGER NOT NULL,  
+            score REAL NOT NULL,  
+            display_name TEXT NOT NULL,  
+            category_name TEXT NOT NULL,  
+            frigate_event TEXT NOT NULL UNIQUE,
+            camera_name TEXT NOT NULL,
+            user_label TEXT NOT NULL DEFAULT '',
+            reviewed INTEGER NOT NULL DEFAULT 0
+        )    
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS detection_choices (
+            event_id TEXT,
+            rank INTEGER,
+            display_name TEXT,
+            score REAL,
+            PRIMARY KEY(event_id, rank)
+        )
+    """)
+
+    # Slot per classified event in the vector store (see vectorstore.py)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS detection_vectors (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            frigate_event TEXT NOT NULL UNIQUE,
+            camera_name TEXT NOT NULL,
+            detection_time TIMESTAMP NOT NULL
+        )
+    """)
+    # Which slots each model's vector file has a row for
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS vector_models (
+            slot INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            PRIMARY KEY (slot, model)
+        ) WITHOUT ROWID
+    """)
+
+    # detection_time drives every page; MIN() and date-range lookups use it
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_detections_time
+            ON detections (detection_time)
+    """)
+
+    # Species pages filter on display_name over a time range
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_detections_species_time
+            ON detections (display_name, detection_time)
+    """)
+
+    # Per-day change counters for the web UI's page cache and ETags. The
+    # triggers catch every writer (ingest, review/label edits, maintenance).
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS day_generations (
+            day TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    for event, rows in (('INSERT', ('NEW',)), ('UPDATE', ('OLD', 'NEW')), ('DELETE', ('OLD',))):
+        bumps = ''.join(f"""
+            INSERT INTO day_generations (day, generation, updated_at)
+            VALUES (DATE({row}.detection_time), 1, DATETIME('now'))
+            ON CONFLICT(day) DO UPDATE
+                SET generation = generation + 1, updated_at = excluded.updated_at;""" for row in rows)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS detections_generation_{event.lower()}
+            AFTER {event} ON detections
+            BEGIN{bumps}
+            END
+        """)
+    if cursor.execute("SELECT 1 FROM day_generations LIMIT 1").fetchone() is None:
+        cursor.execute("""
+            INSERT INTO day_generations (day, generation, updated_at)
+            SELECT DATE(detection_time), 1, DATETIME('now') FROM detections GROUP BY 1
+        """)
+
+    # Per-hour counts that outlive archived detail rows (see retention.py)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS detection_rollups (
+            day TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            display_name TEXT NOT NULL,
+            camera_name TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (day, hour, display_name, camera_name)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS maintenance_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_rollups_species
+            ON detection_rollups (display_name, day)
+    """)
+    # Keep the rollups current on every write, like day_generations above.
+    # Deletes made while archiving (retention.py) leave the counts alone.
+    rollup_key = """day = DATE({row}.detection_time)
+               AND hour = CAST(STRFTIME('%H', {row}.detection_time) AS INTEGER)
+               AND display_name = {row}.display_name AND camera_name = {row}.camera_name"""
+    rollup_add = """
+            INSERT INTO detection_rollups (day, hour, display_name, camera_name, count)
+            VALUES (DATE(NEW.detection_time), CAST(STRFTIME('%H', NEW.detection_time) AS INTEGER),
+                    NEW.display_name, NEW.camera_name, 1)
+            ON CONFLICT(day, hour, display_name, camera_name) DO UPDATE SET count = count + 1;"""
+    rollup_remove = f"""
+            UPDATE detection_rollups SET count = count - 1 WHERE {rollup_key.format(row='OLD')};
+            DELETE FROM detection_rollups WHERE {rollup_key.format(row='OLD')} AND count <= 0;"""
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS detections_rollup_insert
+        AFTER INSERT ON detections
+        BEGIN{rollup_add}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS detections_rollup_update
+        AFTER UPDATE OF detection_time, display_name, camera_name ON detections
+        WHEN OLD.detection_time IS NOT NEW.detection_time OR OLD.display_name IS NOT NEW.display_name
+          OR OLD.camera_name IS NOT NEW.camera_name
+        BEGIN{rollup_remove}{rollup_add}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS detections_rollup_delete
+        AFTER DELETE ON detections
+        WHEN NOT EXISTS (SELECT 1 FROM maintenance_meta WHERE key = 'archiving')
+        BEGIN{rollup_remove}
+        END
+    """)
+
+    # Coarser aggregates for the multi-year trend views, fed by count deltas
+    # on detection_rollups so they inherit its archive handling
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS species_days (
+            day TEXT NOT NULL,
+            display_name TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (day, display_name)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_species_days_species
+            ON species_days (display_name, day)
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS activity_hours (
+            day TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (day, hour)
+        ) WITHOUT ROWID
+    """)
+    for event, row, delta in (('INSERT', 'NEW', 'NEW.count'),
+                              ('UPDATE OF count', 'NEW', 'NEW.count - OLD.count'),
+                              ('DELETE', 'OLD', '-OLD.count')):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS rollups_cascade_{event.split()[0].lower()}
+            AFTER {event} ON detection_rollups
+            BEGIN
+                INSERT INTO species_days (day, display_name, count)
+                VALUES ({row}.day, {row}.display_name, {delta})
+                ON CONFLICT(day, display_name) DO UPDATE SET count = count + excluded.count;
+                DELETE FROM species_days
+                 WHERE day = {row}.day AND display_name = {row}.display_name AND count <= 0;
+                INSERT INTO activity_hours (day, hour, count)
+                VALUES ({row}.day, {row}.hour, {delta})
+                ON CONFLICT(day, hour) DO UPDATE SET count = count + excluded.count;
+                DELETE FROM activity_hours WHERE day = {row}.day AND hour = {row}.hour AND count <= 0;
+            END
+        """)
+
+    if cursor.execute("SELECT 1 FROM maintenance_meta WHERE key = 'rollups_seeded'").fetchone() is None:
+        print("Building detection rollups", flush=True)
+        rebuild_rollups(conn)
+        cursor.execute("INSERT INTO maintenance_meta (key, value) VALUES ('rollups_seeded', DATETIME('now'))")
+
+    # Pending Frigate sub_label writes (see outbox.py)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sublabel_outbox (
+            event_id TEXT PRIMARY KEY,
+            sub_label TEXT NOT NULL,
+            source TEXT NOT NULL,
+            pending INTEGER NOT NULL DEFAULT 1,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL,
+            sent_label TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_sublabel_outbox_due
+            ON sublabel_outbox (pending, next_attempt)
+    """)
+
+    conn.commit()
+
+    conn.close()
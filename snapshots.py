@@ -0,0 +1,373 @@
+"""
+Bounded-memory snapshot loading for ingest.
+
+A snapshot goes from the HTTP response to the model-sized crop without
+the whole chain of copies (response body, BytesIO, full-frame image, crop,
+thumbnail) being alive at once:
+
+  * The body is streamed into a buffer owned by the worker thread and
+    reused for every event. Bodies over `max_bytes` are refused before
+    anything is decoded.
+  * JPEG frames are decoded at 1/2, 1/4 or 1/8 scale (libjpeg DCT scaling,
+    Image.draft) when the bird box still comes out at least twice the model
+    input size; a 4K frame rarely needs a full-resolution decode.
+  * Crop and thumbnail are a single resize with a source box, so the crop
+    never exists as an image of its own, and the decoded frame is closed as
+    soon as the crop is made.
+  * Decodes reserve their size from a byte budget shared by the workers,
+    so concurrent workers can't all hold full-frame images at the same time.
+  * Where possible the frame never crosses the network at all: Frigate's
+    event snapshot endpoint crops a square around the bird box (crop=1)
+    and scales it (height=) on the server, and only enough pixels for the
+    model input come back. See crop_request() and locate_box(). A snapshot
+    Frigate didn't crop isn't used: an event that already ended is served
+    from disk as the full frame with the bounding box drawn in, so the
+    clean frame comes from the recordings instead.
+  * Allocations of a megabyte and up are served by mmap (glibc mallopt), so
+    a frame's memory goes back to the OS when the image is closed. By
+    default glibc raises that threshold after the first large free, and
+    decoded frames then land in per-thread heaps that fragment and never
+    shrink: RSS climbs for hours with several workers.
+"""
+import ctypes
+import ctypes.util
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from PIL import Image
+
+from breaker import CircuitBreaker, FrigateUnavailable, guarded_get
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+CHUNK = 64 * 1024
+# Pillow stores RGB images with 4 bytes per pixel
+BYTES_PER_PIXEL = 4
+# mallopt() parameter number, from glibc's malloc.h
+M_MMAP_THRESHOLD = -3
+# Frigate's crop=1 snapshot (TrackedObject.get_jpg_bytes) is the region
+# calculate_region(frame, *box, 300, multiplier=1.1) gives: a square 1.1x the
+# box's long side, at least 300px, centred on the box and kept in the frame
+FRIGATE_CROP_MIN = 300
+FRIGATE_CROP_MULTIPLIER = 1.1
+
+
+class SnapshotTooLarge(Exception):
+    pass
+
+
+class SnapshotBuffer:
+    """A reusable byte buffer that PIL can read as a file."""
+
+    def __init__(self, size: int = MB):
+        self.data = bytearray(size)
+        self.length = 0
+        self.pos = 0
+
+    def fill(self, response, max_bytes: int) -> int:
+        """Read the response body into the buffer; raise SnapshotTooLarge past max_bytes."""
+        declared = int(response.headers.get('Content-Length') or 0)
+        if declared > max_bytes:
+            raise SnapshotTooLarge(declared)
+        self._reserve(declared)
+        self.length = self.pos = 0
+        for chunk in response.iter_content(CHUNK):
+            end = self.length + len(chunk)
+            if end > max_bytes:
+                raise SnapshotTooLarge(end)
+            if end > len(self.data):
+                self._reserve(min(max(end, 2 * len(self.data)), max_bytes))
+            self.data[self.length:end] = chunk
+            self.length = end
+        return self.length
+
+    def _reserve(self, size):
+        if size > len(self.data):
+            self.data.extend(bytes(size - len(self.data)))
+
+    # -- file interface for Image.open ----------------------------------
+
+    def read(self, size: int = -1) -> bytes:
+        end = self.length if size is None or size < 0 else min(self.pos + size, self.length)
+        with memoryview(self.data) as view:
+            chunk = view[self.pos:end].tobytes()
+        self.pos = max(end, self.pos)
+        return chunk
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        base = (0, self.pos, self.length)[whence]
+        self.pos = max(base + offset, 0)
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+
+class MemoryBudget:
+    """
+    Bytes of decoded image the workers may hold between them. A decode
+    waits while the budget is used up, but one decode always proceeds, so
+    a frame bigger than the whole budget still gets classified.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.waits = 0
+        self.cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size: int):
+        with self.cond:
+            if self.used and self.used + size > self.limit:
+                self.waits += 1
+                while self.used and self.used + size > self.limit:
+                    self.cond.wait()
+            self.used += size
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.used -= size
+                self.cond.notify_all()
+
+
+def thumbnail_size(width: int, height: int, size) -> tuple:
+    """The size Image.thumbnail(size) would give a width x height image."""
+    x, y = size
+    if x >= width and y >= height:
+        return width, height
+    aspect = width / height
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
+
+
+def draft_scale(box, size) -> int:
+    """Largest JPEG DCT scale (1, 2, 4 or 8) keeping the box at least twice `size`."""
+    x1, y1, x2, y2 = box
+    for scale in (8, 4, 2):
+        if (x2 - x1) / scale >= 2 * size[0] or (y2 - y1) / scale >= 2 * size[1]:
+            return scale
+    return 1
+
+
+def frigate_crop_region(frame_size, box) -> tuple:
+    """The part of a frame_size frame Frigate returns for crop=1 around `box`."""
+    width, height = frame_size
+    x1, y1, x2, y2 = box
+    size = int((max(x2 - x1, y2 - y1) * FRIGATE_CROP_MULTIPLIER) // 4 * 4)
+    size = max(size, FRIGATE_CROP_MIN)
+    x = min(max(int((x2 - x1) / 2 + x1 - size / 2), 0), max(width - size, 0))
+    y = min(max(int((y2 - y1) / 2 + y1 - size / 2), 0), max(height - size, 0))
+    return x, y, min(x + size, width), min(y + size, height)
+
+
+def crop_request(frame_size, box, size=(224, 224)):
+    """
+    (region, height) for a crop=1 snapshot request: the region Frigate will
+    crop, and the `height=` that scales it so the box still comes out at
+    `size`, or None where Frigate would have to upscale.
+    """
+    region = frigate_crop_region(frame_size, box)
+    x1, y1, x2, y2 = box
+    target = thumbnail_size(x2 - x1, y2 - y1, size)
+    scale = min(target[0] / (x2 - x1), target[1] / (y2 - y1))
+    height = math.ceil((region[3] - region[1]) * scale)
+    return region, height if height < region[3] - region[1] else None
+
+
+def scaled_size(region, height) -> tuple:
+    """Size of `region` after Frigate's height= resize (width rounded down, as Frigate does)."""
+    width, region_height = region[2] - region[0], region[3] - region[1]
+    return (int(height * width / region_height), height) if height else (width, region_height)
+
+
+def locate_box(image_size, frame_size, box, region, height):
+    """
+    (box, cropped): `box` in the coordinates of a snapshot of `image_size`
+    that is either the crop=1 `region` or the whole frame, scaled to
+    `height` or not, and whether it was the region (the whole frame of an
+    ended event has the box drawn on it; callers don't classify that one).
+    None if the image is neither.
+    """
+    for origin in (region, (0, 0) + tuple(frame_size)):
+        for expected in (scaled_size(origin, height), scaled_size(origin, None)):
+            if abs(expected[0] - image_size[0]) > 1 or expected[1] != image_size[1]:
+                continue
+            sx = image_size[0] / (origin[2] - origin[0])
+            sy = image_size[1] / (origin[3] - origin[1])
+            return ((box[0] - origin[0]) * sx, (box[1] - origin[1]) * sy,
+                    (box[2] - origin[0]) * sx, (box[3] - origin[1]) * sy), origin is region
+    return None
+
+
+class FrameSizes:
+    """
+    Detect resolution per camera, read from Frigate's /api/config: the frame
+    event snapshots are taken from and their boxes refer to. Re-read every
+    `refresh` seconds, and at most every `retry` seconds while a camera is
+    missing from it (or Frigate can't be reached).
+    """
+
+    def __init__(self, session, base_url: str, refresh: float = 300.0, retry: float = 60.0,
+                 breaker: CircuitBreaker = None):
+        self.session = session
+        self.breaker = breaker or CircuitBreaker('api')
+        self.url = f"{base_url}/api/config"
+        self.refresh = refresh
+        self.retry = retry
+        self.sizes = {}
+        self.loaded = None
+        self.lock = threading.Lock()
+
+    def get(self, camera: str):
+        """(width, height) for `camera`, or None if it isn't known."""
+        now = time.monotonic()
+        if self._stale(camera, now):
+            with self.lock:
+                if self._stale(camera, now):  # not just reloaded by another worker
+                    self._load(now)
+        return self.sizes.get(camera)
+
+    def _stale(self, camera, now) -> bool:
+        if self.loaded is None:
+            return True
+        age = now - self.loaded
+        return age > self.refresh or (camera not in self.sizes and age > self.retry)
+
+    def _load(self, now):
+        self.loaded = now
+        try:
+            r = guarded_get(self.session, self.url, self.breaker, timeout=10)
+            r.raise_for_status()
+            cameras = r.json().get('cameras') or {}
+        except (OSError, ValueError, AttributeError) as e:
+            logger.warning("Could not read camera resolutions from %s: %s", self.url, e)
+            return
+        self.sizes = {name: (cam['detect']['width'], cam['detect']['height'])
+                      for name, cam in cameras.items()
+                      if (cam.get('detect') or {}).get('width') and cam['detect'].get('height')}
+
+
+class SnapshotLoader:
+    """Fetches snapshots and turns them into model-sized crops (see module docstring)."""
+
+    def __init__(self, session, max_bytes: int = 10 * MB, decode_budget: int = 128 * MB,
+                 draft: bool = True, timeout=(3, 15), breaker: CircuitBreaker = None):
+        self.session = session
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker('snapshot')
+        self.max_bytes = max_bytes
+        self.budget = MemoryBudget(decode_budget)
+        self.draft = draft
+        self.local = threading.local()
+        self.refused = 0
+        self.lock = threading.Lock()
+        self.transfers = {}    # camera -> {kind: [snapshots, bytes]}
+
+    def fetch(self, url: str):
+        """
+        The snapshot body in this thread's buffer, or None if Frigate has no
+        usable one. Raises FrigateUnavailable when Frigate can't be reached
+        or answers 5xx, and without a request while the breaker is open.
+        """
+        buf = getattr(self.local, 'buffer', None)
+        if buf is None:
+            buf = self.local.buffer = SnapshotBuffer()
+        with guarded_get(self.session, url, self.breaker, stream=True, timeout=self.timeout) as r:
+            logger.debug("Fetched snapshot URL=%s -> status=%d", url, r.status_code)
+            if not r.ok:
+                logger.warning("Snapshot fetch failed: %s %s", r.status_code, r.text[:200])
+                return None
+            try:
+                buf.fill(r, self.max_bytes)
+            except OSError as e:
+                # the connection dropped or timed out mid-body
+                self.breaker.failure()
+                raise FrigateUnavailable(f"{self.breaker.name}: {e}") from e
+            except SnapshotTooLarge as e:
+                self.refused += 1
+                logger.warning("Snapshot %s refused: %s bytes is over the %d byte limit", url, e, self.max_bytes)
+                return None
+        return buf
+
+    def image_size(self, buf: SnapshotBuffer) -> tuple:
+        """(width, height) of the snapshot in `buf`, from its header alone."""
+        buf.seek(0)
+        with Image.open(buf) as img:
+            return img.size
+
+    def crop(self, buf: SnapshotBuffer, box, size=(224, 224)) -> Image.Image:
+        """
+        Crop `box` (pixels of this snapshot) out of the snapshot in `buf` and
+        fit it inside `size`, as img.crop(box).thumbnail(size) would.
+        """
+        buf.seek(0)
+        img = Image.open(buf)
+        try:
+            width, height = img.size
+            x1, y1 = max(box[0], 0), max(box[1], 0)
+            x2, y2 = min(box[2], width), min(box[3], height)
+            target = thumbnail_size(max(round(x2 - x1), 1), max(round(y2 - y1), 1), size)
+            scale = draft_scale((x1, y1, x2, y2), size) if self.draft and img.format == 'JPEG' else 1
+            if scale > 1:
+                img.draft(img.mode, (math.ceil(width / scale), math.ceil(height / scale)))
+            sx, sy = width / img.size[0], height / img.size[1]
+            with self.budget.reserve(img.size[0] * img.size[1] * BYTES_PER_PIXEL):
+                img.load()
+                if target == (x2 - x1, y2 - y1) and scale == 1:
+                    roi = img.crop((x1, y1, x2, y2))
+                else:
+                    roi = img.resize(target, Image.Resampling.BICUBIC, box=(x1 / sx, y1 / sy, x2 / sx, y2 / sy),
+                                     reducing_gap=2.0)
+                img.close()
+        finally:
+            img.close()
+        if roi.mode != 'RGB':
+            roi = roi.convert('RGB')
+        return roi
+
+    def record(self, camera: str, kind: str, nbytes: int):
+        """Count a snapshot download of `nbytes` for `camera` under `kind` (e.g. crop, frame)."""
+        with self.lock:
+            t = self.transfers.setdefault(camera, {}).setdefault(kind, [0, 0])
+            t[0] += 1
+            t[1] += nbytes
+
+    def status(self) -> dict:
+        with self.lock:
+            transfers = {camera: {kind: {'snapshots': n, 'bytes': b, 'mean_kb': round(b / n / 1024, 1)}
+                                  for kind, (n, b) in sorted(kinds.items())}
+                         for camera, kinds in sorted(self.transfers.items())}
+        return {'refused': self.refused, 'budget_waits': self.budget.waits, 'transfers': transfers,
+                'breaker': self.breaker.status()}
+
+
+def set_mmap_threshold(threshold: int) -> bool:
+    """
+    Fix glibc's mmap threshold at `threshold` bytes for this process (see
+    the module docstring). Returns False where there is no mallopt, e.g.
+    musl or macOS.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        return bool(libc.mallopt(M_MMAP_THRESHOLD, threshold))
+    except (OSError, AttributeError, TypeError):
+        return False
@@ -4,26 +4,47 @@ import yaml
 import json
 import sqlite3
 import numpy as np
-from PIL import Image, ImageOps
-from io import BytesIO
 from datetime import datetime
 import requests
 #import paho.mqtt.client as mqtt
 from paho.mqtt import client as mqtt_client
 from paho.mqtt.client import CallbackAPIVersion
-from tflite_support.task import core, processor, vision
 from queries import get_common_name
 import multiprocessing
 import time
 #import cv2
 import hashlib
 from webui import app
+import webui
 import logging
-import tflite_runtime.interpreter as tflite
+from classifier import ClassificationContext, ContextReloader, pick_best
+from outbox import SubLabelSender, enqueue_sub_label
+from retention import RetentionWorker
+import schema
+import profiling
+from snapshots import SnapshotLoader, FrameSizes, crop_request, locate_box, set_mmap_threshold, MB
+from ingest import EventDispatcher, check_scaling, partition_of, store_detection
+from catchup import CatchUp
+from breaker import CircuitBreaker, FrigateUnavailable
+import itertools
+import threading
+import socket
+import signal
 
 # Globals
 session = requests.Session()
 DBPATH = './data/speciesid.db'
+sub_label_sender = None
+context = None          # active ClassificationContext (see publish_context)
+snapshot_loader = None
+frame_sizes = None
+catchup = None
+# Events requeued while Frigate was unreachable (see defer_event)
+deferrals = {'waiting': 0, 'deferred': 0, 'given_up': 0, 'superseded': 0}
+# event id -> sequence number of its deferred update still due to run
+deferred_events = {}
+deferral_seq = itertools.count(1)
+deferral_lock = threading.Lock()
 
 # Load config + auth + TFLite model
 cfg_full = yaml.safe_load(open('config/config.yml'))
@@ -41,6 +62,8 @@ elif frig_cfg.get('username') and frig_cfg.get('password'):
         session.headers.update({'Authorization': f"Bearer {r.json()['access_token']}"})
     else:
         session.auth = (frig_cfg['username'], frig_cfg['password'])
+# Frigate's JSON API: the config, the event list and sub_label posts (see breaker.py)
+api_breaker = CircuitBreaker('api', frig_cfg.get('breaker_failures', 5), frig_cfg.get('breaker_reset', 30))
 MODEL_PATH = cfg_full['classification']['model']
 LABEL_PATH = cfg_full['classification']['labels']
 
@@ -61,16 +84,15 @@ label_path = cfg_full['classification']['labels']
 #print(f"Loaded TFLite model: {model_path}, top‑k = {cls_opts.max_results}", flush=True)
 
 
-# New filter import code
+# Whitelist of common names; reloaded along with the rest of the
+# classification settings (see ClassificationContext)
 BASE_DIR = os.path.dirname(__file__)                           # directory of speciesid.py :contentReference[oaicite:0]{index=0}
-whitelist_path = os.path.join(BASE_DIR, 'config', 'northeast_birds.txt')
-try:
-    with open(whitelist_path, 'r') as f:
-        allowed = {line.strip().lower() for line in f if line.strip() and not line.strip().startswith('#')}
-    print(f"Loaded {len(allowed)} allowed species: {sorted(allowed)}")
-except FileNotFoundError:
-    print(f"Whitelist file not found: {whitelist_path}")
-    allowed = set()
+DEFAULT_WHITELIST = os.path.join(BASE_DIR, 'config', 'northeast_birds.txt')
+CONFIG_PATH = './config/config.yml'
+RELOAD_TRIGGER = './data/reload'
+CLASSIFICATION_STATUS = './data/status/classification.json'
+# Per-camera queue depth and wait times, one file per ingest node
+INGEST_STATUS = './data/status/ingest-{node}.json'
 
 
 # Logging setup
@@ -110,103 +132,31 @@ def get_common_name(scientific_name: str) -> str:
         print(f"Warning: failed to lookup common name for {scientific_name}: {e}")
     return scientific_name
 
-def classify_top5_via_interpreter(pil_img: Image.Image):
-    # 1. Crop / resize / pad exactly as in speciesid.py
-    #img = pil_img.copy()
-    #img.thumbnail((224, 224))
-    #pad = ImageOps.expand(
-    #    img,
-    #    border=((224 - img.width)  // 2, (224 - img.height) // 2),
-    #    fill='black'
-    #)
-    #arr = np.array(pad)
-    
-    arr = np.array(pil_img)
-
-    with open(LABEL_PATH) as f:
-        labels = [line.strip() for line in f]
-
-    # Ensure interpreter is ready
-    interpreter.allocate_tensors()
-
-    # Fetch details here, in the function’s scope
-    input_details  = interpreter.get_input_details()
-    output_details = interpreter.get_output_details()
-
-    # 2. Prepare input tensor
-    tensor = np.expand_dims(arr, axis=0).astype(input_details[0]['dtype'])
-    interpreter.set_tensor(input_details[0]['index'], tensor)
-
-    # 3. Run inference
-    interpreter.invoke()
-
-    # 4. Retrieve and dequantize output
-    raw_output = interpreter.get_tensor(output_details[0]['index'])  # shape: [1, 965]
-    scale, zero_point = output_details[0]['quantization']
-    probs = scale * (raw_output.astype(np.float32) - zero_point)    # dequantize :contentReference[oaicite:6]{index=6}
-    probs = np.squeeze(probs)  # shape: (965,)
-
-    # 5. Get top-5 indices
-    #    Argsort returns indices that would sort the array ascending.
-    idx_sorted = np.argsort(probs)                              # :contentReference[oaicite:7]{index=7}
-    top5_idx   = idx_sorted[-5:][::-1]                          # last 5 reversed for descending :contentReference[oaicite:8]{index=8}
-
-    # 6. Map to (label, score)
-    top5 = [(labels[i], float(probs[i])) for i in top5_idx]     # label file from step 2 :contentReference[oaicite:9]{index=9}
-    return top5
-
 # MQTT callbacks & DB setup
-def on_connect(client, userdata, flags, rc):
+def on_connect(client, userdata, flags, rc, properties=None):
     print("MQTT Connected", flush=True)
 
-    # we are going subscribe to frigate/events and look for bird detections there
-    client.subscribe(f"{cfg_full['frigate']['main_topic']}/events/#")
+    # we are going subscribe to frigate/events and look for bird detections
+    # there; (re)subscribing here also restores the subscription on reconnect
+    print(f"Subscribing to {subscribe_topic}", flush=True)
+    client.subscribe(subscribe_topic)
+    # Events from while we weren't subscribed come from Frigate's API instead
+    if catchup is not None:
+        catchup.connected()
 
 
-def on_disconnect(client, userdata, rc):
+def on_disconnect(client, userdata, rc, properties=None):
+    if catchup is not None:
+        catchup.disconnected()
     if rc != 0:
-        print("Unexpected disconnection, trying to reconnect", flush=True)
-        while True:
-            try:
-                client.reconnect()
-                break
-            except Exception as e:
-                print(f"Reconnection failed due to {e}, retrying in 60 seconds", flush=True)
-                time.sleep(60)
+        # loop_forever() reconnects on its own, backing off up to reconnect_delay_set's max_delay
+        print("Unexpected disconnection, reconnecting", flush=True)
     else:
         print("Expected disconnection", flush=True)
 
 def setupdb():
-    conn = sqlite3.connect(DBPATH)
-    cursor = conn.cursor()
-    cursor.execute("""    
-        CREATE TABLE IF NOT EXISTS detections (    
-            id INTEGER PRIMARY KEY AUTOINCREMENT,  
-            detection_time TIMESTAMP NOT NULL,  
-            detection_index INTEGER NOT NULL,  
-            score REAL NOT NULL,  
-            display_name TEXT NOT NULL,  
-            category_name TEXT NOT NULL,  
-            frigate_event TEXT NOT NULL UNIQUE,
-            camera_name TEXT NOT NULL,
-            user_label TEXT NOT NULL DEFAULT '',
-            reviewed INTEGER NOT NULL DEFAULT 0
-        )    
-    """)
-
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS detection_choices (
-            event_id TEXT,
-            rank INTEGER,
-            display_name TEXT,
-            score REAL,
-            PRIMARY KEY(event_id, rank)
-        )
-    """)
-
-    conn.commit()
-
-    conn.close()
+    """Create or upgrade the database schema (see schema.py)."""
+    schema.setupdb(DBPATH)
 
 def on_message(client, userdata, message):
     #print("on message triggered")
@@ -227,173 +177,360 @@ def on_message(client, userdata, message):
         logger.info("Skipping because has_snapshot=%s", has_snapshot)
 
     full_id = after['id']
-    event_id = full_id.split('-')[0]
-    camera = after.get('camera')
-
-    # Build snapshot URL per camera
-    
-    snapshot_path = f"/api/{camera}/recordings/{event_id}/snapshot.jpg"
-    r = session.get(f"{base_url}{snapshot_path}", stream=True)
-    logger.debug("Fetched snapshot URL=%s -> status=%d", snapshot_path, r.status_code)
-
-    if not r.ok:
-        #print(f"Snapshot error {r.status_code}", flush=True)
-        logger.warning("Snapshot fetch failed: %s %s", r.status_code, r.text[:200]) 
+    if not owns_event(full_id):
+        logger.debug("Skipping %s, owned by another partition", full_id)
         return
-    
-    img = Image.open(BytesIO(r.content))
-    x1, y1, x2, y2 = after['snapshot']['box']
-    ROI = img.crop((x1,y1,x2,y2))
-    ROI.thumbnail((224,224))
-#    pad = ImageOps.expand(
-#        ROI,
-#        border=((224-ROI.width)//2, (224-ROI.height)//2),
-#        fill='black'
-#    )
-    
-    w, h = ROI.size
-    pad_left   = (224 - w) // 2
-    pad_right  = 224 - w - pad_left
-    pad_top    = (224 - h) // 2
-    pad_bottom = 224 - h - pad_top
-
-    pad = ImageOps.expand(
-        ROI,
-        border=(pad_left, pad_top, pad_right, pad_bottom),
-        fill='black'
-    )
 
-    arr = np.array(pad)
-    tensor_img = vision.TensorImage.create_from_array(arr)
+    # Classification runs on the worker that owns this event, off the
+    # network thread, so keepalives and acks aren't held up by inference
+    dispatcher.submit(full_id, after, camera=after.get('camera'))
 
-    start = datetime.fromtimestamp(after['start_time'])
-    ts = start.strftime('%Y-%m-%d %H:%M:%S')
+def owns_event(full_id):
+    """In partitioned mode every node sees every event but owns only some."""
+    partitions = ingest_cfg.get('partitions', 1)
+    return partitions <= 1 or partition_of(full_id, partitions) == ingest_cfg.get('partition_index', 0)
 
-    # Classification & DB logic as before...
-    result = classifier.classify(tensor_img)
-    logger.debug("Classifier result: %s", result)
+def acquire_context():
+    """
+    The active classification context, counted as in use until its
+    release(), so a reload can't close its vector store under the event.
+    """
+    while True:
+        ctx = context
+        if ctx.acquire():
+            return ctx
+        # retired and closed between reading the global and acquiring it
+
+def process_event(after, ctx):
+    """Classify one update with `ctx`, a snapshot of the active settings a reload doesn't affect."""
+    full_id = after['id']
+    event_id = full_id.split('-')[0]
+    camera = after.get('camera')
 
-    categories = result.classifications[0].categories
-    if not categories:
-        #print("no categories")
-        logger.info("No categories returned by classifier")
+    ROI = fetch_crop(full_id, event_id, camera, after['snapshot']['box'],
+                     ended=after.get('end_time') is not None)
+    if ROI is None:
         return
-    
-    print("Length of classifications   ")
-    print(len(result.classifications))
-    print("Length of classifications[0].categories:   ")
-    print(len(result.classifications[0].categories))
-
-    # prints out candidates to terminal
-    for cat in result.classifications[0].categories:
-        name = cat.display_name or "<None>"
-        low = name.lower()
-        is_allowed = (low in allowed)
-        print(f"  » '{name}' → lowercase '{low}' → in allowed? {is_allowed}")
-    
-    for cat in result.classifications[0].categories:
-        sci = cat.display_name
-        common = get_common_name(sci)
-        logger.debug("Category %r maps to common name %r", sci, common)
-
-
-    filtered = [
-            cat for cat in result.classifications[0].categories
-            if cat.display_name not in (None, "__background__") and get_common_name(cat.display_name).lower() in allowed
-    ]
 
-    if not filtered:
-        logger.info("All candidates were filtered out")
-        return
+    start = datetime.fromtimestamp(after['start_time'])
+    ts = start.strftime('%Y-%m-%d %H:%M:%S')
 
-    best_cat = filtered[0]
-    display_name = best_cat.display_name
-    score = best_cat.score
-    index = best_cat.index
-    display_name = best_cat.display_name
-    category_name = best_cat.category_name
-    common_name = get_common_name(best_cat.display_name)
-    logger.debug("Best candidate: %s", best_cat.display_name)
-
-    #top5 = sorted(filtered, key=lambda c: c.score, reverse=True)[:5]
-    top5 = classify_top5_via_interpreter(pad)
-
-    if score < cfg_full['classification']['threshold']:
-        #print("Insufficient score")
-        logger.info("Top category has insufficient score")
-        return
+    # One inference per update: the thumbnail is centred into the input
+    # tensor, then the whitelist mask and threshold are applied to the full
+    # output vector (the same rule `vectorstore.py reevaluate` uses).
+    with ctx.engine() as engine:
+        engine.set_image(ROI)
+        del ROI
+        engine.invoke()
+        top5 = [(ctx.choice_names[i], s) for i, s in engine.top_k(5)]
+        for label, s in top5:
+            logger.debug("  candidate %r score=%.3f", label, s)
+
+        scores = engine.raw_scores()
+        index = pick_best(scores, ctx.allowed_mask, ctx.min_q)
+        profiling.lap('infer')
 
-    if display_name != "__background__":
         conn = sqlite3.connect(DBPATH, timeout=30)
         cursor = conn.cursor()
-
-        #Check if a record with the given event exists
-        cursor.execute("SELECT * FROM detections WHERE frigate_event = ?", (full_id,))
-        result = cursor.fetchone()
-
-        if result is None:
-	     # Insert a new record if it doesn't exist
-             print("No record yet for this event. Storing.", flush=True)
-             cursor.execute("""  
-             INSERT OR REPLACE INTO detections (detection_time, detection_index, score,  
-             display_name, category_name, frigate_event, camera_name) VALUES (?, ?, ?, ?, ?, ?, ?)  
-             """, (ts, index, score, common_name, category_name, full_id, camera))
-            
-             for rank, (display_name, score) in enumerate(top5, start=1):
-                 common = get_common_name(display_name)
-                 cursor.execute("""
-                 INSERT INTO detection_choices(event_id, rank, display_name, score)
-                 VALUES (?, ?, ?, ?)
-                 ON CONFLICT(event_id, rank) DO UPDATE
-                     SET display_name=excluded.display_name,
-                         score=excluded.score
-                 """, (full_id, rank, common, score))
-            
-        else:
-            print("There is already a record for this event. Checking score", flush=True)
-            # Update the existing record if the new score is higher
-            existing_score = result[3]
-            if score > existing_score:
-                print("New score is higher. Updating record with higher score.", flush=True)
-                cursor.execute("""  
-                  UPDATE detections  
-                  SET detection_time = ?, detection_index = ?, score = ?, display_name = ?, category_name = ?  
-                  WHERE frigate_event = ?  
-                  """, (ts, index, score, common_name, category_name, full_id))
-            else:
-                print("New score is lower.", flush=True)
-
-        # Commit the changes
-        conn.commit()
-
-
-    # Example sub_label push using recordings endpoint
-    sub_json = {"subLabel": display_name[:20]}
-    session.post(
-        f"{base_url}/api/{camera}/recordings/{event_id}/sub_label",
-        json=sub_json
-    )
-
+        slot, new_slot = ctx.vectors.register(cursor, full_id, camera, ts)
+        if new_slot:
+            ctx.vectors.write(slot, scores)
+
+        if index < 0:
+            del scores
+            conn.commit()
+            conn.close()
+            logger.info("No allowed candidate reached the threshold")
+            return
+
+        score = ctx.scale * (int(scores[index]) - ctx.zero_point)
+        display_name = ctx.display_names[index]
+        category_name = ctx.category_names[index]
+        common_name = ctx.common_names[index]
+        logger.debug("Best candidate: %s (%s) score=%.3f", display_name, common_name, score)
+
+        # Insert, or replace only if this update scored higher; safe to repeat
+        stored = store_detection(cursor, ts, index, score, common_name, category_name,
+                                 full_id, camera, top5)
+        logger.info("Event %s: %s", full_id,
+                    "stored %s (%.2f)" % (common_name, score) if stored else "existing record scores higher")
+
+        # Keep the stored vector in step with the update that produced the row
+        if stored and not new_slot:
+            ctx.vectors.write(slot, scores)
+        del scores
+        profiling.lap('store')
+
+    # Queue the Frigate sub_label write-back in the same transaction; the
+    # outbox sender coalesces repeated updates for this event.
+    if stored and sub_label_sender is not None:
+        enqueue_sub_label(conn, full_id, display_name)
+
+    # Commit the changes
+    conn.commit()
     conn.close()
+    profiling.lap('commit')
+
+    if stored and sub_label_sender is not None:
+        sub_label_sender.notify()
     
     logger.debug("on_message fully processed event %s", full_id)
 
+def fetch_crop(full_id, event_id, camera, box, size=(224, 224), ended=False):
+    """
+    The bird box from the event's snapshot, fitted inside `size`.
+
+    Frigate is asked for a crop around the box scaled so the box comes back
+    just big enough for the model (crop=1&height=, see snapshots.py). When
+    the camera's resolution isn't known, the request fails or the image
+    isn't that crop, the full frame is fetched from the recordings and
+    cropped here. An event that has `ended` answers with its stored full
+    frame instead, which has the bounding box drawn on it (Frigate ignores
+    bbox=0 there), so for those the crop isn't asked for at all; an event
+    that ended after the update was sent is caught by the size check.
+    Bytes downloaded are counted per camera in the ingest status.
+    """
+    server_crop = ingest_cfg.get('server_crop', True) and not ended
+    frame_size = frame_sizes.get(camera) if server_crop else None
+    if frame_size:
+        region, height = crop_request(frame_size, box, size)
+        query = f"crop=1&quality={ingest_cfg.get('snapshot_quality', 90)}&bbox=0&timestamp=0"
+        if height:
+            query += f"&height={height}"
+        snapshot = snapshot_loader.fetch(f"{base_url}/api/events/{full_id}/snapshot.jpg?{query}")
+        profiling.lap('fetch')
+        if snapshot is not None:
+            found = locate_box(snapshot_loader.image_size(snapshot), frame_size, box, region, height)
+            # an event that has ended comes back as the full frame, box drawn in
+            kind = 'unusable' if found is None else 'crop' if found[1] else 'event_frame'
+            snapshot_loader.record(camera, kind, snapshot.length)
+            if kind == 'crop':
+                profiling.annotate(snapshot=kind, snapshot_bytes=snapshot.length)
+                logger.debug("Event %s: %s snapshot, %d bytes", full_id, kind, snapshot.length)
+                roi = snapshot_loader.crop(snapshot, found[0], size)
+                profiling.lap('decode')
+                return roi
+            # ended events are routine (catch-up replays nothing else); a mismatch isn't
+            logger.log(logging.DEBUG if kind == 'event_frame' else logging.INFO,
+                       "Event %s: %s snapshot isn't the crop; fetching the full frame", full_id, kind)
+
+    # Streamed into this worker's reusable buffer and cropped straight to
+    # the model input size (see snapshots.py)
+    snapshot = snapshot_loader.fetch(f"{base_url}/api/{camera}/recordings/{event_id}/snapshot.jpg")
+    if snapshot is None:
+        return None
+    profiling.lap('fetch')
+    snapshot_loader.record(camera, 'frame', snapshot.length)
+    profiling.annotate(snapshot='frame', snapshot_bytes=snapshot.length)
+    logger.debug("Event %s: full frame, %d bytes", full_id, snapshot.length)
+    roi = snapshot_loader.crop(snapshot, box, size)
+    profiling.lap('decode')
+    return roi
+
+def handle_event(after):
+    """Dispatcher entry point: process_event, timed per stage (see profiling.py)."""
+    with deferral_lock:
+        if after.get('_deferrals'):
+            deferrals['waiting'] -= 1
+            # a newer update for the event was handled while this one waited
+            if deferred_events.get(after['id']) != after['_deferral_seq']:
+                deferrals['superseded'] += 1
+                return
+        deferred_events.pop(after['id'], None)
+    ctx = acquire_context()
+    try:
+        with profiling.trace('event', 'process_event', event=after['id'], camera=after.get('camera')):
+            try:
+                process_event(after, ctx)
+            except FrigateUnavailable as e:
+                defer_event(after, e)
+    finally:
+        ctx.release()
+
+def defer_event(after, reason):
+    """
+    Requeue an event whose snapshot couldn't be fetched because Frigate is
+    unreachable or its breaker is open. It goes back to the dispatcher as
+    delayed backlog, due when the snapshot breaker next lets a probe through
+    and backing off to a minute between tries, so it keeps the catch-up
+    mark from moving past it. Given up after `ingest.defer_max_minutes`, or
+    when `ingest.defer_max_events` are already waiting. Only an event's
+    latest update is kept: handle_event drops a deferred one once a newer
+    update for the event has been handled, so updates never run out of order.
+    """
+    tries = after.get('_deferrals', 0) + 1
+    first = after.get('_deferred_at', time.time())
+    with deferral_lock:
+        if (time.time() - first > ingest_cfg.get('defer_max_minutes', 60) * 60
+                or deferrals['waiting'] >= ingest_cfg.get('defer_max_events', 1000)):
+            deferrals['given_up'] += 1
+            logger.warning("Event %s: giving up after %d tries, Frigate still unavailable (%s)",
+                           after['id'], tries, reason)
+            return
+        deferrals['waiting'] += 1
+        deferrals['deferred'] += 1
+        seq = deferred_events[after['id']] = next(deferral_seq)
+    delay = max(snapshot_loader.breaker.retry_in(), min(5 * 2 ** (tries - 1), 60))
+    logger.info("Event %s: Frigate unavailable (%s), retrying in %.0fs", after['id'], reason, delay)
+    dispatcher.submit(after['id'], dict(after, _deferrals=tries, _deferred_at=first, _deferral_seq=seq),
+                      camera=after.get('camera'), backlog=True, delay=delay)
+
+def build_context(previous=None):
+    """Build a classification context from the current config.yml."""
+    with open(CONFIG_PATH, 'r') as config_file:
+        cls_cfg = yaml.safe_load(config_file)['classification']
+    return ClassificationContext(cls_cfg, cls_cfg.get('whitelist', DEFAULT_WHITELIST),
+                                 BIRDNAMES_PATH, previous=previous)
+
+def publish_context(ctx):
+    global context
+    previous, context = context, ctx
+    if previous is not None:
+        previous.retire(ctx)
+
+def watched_paths():
+    ctx = context
+    return [CONFIG_PATH, ctx.whitelist_path, ctx.model_path, ctx.label_path, RELOAD_TRIGGER]
+
+def start_context_reloader():
+    """
+    Load the classification context and keep it in sync with config.yml,
+    the whitelist and the model files. SIGHUP forces a reload.
+    """
+    publish_context(build_context())
+    print(f"{int(context.allowed_mask.sum())} of {len(context.display_names)} model labels are whitelisted", flush=True)
+    reloader = ContextReloader(
+        build=lambda: build_context(previous=context),
+        publish=publish_context,
+        watch_paths=watched_paths,
+        status_path=CLASSIFICATION_STATUS,
+        interval=config['classification'].get('reload_interval', 5),
+    )
+    reloader.write_status(context)
+    signal.signal(signal.SIGHUP, lambda signum, frame: reloader.trigger())
+    reloader.start()
+    return reloader
+
+def start_sub_label_sender():
+    """Start the background sender that drains the sub_label outbox."""
+    global sub_label_sender
+    out_cfg = config.get('sub_labels', {})
+    if not out_cfg.get('enabled', True):
+        print("Frigate sub_label write-back disabled", flush=True)
+        return None
+    sub_label_sender = SubLabelSender(
+        session, base_url, DBPATH,
+        concurrency=out_cfg.get('concurrency', 2),
+        max_attempts=out_cfg.get('max_attempts', 10),
+        backoff_max=out_cfg.get('backoff_max', 300),
+        breaker=api_breaker,
+    )
+    sub_label_sender.start()
+    return sub_label_sender
+
+def start_retention_worker():
+    """Start the background archive/compaction pass (see retention.py)."""
+    ret_cfg = config.get('retention') or {}
+    if not ret_cfg.get('enabled', True):
+        return None
+    worker = RetentionWorker(
+        DBPATH,
+        keep_days=ret_cfg.get('keep_days', 0),
+        archive_dir=ret_cfg.get('archive_dir', './data/archive'),
+        interval=ret_cfg.get('interval', 3600),
+        batch_size=ret_cfg.get('batch_size', 500),
+        vacuum_pages=ret_cfg.get('vacuum_pages', 256),
+    )
+    worker.start()
+    return worker
+
+def start_snapshot_loader():
+    """
+    Snapshot size cap, decode budget, server-side cropping and malloc
+    settings from `ingest:` (see snapshots.py); timeouts and breaker from
+    `frigate:` (see breaker.py).
+    """
+    global snapshot_loader, frame_sizes
+    threshold_kb = ingest_cfg.get('mmap_threshold_kb', 1024)
+    if threshold_kb and not set_mmap_threshold(threshold_kb * 1024):
+        logger.info("mallopt not available; freed snapshot memory may not return to the OS")
+    snapshot_loader = SnapshotLoader(
+        session,
+        max_bytes=int(ingest_cfg.get('max_snapshot_mb', 10) * MB),
+        decode_budget=int(ingest_cfg.get('decode_budget_mb', 128) * MB),
+        draft=ingest_cfg.get('jpeg_draft', True),
+        timeout=(frig_cfg.get('connect_timeout', 3), frig_cfg.get('read_timeout', 15)),
+        breaker=CircuitBreaker('snapshot', frig_cfg.get('breaker_failures', 5), frig_cfg.get('breaker_reset', 30)))
+    frame_sizes = FrameSizes(session, base_url, breaker=api_breaker)
+
+def start_catchup(node):
+    """Start the thread that replays events missed while offline (see catchup.py)."""
+    global catchup
+    cu_cfg = config.get('catchup') or {}
+    if not cu_cfg.get('enabled', True):
+        return None
+    catchup = CatchUp(
+        session, base_url, DBPATH, dispatcher, node,
+        frame_size=frame_sizes.get,
+        accept=owns_event,
+        overlap=cu_cfg.get('overlap_seconds', 300),
+        max_hours=cu_cfg.get('max_hours', 24),
+        max_pending=cu_cfg.get('max_pending', 2 * ingest_cfg.get('workers', 1)),
+        breaker=api_breaker,
+    )
+    dispatcher.status_sources['catchup'] = catchup.status
+    catchup.start()
+    return catchup
+
+def start_profiler():
+    """Stage timings for ingest; SIGUSR2 toggles the stack sampler."""
+    prof_cfg = config.get('profiling') or {}
+    if not prof_cfg.get('enabled', False):
+        return None
+    prof = profiling.init('ingest', prof_cfg)
+    prof.ensure_running()
+    signal.signal(signal.SIGUSR2, lambda signum, frame: prof.toggle_sampling(prof_cfg.get('sample_seconds', 30)))
+    return prof
+
 def run_mqtt_client():
     load_config()
+    check_scaling(config.get('ingest') or {})
+    start_profiler()
+    start_context_reloader()
+    start_sub_label_sender()
+    start_retention_worker()
+
+    global ingest_cfg, dispatcher, subscribe_topic
+    ingest_cfg = config.get('ingest') or {}
+    start_snapshot_loader()
+    node = ingest_cfg.get('node_id') or socket.gethostname()
+    dispatcher = EventDispatcher(handle_event, workers=ingest_cfg.get('workers', 1),
+                                 cameras=ingest_cfg.get('cameras'),
+                                 coalesce=ingest_cfg.get('coalesce_updates', True),
+                                 status_path=INGEST_STATUS.format(node=node),
+                                 status_sources={'snapshots': snapshot_loader.status,
+                                                 'deferrals': lambda: dict(deferrals),
+                                                 'api_breaker': api_breaker.status})
+    start_catchup(node)
+    subscribe_topic = f"{config['frigate']['main_topic']}/events/#"
+    protocol = mqtt_client.MQTTv311
+    if ingest_cfg.get('shared_group'):
+        # MQTT v5 shared subscription: the broker load-balances across nodes
+        subscribe_topic = f"$share/{ingest_cfg['shared_group']}/{subscribe_topic}"
+        protocol = mqtt_client.MQTTv5
+
     print("Starting MQTT client. Connecting to: " + config['frigate']['mqtt_server'], flush=True)
     now = datetime.now()
     current_time = now.strftime("%Y%m%d%H%M%S")
     #client = mqtt.Client("birdspeciesid" + current_time)
     client = mqtt_client.Client(
       CallbackAPIVersion.VERSION1,          # use the legacy callback API
-      client_id="birdspeciesid" + current_time)
+      client_id=f"birdspeciesid-{node}-{current_time}",
+      protocol=protocol)
     client.reconnect_delay_set(min_delay=1,max_delay=60)
     
     print("client created")
 
-    client.subscribe("frigate/events/#")
-    print("explicit subscription")
-    
     client.on_message = on_message
     client.on_disconnect = on_disconnect
     client.on_connect = on_connect
@@ -417,7 +554,7 @@ def load_config():
 
 def run_webui():
     print("Starting flask app", flush=True)
-    app.run(debug=False, host=config['webui']['host'], port=config['webui']['port'])
+    webui.serve(config['webui'])
 
 def main():
 
@@ -432,39 +569,29 @@ def main():
 
     load_config()
 
-    # Initialize the image classification model
-    base_options = core.BaseOptions(
-        file_name=config['classification']['model'], use_coral=False, num_threads=4)
-
-    # Enable Coral by this setting
-    classification_options = processor.ClassificationOptions(
-        max_results=5, score_threshold=config['classification']['threshold'])
-    options = vision.ImageClassifierOptions(
-        base_options=base_options, classification_options=classification_options)
-
-    # create classifier
-    global classifier
-    classifier = vision.ImageClassifier.create_from_options(options)
-
-    # Instantiate and allocate
-    global interpreter
-    interpreter = tflite.Interpreter(model_path=MODEL_PATH)  
-    interpreter.allocate_tensors()  
-    input_details  = interpreter.get_input_details()  
-    output_details = interpreter.get_output_details()  
-
     # setup database
     setupdb()
 
+    # Extra ingest nodes (see ingest.py) run without their own web UI
+    ingest_only = '--ingest-only' in sys.argv[1:]
+
     print("Starting threads for Flask and MQTT", flush=True)
-    flask_process = multiprocessing.Process(target=run_webui)
+    processes = []
+    if not ingest_only:
+        flask_process = multiprocessing.Process(target=run_webui)
+        processes.append(flask_process)
     mqtt_process = multiprocessing.Process(target=run_mqtt_client)
+    processes.append(mqtt_process)
+
+    for process in processes:
+        process.start()
 
-    flask_process.start()
-    mqtt_process.start()
+    # `docker kill -s HUP` reaches this process; pass it on to ingest
+    signal.signal(signal.SIGHUP, lambda signum, frame: os.kill(mqtt_process.pid, signal.SIGHUP))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: os.kill(mqtt_process.pid, signal.SIGUSR2))
 
-    flask_process.join()
-    mqtt_process.join()
+    for process in processes:
+        process.join()
 
     print("main completed")
 
@@ -1,47 +1,104 @@
 // static/js/review-toggle.js
-document.addEventListener('DOMContentLoaded', () => {
-  // Find all review buttons on the page
-  const buttons = document.querySelectorAll('.review-btn');
+//
+// Review toggles and label forms don't talk to the server one by one: each
+// change is applied to the page right away and queued, and the queue is sent
+// to /detections/bulk in one request once clicking stops for a moment (or
+// when the page is hidden/closed, via sendBeacon).
+const reviewQueue = (() => {
+  const FLUSH_DELAY_MS = 800;
+  const pending = new Map();  // event id -> {event_id, reviewed?, label?}
+  let timer = null;
 
-  buttons.forEach(btn => {
-    btn.addEventListener('click', async event => {
-      event.preventDefault();  // Prevent any default form submissions
+  function add(eventId, change) {
+    pending.set(eventId, Object.assign(pending.get(eventId) || { event_id: eventId }, change));
+    clearTimeout(timer);
+    timer = setTimeout(flush, FLUSH_DELAY_MS);
+  }
 
-      const eventId = btn.dataset.event;
-      // Determine current state from aria-pressed
-      const isReviewed = btn.getAttribute('aria-pressed') === 'true';
-      // We want to toggle, so reviewed → unreview (DELETE), unreview → review (POST)
-      const method = isReviewed ? 'DELETE' : 'POST';
-      const url = `/detections/${encodeURIComponent(eventId)}/review`;
-      const fetchOptions = {
-        method: method,
-        headers: { 'Content-Type': 'application/json' }
-      };
-      // Only include JSON body on POST
-      if (!isReviewed) {
-        fetchOptions.body = JSON.stringify({ reviewed: true });
-      }
+  function take() {
+    clearTimeout(timer);
+    const changes = Array.from(pending.values());
+    pending.clear();
+    return changes;
+  }
+
+  async function flush() {
+    const changes = take();
+    if (!changes.length) return;
+    try {
+      const resp = await fetch('/detections/bulk', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ changes })
+      });
+      if (!resp.ok) throw new Error(`status ${resp.status}`);
+      const json = await resp.json();
+      // Show what the server actually stored
+      json.updated.forEach(row => {
+        if (pending.has(row.event_id)) return;  // clicked again since
+        document.querySelectorAll(`.review-btn[data-event="${CSS.escape(row.event_id)}"]`)
+          .forEach(btn => setReviewed(btn, row.reviewed));
+      });
+    } catch (err) {
+      console.error('Error saving review changes:', err);
+      // Put them back (unless superseded) and try again later
+      changes.forEach(change => {
+        if (!pending.has(change.event_id)) pending.set(change.event_id, change);
+      });
+      timer = setTimeout(flush, FLUSH_DELAY_MS * 5);
+    }
+  }
+
+  function flushOnExit() {
+    const changes = take();
+    if (!changes.length) return;
+    const body = new Blob([JSON.stringify({ changes })], { type: 'application/json' });
+    if (!navigator.sendBeacon('/detections/bulk', body)) {
+      changes.forEach(change => pending.set(change.event_id, change));
+    }
+  }
+
+  document.addEventListener('visibilitychange', () => {
+    if (document.visibilityState === 'hidden') flushOnExit();
+  });
+  window.addEventListener('pagehide', flushOnExit);
+
+  return { add, flush };
+})();
 
-      try {
-        const resp = await fetch(url, fetchOptions);
-        if (!resp.ok) {
-          console.error(`Failed to toggle review (status ${resp.status})`);
-          return;
-        }
-        const json = await resp.json();
-        // Update the button state based on the server's response
-        const nowReviewed = json.reviewed === true;
-        btn.setAttribute('aria-pressed', nowReviewed);
-        // Swap icon class: bi-check for reviewed, bi-check-circle for unreviewed
-        const icon = btn.querySelector('i');
-        if (icon) {
-          icon.classList.remove('bi-check', 'bi-check-circle');
-          icon.classList.add(nowReviewed ? 'bi-check' : 'bi-check-circle');
-        }
-      } catch (err) {
-        console.error('Error toggling review flag:', err);
+function setReviewed(btn, reviewed) {
+  btn.setAttribute('aria-pressed', reviewed ? 'true' : 'false');
+  // Swap icon class: bi-check for reviewed, bi-check-circle for unreviewed
+  const icon = btn.querySelector('i');
+  if (icon) {
+    icon.classList.remove('bi-check', 'bi-check-circle');
+    icon.classList.add(reviewed ? 'bi-check' : 'bi-check-circle');
+  }
+}
+
+document.addEventListener('DOMContentLoaded', () => {
+  document.querySelectorAll('.review-btn').forEach(btn => {
+    btn.addEventListener('click', event => {
+      event.preventDefault();  // Prevent any default form submissions
+      const reviewed = btn.getAttribute('aria-pressed') !== 'true';
+      setReviewed(btn, reviewed);
+      reviewQueue.add(btn.dataset.event, { reviewed });
+    });
+  });
+
+  // Label forms post to /set_label without JS; with it, queue the label
+  // instead of reloading the page
+  document.querySelectorAll('form.label-form').forEach(form => {
+    form.addEventListener('submit', event => {
+      event.preventDefault();
+      const eventId = form.elements['event_id'].value;
+      const label = form.elements['selected_label'].value;
+      reviewQueue.add(eventId, { label });
+      const button = form.querySelector('button[type="submit"]');
+      if (button) {
+        button.textContent = 'Saved';
+        setTimeout(() => { button.textContent = 'Save'; }, 1500);
       }
     });
   });
 });
-
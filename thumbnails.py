@@ -0,0 +1,288 @@
+"""
+Thumbnail cache and contact sheets for the web UI's list pages.
+
+Frigate event thumbnails are kept on disk (data/thumbnails/<xx>/<event>),
+so each one crosses the network once, however many pages and processes
+show it. The cache is trimmed back to `max_mb`, least recently used first.
+
+A list page with hundreds of detections used to make one proxied request
+per thumbnail. Instead, the page registers its event ids and gets a key;
+its thumbnails are then served as contact sheets: JPEG sprites of up to
+`per_sheet` tiles, `columns` to a row, each thumbnail fitted and centred in
+a `tile` x `tile` cell. The page renders CSS sprites from the key and each
+event's position, so it costs one request per sheet. A sheet is built
+with its thumbnails fetched and scaled in parallel, and is stored next to
+the thumbnails with a JSON map of each event's offsets. Sheets with a
+thumbnail missing aren't stored, so the gap is retried on a later request;
+such a build is written as one `.partial` file (offsets, then the JPEG) and
+served for INCOMPLETE_TTL seconds, so the sheet and its offsets, fetched
+one after the other and maybe from different web workers, come from the
+same build. A page
+and its sheets are used, and pruned after SHEET_MAX_AGE, as a group.
+
+With a breaker and a negative cache (see breaker.py), thumbnails Frigate
+answered 404 for aren't asked for again until the entry expires, and while
+the breaker is open a sheet is built from what is on disk, with blank cells
+for the rest, instead of waiting on Frigate for each tile.
+"""
+import contextlib
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, UnidentifiedImageError
+
+from breaker import CircuitBreaker, CircuitOpen, FrigateUnavailable, guarded_get
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_DIR = './data/thumbnails'
+# Registered pages and built sheets not used for this long are removed
+SHEET_MAX_AGE = 7 * 86400
+# An incomplete sheet is served from its .partial file for this long before it is rebuilt
+INCOMPLETE_TTL = 30
+# Check the cache size after this many new files
+PRUNE_EVERY = 200
+
+
+def _write_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class ThumbnailCache:
+    """Frigate event thumbnails on disk; fetched on first use."""
+
+    def __init__(self, session, base_url: str, cache_dir: str = THUMBNAIL_DIR, max_mb: float = 500,
+                 timeout=10, breaker: CircuitBreaker = None, missing=None):
+        self.session = session
+        self.base_url = base_url
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker('thumbnail')
+        self.missing = missing    # NegativeCache of (event id, 'thumbnail'), optional
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.writes = 0
+
+    def path(self, event_id: str) -> str:
+        shard = hashlib.sha1(event_id.encode()).hexdigest()[:2]
+        return os.path.join(self.cache_dir, shard, event_id.replace('/', '_'))
+
+    def get(self, event_id: str):
+        """The thumbnail's bytes, or None if Frigate doesn't have a usable one."""
+        path = self.path(event_id)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # recency for pruning
+            return data
+        except FileNotFoundError:
+            pass
+        key = (event_id, 'thumbnail')
+        if self.missing is not None and key in self.missing:
+            return None
+        try:
+            r = guarded_get(self.session, f"{self.base_url}/api/events/{event_id}/thumbnail.jpg", self.breaker,
+                            timeout=self.timeout)
+        except CircuitOpen:
+            return None
+        except FrigateUnavailable as e:
+            logger.warning("Thumbnail fetch for %s failed: %s", event_id, e)
+            return None
+        if r.status_code != 200 or not r.headers.get('Content-Type', '').startswith('image/'):
+            if r.status_code == 404 and self.missing is not None:
+                self.missing.add(key)
+            return None
+        try:
+            with Image.open(io.BytesIO(r.content)) as img:
+                img.verify()
+        except (UnidentifiedImageError, OSError, SyntaxError):
+            logger.warning("Invalid thumbnail data for %s", event_id)
+            if self.missing is not None:
+                self.missing.add(key)
+            return None
+        _write_atomic(path, r.content)
+        with self.lock:
+            self.writes += 1
+            prune = self.writes % PRUNE_EVERY == 0
+        if prune:
+            self.prune()
+        return r.content
+
+    def prune(self):
+        """
+        Remove the least recently used files until the cache fits in
+        max_bytes, and sheets and registered pages unused for SHEET_MAX_AGE.
+        """
+        files, total = [], 0
+        pages = {}  # page key -> newest mtime of its ids file and sheets
+        for root, _, names in os.walk(self.cache_dir):
+            in_sheets = os.path.basename(root) == 'sheets'
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                page = _page_key(name) if in_sheets else None
+                if page is not None:
+                    pages[page] = max(pages.get(page, 0), st.st_mtime)
+                files.append((st.st_mtime, st.st_size, path, page))
+                total += st.st_size
+        files.sort()
+        now = time.time()
+        for mtime, size, path, page in files:
+            stale_sheet = page is not None and (now - pages[page] > SHEET_MAX_AGE or
+                                                (path.endswith('.partial') and now - mtime > INCOMPLETE_TTL))
+            if total <= self.max_bytes and not stale_sheet:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+
+def _page_key(name: str) -> str:
+    """The registered page a file in the sheets directory belongs to: `key`.ids.json, `key`-`n`.jpg/.json/.partial."""
+    return name.split('.', 1)[0].split('-', 1)[0]
+
+
+class SheetLayout:
+    """Where each event of a registered page sits in its contact sheets."""
+
+    def __init__(self, key: str, per_sheet: int, columns: int, tile: int):
+        self.key = key
+        self.per_sheet = per_sheet
+        self.columns = columns
+        self.tile = tile
+
+    def place(self, index: int):
+        """(sheet number, x, y) of the `index`th event on the page."""
+        sheet, slot = divmod(index, self.per_sheet)
+        return sheet, (slot % self.columns) * self.tile, (slot // self.columns) * self.tile
+
+
+class ContactSheets:
+    """Registers pages of event ids and builds their sprite sheets (see module docstring)."""
+
+    def __init__(self, cache: ThumbnailCache, tile: int = 100, columns: int = 10, per_sheet: int = 100,
+                 quality: int = 80, workers: int = 8):
+        self.cache = cache
+        self.sheet_dir = os.path.join(cache.cache_dir, 'sheets')
+        self.tile = tile
+        self.columns = columns
+        self.per_sheet = per_sheet
+        self.quality = quality
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnail')
+
+    def register(self, event_ids) -> SheetLayout:
+        """Remember this page's events (in display order) and return its layout."""
+        event_ids = list(event_ids)
+        spec = json.dumps([self.tile, self.columns, self.per_sheet, event_ids])
+        key = hashlib.sha1(spec.encode()).hexdigest()[:20]
+        path = os.path.join(self.sheet_dir, f"{key}.ids.json")
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            _write_atomic(path, json.dumps(event_ids).encode())
+        return SheetLayout(key, self.per_sheet, self.columns, self.tile)
+
+    def events(self, key: str, sheet: int):
+        """Event ids on sheet `sheet` of the page registered as `key`, or None if unknown."""
+        path = os.path.join(self.sheet_dir, f"{key}.ids.json")
+        try:
+            with open(path) as f:
+                event_ids = json.load(f)
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return event_ids[sheet * self.per_sheet:(sheet + 1) * self.per_sheet]
+
+    def _tile(self, event_id: str):
+        data = self.cache.get(event_id)
+        if data is None:
+            return None
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                img.draft('RGB', (self.tile, self.tile))
+                img = img.convert('RGB')
+            img.thumbnail((self.tile, self.tile), Image.Resampling.LANCZOS)
+            return img
+        except (UnidentifiedImageError, OSError):
+            return None
+
+    def sheet(self, key: str, sheet: int):
+        """
+        (jpeg bytes, offsets, complete) for a sheet; offsets maps event id
+        to [x, y, width, height] and is None for missing thumbnails. None if
+        the page isn't registered.
+        """
+        base = os.path.join(self.sheet_dir, f"{key}-{sheet}")
+        try:
+            with open(base + '.jpg', 'rb') as f:
+                data = f.read()
+            with open(base + '.json') as f:
+                offsets = json.load(f)
+            # keep the page's files together for prune
+            os.utime(base + '.jpg')
+            os.utime(base + '.json')
+            with contextlib.suppress(FileNotFoundError):
+                os.utime(os.path.join(self.sheet_dir, f"{key}.ids.json"))
+            return data, offsets, True
+        except (FileNotFoundError, ValueError):
+            pass
+        recent = self._partial(base + '.partial')
+        if recent is not None:
+            return recent[0], recent[1], False
+        event_ids = self.events(key, sheet)
+        if event_ids is None:
+            return None
+        tiles = list(self.pool.map(self._tile, event_ids))
+        rows = max((len(event_ids) + self.columns - 1) // self.columns, 1)
+        canvas = Image.new('RGB', (min(len(event_ids), self.columns) * self.tile or self.tile, rows * self.tile),
+                           'white')
+        offsets = {}
+        for slot, (event_id, img) in enumerate(zip(event_ids, tiles)):
+            if img is None:
+                offsets[event_id] = None  # left blank, like the hidden placeholder of an <img>
+                continue
+            cell_x, cell_y = (slot % self.columns) * self.tile, (slot // self.columns) * self.tile
+            x = cell_x + (self.tile - img.width) // 2
+            y = cell_y + (self.tile - img.height) // 2
+            canvas.paste(img, (x, y))
+            offsets[event_id] = [x, y, img.width, img.height]
+        out = io.BytesIO()
+        canvas.save(out, 'JPEG', quality=self.quality, optimize=True)
+        data = out.getvalue()
+        complete = all(offset is not None for offset in offsets.values())
+        if complete:
+            _write_atomic(base + '.json', json.dumps(offsets).encode())
+            _write_atomic(base + '.jpg', data)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(base + '.partial')
+        else:
+            # one file, so a reader never pairs this image with another build's offsets
+            _write_atomic(base + '.partial', json.dumps(offsets).encode() + b'\n' + data)
+        return data, offsets, complete
+
+    @staticmethod
+    def _partial(path: str):
+        """(jpeg bytes, offsets) of an incomplete build younger than INCOMPLETE_TTL, or None."""
+        try:
+            if time.time() - os.path.getmtime(path) >= INCOMPLETE_TTL:
+                return None
+            with open(path, 'rb') as f:
+                header, data = f.read().split(b'\n', 1)
+            return data, json.loads(header)
+        except (FileNotFoundError, ValueError):
+            return None
@@ -0,0 +1,418 @@
+"""
+Append-only, memory-mapped store of the model's full quantized output vector
+for every classified event, plus the re-evaluation command that re-applies
+a threshold/whitelist to that history without re-running inference.
+
+Layout: one raw uint8 file per model, row `slot` at byte offset
+slot * width. Slots come from the `detection_vectors` table, which is filled
+for every classified event (including ones that were rejected), so lowering
+the threshold can bring those back too. A slot number is the same in every
+model's file, but a file only holds the rows that model actually produced;
+`vector_models` records which (model, slot) rows have been written, and
+everything else in a file is a hole that reads as zeros.
+
+    python vectorstore.py reevaluate --threshold 0.5 --dry-run
+"""
+import os
+import argparse
+import sqlite3
+import threading
+import time
+import numpy as np
+import yaml
+
+from retention import get_meta, set_meta
+
+VECTOR_DIR = './data/vectors'
+DBPATH = './data/speciesid.db'
+BIRDNAMES_PATH = os.path.join(os.path.dirname(__file__), 'birdnames.db')
+# classification.whitelist when unset, as in speciesid
+DEFAULT_WHITELIST = os.path.join(os.path.dirname(__file__), 'config', 'northeast_birds.txt')
+
+# rows handed to NumPy at once during re-evaluation (~16 MB for 965 labels)
+CHUNK_ROWS = 16384
+
+
+def vector_path_for(model_path: str) -> str:
+    """Vectors are only comparable within one model, so key the file by it."""
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(VECTOR_DIR, f"{name}.u8")
+
+
+class VectorStore:
+    def __init__(self, path: str, width: int):
+        self.path = path
+        self.width = width
+        self.model = os.path.splitext(os.path.basename(path))[0]
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # O_APPEND is deliberately not used: rows are written at fixed offsets
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.lock = threading.Lock()
+        self.users = 0
+        self.retired = False
+
+    def register(self, cursor, frigate_event: str, camera: str, detection_time: str):
+        """
+        Return (slot, is_new) for an event, allocating the next slot the first
+        time the event is seen. is_new is per model: an event classified
+        under a previous model has a slot, but no row in this store yet, and
+        the caller must write it. The row is marked as written here, in the
+        caller's transaction, which commits after the write.
+        """
+        cursor.execute(
+            "INSERT OR IGNORE INTO detection_vectors (frigate_event, camera_name, detection_time) "
+            "VALUES (?, ?, ?)",
+            (frigate_event, camera, detection_time)
+        )
+        slot = cursor.execute(
+            "SELECT id FROM detection_vectors WHERE frigate_event = ?", (frigate_event,)
+        ).fetchone()[0]
+        cursor.execute("INSERT OR IGNORE INTO vector_models (slot, model) VALUES (?, ?)", (slot, self.model))
+        return slot, cursor.rowcount == 1
+
+    def write(self, slot: int, scores: np.ndarray):
+        """Write one raw output vector into its slot (no intermediate copy)."""
+        if scores.size != self.width:
+            raise ValueError(f"vector has {scores.size} entries, store expects {self.width}")
+        with self.lock:
+            # a closed store's fd number may already belong to another file
+            if self.fd is None:
+                raise ValueError(f"vector store {self.path} is closed")
+            os.pwrite(self.fd, memoryview(scores), slot * self.width)
+
+    def matrix(self) -> np.ndarray:
+        """Read-only (rows, width) view of the whole file."""
+        rows = os.path.getsize(self.path) // self.width
+        if rows == 0:
+            return np.zeros((0, self.width), dtype=np.uint8)
+        return np.memmap(self.path, dtype=np.uint8, mode='r', shape=(rows, self.width))
+
+    def adopt_legacy(self, conn):
+        """
+        Mark the rows written before vector_models existed: every slot in
+        detection_vectors whose row in this file isn't all zeros (a real
+        output vector never is). Runs once per model.
+        """
+        key = f"vectors_adopted:{self.model}"
+        if get_meta(conn, key) is not None:
+            return
+        matrix = self.matrix()
+        slots = [row[0] for row in conn.execute("SELECT id FROM detection_vectors WHERE id < ? ORDER BY id",
+                                               (len(matrix),))]
+        with conn:
+            for start in range(0, len(slots), CHUNK_ROWS):
+                chunk = np.array(slots[start:start + CHUNK_ROWS], dtype=np.int64)
+                written = chunk[matrix[chunk].any(axis=1)]
+                conn.executemany("INSERT OR IGNORE INTO vector_models (slot, model) VALUES (?, ?)",
+                                 [(int(slot), self.model) for slot in written])
+            set_meta(conn, key, '1')
+
+    def acquire(self) -> bool:
+        """Count a user of the store; False once it has been retired and closed."""
+        with self.lock:
+            if self.fd is None:
+                return False
+            self.users += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.users -= 1
+            if self.retired and self.users == 0:
+                self._close()
+
+    def retire(self):
+        """Close the store as soon as its last user releases it (now, if it has none)."""
+        with self.lock:
+            self.retired = True
+            if self.users == 0:
+                self._close()
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def _top_k_batch(matrix: np.ndarray, k: int):
+    """Indices of the k best outputs per row, best first."""
+    part = np.argpartition(matrix, -k, axis=1)[:, -k:]
+    order = np.argsort(-np.take_along_axis(matrix, part, axis=1).astype(np.int16), axis=1, kind='stable')
+    return np.take_along_axis(part, order, axis=1)
+
+
+def reevaluate(conn, store: VectorStore, tables: dict, mask: np.ndarray, min_q: int,
+               scale: float, zero_point: int, dry_run: bool = False) -> dict:
+    """
+    Re-apply `mask`/`min_q` to every stored vector and bring `detections`
+    in line:
+
+      * newly accepted events are inserted (with their top-5 choices),
+      * accepted events whose best label changed are relabelled,
+      * events that no longer pass are removed, unless they have been
+        reviewed or given a user label.
+
+    Only events this model has a vector for are considered; a detection
+    made under another model, whose row here is a hole, is left alone.
+    Everything is applied in one transaction. Returns counts per action.
+    """
+    from classifier import pick_best_batch
+
+    store.adopt_legacy(conn)
+    # One row per vector this model wrote, with the detection it currently backs (if any)
+    events = conn.execute("""
+        SELECT v.id, v.frigate_event, v.camera_name, v.detection_time,
+               IFNULL(d.detection_index, -1),
+               IFNULL(d.reviewed, 0) OR IFNULL(d.user_label, '') != ''
+          FROM vector_models m
+          JOIN detection_vectors v ON v.id = m.slot
+          LEFT JOIN detections d ON d.frigate_event = v.frigate_event
+         WHERE m.model = ?
+         ORDER BY v.id
+    """, (store.model,)).fetchall()
+    matrix = store.matrix()
+
+    inserts, choices, updates, deletes = [], [], [], []
+    for start in range(0, len(events), CHUNK_ROWS):
+        batch = [e for e in events[start:start + CHUNK_ROWS] if e[0] < len(matrix)]
+        if not batch:
+            continue
+        slots = np.array([e[0] for e in batch], dtype=np.int64)
+        current = np.array([e[4] for e in batch], dtype=np.int64)
+        protected = np.array([bool(e[5]) for e in batch])
+        rows = matrix[slots]
+        # a marked row that reads as zeros was never written out (lost in a crash)
+        best = np.where(rows.any(axis=1), pick_best_batch(rows, mask, min_q), -2)
+
+        # Only rows whose outcome changes are touched from Python
+        for r in np.flatnonzero((best == -1) & (current >= 0) & ~protected):
+            deletes.append((batch[r][1],))
+        for r in np.flatnonzero((best >= 0) & (current >= 0) & (best != current)):
+            b = best[r]
+            updates.append((int(b), float(scale * (int(rows[r, b]) - zero_point)),
+                            tables['common'][b], tables['category'][b], batch[r][1]))
+        new = np.flatnonzero((best >= 0) & (current < 0))
+        top5 = _top_k_batch(rows[new], 5)
+        for r, top in zip(new, top5):
+            slot, full_id, camera, ts = batch[r][:4]
+            b = best[r]
+            inserts.append((ts, int(b), float(scale * (int(rows[r, b]) - zero_point)),
+                            tables['common'][b], tables['category'][b], full_id, camera))
+            for rank, i in enumerate(top, start=1):
+                choices.append((full_id, rank, tables['choice'][i],
+                                float(scale * (int(rows[r, i]) - zero_point))))
+
+    summary = {'events': len(events), 'inserted': len(inserts),
+               'relabelled': len(updates), 'removed': len(deletes)}
+    if dry_run:
+        return summary
+
+    with conn:
+        conn.executemany("""
+            INSERT OR IGNORE INTO detections (detection_time, detection_index, score,
+            display_name, category_name, frigate_event, camera_name) VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, inserts)
+        conn.executemany("""
+            INSERT INTO detection_choices(event_id, rank, display_name, score)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(event_id, rank) DO UPDATE
+                SET display_name=excluded.display_name,
+                    score=excluded.score
+        """, choices)
+        conn.executemany("""
+            UPDATE detections
+               SET detection_index = ?, score = ?, display_name = ?, category_name = ?
+             WHERE frigate_event = ?
+        """, updates)
+        conn.executemany("DELETE FROM detection_choices WHERE event_id = ?", deletes)
+        conn.executemany("DELETE FROM detections WHERE frigate_event = ?", deletes)
+    return summary
+
+
+class SimilarityIndex:
+    """
+    Sparse index over the stored vectors for "what else did the model score
+    like this" lookups.
+
+    Each indexed detection keeps only its k largest outputs (label index and
+    L2-normalised weight), so a cosine query is a gather and sum over N*k
+    entries rather than N*width, and a batch of queries is one NumPy call.
+    """
+
+    # Rows this close to the end of the file can still be rewritten by a
+    # higher-scoring update of the same event, so they are re-read on refresh.
+    TAIL = 2048
+
+    def __init__(self, store: VectorStore, db_path: str = DBPATH, k: int = 8, refresh_every: float = 10.0):
+        self.store = store
+        self.db_path = db_path
+        self.k = k
+        self.refresh_every = refresh_every
+        self.events = []
+        self.positions = {}          # frigate_event -> column
+        self.slots = np.zeros(0, dtype=np.int64)
+        self.last_detection = 0      # highest detections.id seen
+        # column-major (k, N): one contiguous row per rank keeps np.take fast
+        self.idx = np.zeros((k, 0), dtype=np.int16)
+        self.val = np.zeros((k, 0), dtype=np.float32)
+        self.refreshed_at = 0.0
+        self.lock = threading.Lock()
+
+    def _sparse(self, rows: np.ndarray):
+        idx = _top_k_batch(rows, self.k)
+        val = np.take_along_axis(rows, idx, axis=1).astype(np.float32)
+        norm = np.linalg.norm(val, axis=1, keepdims=True)
+        return idx.astype(np.int16), val / np.maximum(norm, 1e-6)
+
+    def refresh(self, force: bool = False):
+        """
+        Index detections created since the last refresh, whatever their slot
+        (re-evaluation and late-accepted events add detections for old
+        slots), and re-read the last TAIL slots for rewritten vectors.
+        """
+        with self.lock:
+            if not force and time.monotonic() - self.refreshed_at < self.refresh_every:
+                return
+            matrix = self.store.matrix()
+            tail = int(self.slots.max()) - self.TAIL if len(self.slots) else 0
+
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            if not self.last_detection:
+                self.store.adopt_legacy(conn)
+            query = """
+                SELECT d.id, v.id, v.frigate_event
+                  FROM detections d
+                  JOIN detection_vectors v ON v.frigate_event = d.frigate_event
+                  JOIN vector_models m ON m.slot = v.id AND m.model = ?
+                 WHERE {} > ?
+            """
+            rows = conn.execute(query.format('d.id'), (self.store.model, self.last_detection)).fetchall()
+            rows += conn.execute(query.format('v.id'), (self.store.model, tail)).fetchall()
+            conn.close()
+            self.refreshed_at = time.monotonic()
+
+            found = {}
+            for detection, slot, event in rows:
+                self.last_detection = max(self.last_detection, detection)
+                if slot < len(matrix):
+                    found[event] = slot
+            if not found:
+                return
+            events = list(found)
+            slots = np.array([found[e] for e in events], dtype=np.int64)
+            idx, val = self._sparse(matrix[slots])
+            columns = np.array([self.positions.get(e, -1) for e in events], dtype=np.int64)
+            known = columns >= 0
+
+            # New arrays, so a query holding the old ones isn't affected
+            added = [e for e, k in zip(events, known) if not k]
+            for i, e in enumerate(added):
+                self.positions[e] = len(self.events) + i
+            new_idx = np.concatenate([self.idx, idx[~known].T], axis=1)
+            new_val = np.concatenate([self.val, val[~known].T], axis=1)
+            new_idx[:, columns[known]] = idx[known].T
+            new_val[:, columns[known]] = val[known].T
+            self.slots = np.concatenate([self.slots, slots[~known]])
+            self.events = self.events + added
+            self.idx, self.val = new_idx, new_val
+
+    def query(self, event_ids, limit: int = 20):
+        """
+        Return, per query event, [(frigate_event, similarity), ...] for its
+        `limit` nearest indexed detections (cosine over the top-k outputs).
+        """
+        limit = max(int(limit), 1)
+        if not self.store.acquire():
+            return {e: [] for e in event_ids}  # retired for another model's store
+        try:
+            return self._query(event_ids, limit)
+        finally:
+            self.store.release()
+
+    def _query(self, event_ids, limit: int):
+        self.refresh()
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        found = dict(conn.execute(
+            "SELECT v.frigate_event, v.id FROM detection_vectors v "
+            "JOIN vector_models m ON m.slot = v.id AND m.model = ? WHERE v.frigate_event IN ({})"
+            .format(','.join('?' * len(event_ids))), (self.store.model, *event_ids)
+        ).fetchall())
+        conn.close()
+
+        matrix = self.store.matrix()
+        wanted = [e for e in event_ids if e in found and found[e] < len(matrix)]
+        results = {e: [] for e in event_ids}
+        if not wanted or not len(self.slots):
+            return results
+
+        # Dense (Q, width) query matrix holding only each query's own top-k
+        q_idx, q_val = self._sparse(matrix[[found[e] for e in wanted]])
+        dense = np.zeros((len(wanted), self.store.width), dtype=np.float32)
+        np.put_along_axis(dense, q_idx.astype(np.int64), q_val, axis=1)
+
+        with self.lock:
+            idx, val, events = self.idx, self.val, self.events
+        sims = np.zeros((len(wanted), len(events)), dtype=np.float32)
+        tmp = np.empty_like(sims)
+        for j in range(self.k):
+            np.take(dense, idx[j], axis=1, out=tmp)
+            tmp *= val[j]
+            sims += tmp
+
+        n = min(limit + 1, len(events))
+        for q, event_id in enumerate(wanted):
+            top = np.argpartition(-sims[q], n - 1)[:n]
+            top = top[np.argsort(-sims[q, top], kind='stable')]
+            results[event_id] = [(events[i], float(sims[q, i])) for i in top if events[i] != event_id][:limit]
+        return results
+
+
+def main():
+    from classifier import (read_model_labels, lookup_common_names, load_whitelist,
+                            build_allowed_mask, threshold_to_quantized)
+
+    cfg = yaml.safe_load(open('config/config.yml'))['classification']
+    parser = argparse.ArgumentParser(description="Re-apply classification rules to stored vectors")
+    sub = parser.add_subparsers(dest='command', required=True)
+    re_p = sub.add_parser('reevaluate', help="re-threshold / re-filter stored detections")
+    re_p.add_argument('--threshold', type=float, default=cfg['threshold'])
+    re_p.add_argument('--whitelist', default=cfg.get('whitelist', DEFAULT_WHITELIST))
+    re_p.add_argument('--model', default=cfg['model'])
+    re_p.add_argument('--labels', default=cfg['labels'])
+    re_p.add_argument('--db', default=DBPATH)
+    re_p.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    display, category = read_model_labels(args.model, args.labels)
+    with open(args.labels) as f:
+        label_lines = [line.strip() for line in f]
+    tables = {
+        'common': lookup_common_names(display, BIRDNAMES_PATH),
+        'category': category,
+        'choice': lookup_common_names(label_lines, BIRDNAMES_PATH),
+    }
+    mask = build_allowed_mask(display, tables['common'], load_whitelist(args.whitelist))
+
+    # Quantization parameters come from the model's output tensor
+    import tflite_runtime.interpreter as tflite
+    interpreter = tflite.Interpreter(model_path=args.model)
+    scale, zero_point = interpreter.get_output_details()[0]['quantization']
+    del interpreter
+
+    store = VectorStore(vector_path_for(args.model), len(display))
+    conn = sqlite3.connect(args.db, timeout=30)
+    started = time.perf_counter()
+    summary = reevaluate(conn, store, tables, mask, threshold_to_quantized(args.threshold, scale, zero_point),
+                         scale, zero_point, dry_run=args.dry_run)
+    conn.close()
+    store.close()
+    print(f"{'Would apply' if args.dry_run else 'Applied'}: {summary} "
+          f"in {time.perf_counter() - started:.2f}s", flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,35 @@
 import os
+import json
+import gzip
 import yaml
 import requests
+from requests.adapters import HTTPAdapter
+from gunicorn.app.base import BaseApplication
 from flask import Flask, render_template, send_file, send_from_directory, abort, current_app, g
-from flask import jsonify, request, redirect, url_for
-from datetime import datetime
+from flask import jsonify, request, redirect, url_for, Response
+from datetime import datetime, timedelta
 from io import BytesIO
 from queries import (
     recent_detections, get_daily_summary,
     get_common_name, get_records_for_date_hour,
     get_records_for_scientific_name_and_date,
-    get_earliest_detection_date
+    get_earliest_detection_date, get_detections_for_events,
+    get_generation_signature, get_species_week_trend,
+    get_activity_heatmap, get_first_last_seen
 )
+from vectorstore import VectorStore, SimilarityIndex, vector_path_for
+from outbox import enqueue_sub_label, SOURCE_USER
+from export import FORMATS as EXPORT_FORMATS, stream_export, export_filename
+from thumbnails import ThumbnailCache, ContactSheets
+from breaker import Breakers, NegativeCache, CircuitOpen, FrigateUnavailable, guarded_get
+import profiling
 from PIL import Image, UnidentifiedImageError
 import sqlite3
+import hashlib
+import threading
+import functools
+from collections import OrderedDict
+from datetime import timezone
 
 app = Flask(__name__)
 session = requests.Session()
@@ -37,6 +54,13 @@ elif cfg.get('username') and cfg.get('password'):
 FRIGATE_API = cfg['frigate_url']
 print("frigate api variable = " + FRIGATE_API)
 
+# Every Frigate call has a timeout, each kind of endpoint has a circuit
+# breaker, and media Frigate says it doesn't have is remembered for a while
+# (see breaker.py). Per gunicorn worker.
+FRIGATE_TIMEOUT = (cfg.get('connect_timeout', 3), cfg.get('read_timeout', 15))
+breakers = Breakers(cfg.get('breaker_failures', 5), cfg.get('breaker_reset', 30))
+missing_media = NegativeCache(cfg.get('missing_media_ttl', 300))
+
 # Helper to call Frigate API
 # camera and event for recordings endpoints
 
@@ -61,20 +85,69 @@ def get_db():
         db.row_factory = sqlite3.Row
     return db
 
+# Similarity index over stored score vectors, built on first use and again
+# whenever ingest switches to another model
+_similar_index = None
+_similar_key = None
+_similar_lock = threading.Lock()
+
+def _active_model():
+    """(model, labels) ingest last activated, or config.yml's until it has reported."""
+    try:
+        with open(CLASSIFICATION_STATUS) as f:
+            status = json.load(f)
+        return status['model'], status['labels']
+    except (OSError, ValueError, KeyError):
+        cls_cfg = config['classification']
+        return cls_cfg['model'], cls_cfg['labels']
+
+def get_similarity_index():
+    global _similar_index, _similar_key
+    model, labels = _active_model()
+    key = (vector_path_for(model), labels, os.path.getmtime(labels))
+    with _similar_lock:
+        if _similar_index is None or key != _similar_key:
+            with open(labels) as f:
+                width = len(f.read().splitlines())
+            store = VectorStore(key[0], width)
+            if _similar_index is not None:
+                _similar_index.store.retire()  # closed once queries still using it finish
+            _similar_index, _similar_key = SimilarityIndex(store, DATABASE), key
+        return _similar_index
+
 # Format filter
 @app.template_filter('datetime')
 def format_datetime(value, fmt='%B %d, %Y %H:%M:%S'):
     return datetime.fromisoformat(value).strftime(fmt)
 
-def _fetch_and_stream(path, is_video=False):
+def _placeholder():
+    return send_from_directory('static', 'placeholder.png', mimetype='image/png')
+
+def _fetch_and_stream(path, is_video=False, event_id=None, variant='snapshot'):
+    """
+    Proxy a Frigate media URL, or the placeholder when Frigate doesn't have
+    it. A 404 or invalid image is remembered per (event, variant) for
+    missing_media_ttl seconds; while the variant's breaker is open the
+    placeholder is served without asking Frigate (see breaker.py).
+    """
     url = f"http://{FRIGATE_API}/api/{path}"
     print(url)
 
-    r = session.get(url, stream=not is_video)
+    key = (event_id, variant)
+    if event_id is not None and key in missing_media:
+        return _placeholder()
+    try:
+        r = guarded_get(session, url, breakers[variant], stream=not is_video, timeout=FRIGATE_TIMEOUT)
+    except CircuitOpen:
+        return _placeholder()
+    except FrigateUnavailable as e:
+        app.logger.warning(f"Frigate unavailable for {path}: {e}")
+        return _placeholder()
     # 1. Check HTTP status
     if r.status_code != 200:
-        return send_from_directory('static', 'placeholder.png',
-                                   mimetype='image/png')
+        if r.status_code == 404 and event_id is not None:
+            missing_media.add(key)
+        return _placeholder()
     # 2. Validate MIME
     ctype = r.headers.get('Content-Type', '')
     if is_video:
@@ -85,17 +158,22 @@ def _fetch_and_stream(path, is_video=False):
                          as_attachment=False)
     if not ctype.startswith('image/'):
         app.logger.error(f"Bad image Content-Type: {ctype}")
-        return send_from_directory('static', 'placeholder.png',
-                                   mimetype='image/png')
+        return _placeholder()
     # 3. Verify image integrity
-    buf = BytesIO(r.content)
+    try:
+        buf = BytesIO(r.content)
+    except OSError as e:
+        breakers[variant].failure()
+        app.logger.warning(f"Frigate unavailable for {path}: {e}")
+        return _placeholder()
     try:
         img = Image.open(buf)
         img.verify()
-    except UnidentifiedImageError:
+    except (UnidentifiedImageError, OSError, SyntaxError):
         app.logger.error("Invalid image data received")
-        return send_from_directory('static', 'placeholder.png',
-                                   mimetype='image/png')
+        if event_id is not None:
+            missing_media.add(key)
+        return _placeholder()
     buf.seek(0)
     # 4. Stream to client
     return send_file(buf, mimetype=ctype, as_attachment=False)
@@ -140,7 +218,7 @@ def frigate_snapshot(camera, full_id):
     #if r.ok:
     print(FRIGATE_API)
     return _fetch_and_stream(
-    f"events/{full_id}/snapshot.jpg?crop=1&quality=95"
+    f"events/{full_id}/snapshot.jpg?crop=1&quality=95", event_id=full_id
     )
 
     #return send_file(r.raw, mimetype=r.headers['Content-Type'])
@@ -148,16 +226,46 @@ def frigate_snapshot(camera, full_id):
 
 @app.route('/frigate/<camera>/<full_id>/thumbnail.jpg')
 def frigate_thumbnail(camera, full_id):
-    #event_id = full_id.split('.')[0]
-    #path = f"/api/{camera}/recordings/{full_id}/thumbnail.jpg"
-    #r = frigate_get(path, stream=True)
-    #if r.ok:
-    
-    print(FRIGATE_API)
-    return _fetch_and_stream(f"events/{full_id}/thumbnail.jpg")
-    
-    #return send_file(r.raw, mimetype=r.headers['Content-Type'])
-    return send_from_directory('static/images', '1x1.png', mimetype='image/png')
+    # Served from the on-disk thumbnail cache (see thumbnails.py)
+    data = thumbnail_cache.get(full_id)
+    if data is None:
+        return _placeholder()
+    with Image.open(BytesIO(data)) as img:
+        mimetype = Image.MIME.get(img.format, 'image/jpeg')
+    return send_file(BytesIO(data), mimetype=mimetype, as_attachment=False)
+
+
+@app.route('/contact_sheets/<key>/<int:sheet>.jpg')
+def contact_sheet(key, sheet):
+    """One sprite of a list page's thumbnails (see thumbnails.py)."""
+    built = contact_sheets.sheet(key, sheet)
+    if built is None:
+        abort(404)
+    data, _, complete = built
+    response = send_file(BytesIO(data), mimetype='image/jpeg', as_attachment=False)
+    # the key covers the page's events, so a complete sheet never changes
+    if complete:
+        response.cache_control.public = True
+        response.cache_control.max_age = 86400
+    else:
+        response.cache_control.no_store = True
+    return response
+
+
+@app.route('/contact_sheets/<key>/<int:sheet>.json')
+def contact_sheet_offsets(key, sheet):
+    """[x, y, width, height] of each event's thumbnail in the sheet; null where it is missing."""
+    built = contact_sheets.sheet(key, sheet)
+    if built is None:
+        abort(404)
+    return jsonify(built[1])
+
+
+def page_sheets(records):
+    """Contact-sheet layout for a list page's records, or None to use one <img> per record."""
+    if not THUMBNAIL_CFG.get('contact_sheets', True) or not records:
+        return None
+    return contact_sheets.register(record['frigate_event'] for record in records)
 
 @app.route('/frigate/<camera>/<full_id>/clip.mp4')
 def frigate_clip(camera, full_id):
@@ -165,25 +273,85 @@ def frigate_clip(camera, full_id):
     #path = f"/api/{camera}/recordings/{full_id}/clip.mp4"
     #r = frigate_get(path, stream=True)
     #if r.ok:
-    return _fetch_and_stream(f"events/{full_id}/clip.mp4", is_video=True)
+    return _fetch_and_stream(f"events/{full_id}/clip.mp4", is_video=True, event_id=full_id, variant='clip')
     #return send_file(r.raw, mimetype=r.headers['Content-Type'])
     return send_from_directory('static/images', '1x1.png', mimetype='image/png')
 
 
-# ... other routes unchanged ...
+# Rendered history pages, keyed by URL plus the generation of the days they
+# show (see day_generations in schema.py). A write to any of those
+# days changes the key, so entries never need explicit invalidation.
+_page_cache = OrderedDict()
+_page_cache_lock = threading.Lock()
+
+
+def _parse_day(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def cached_page(day_range):
+    """
+    Serve a page about the days `day_range(**view_args)` returns with a weak
+    ETag and Last-Modified, answer revalidations with 304 before running any
+    query, and keep the rendered HTML in a small LRU.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            try:
+                first, last = day_range(**kwargs)
+            except ValueError:
+                return view(**kwargs)  # malformed date; let the view complain
+            days, generation, updated = get_generation_signature(first, last)
+            key = (request.full_path, days, generation, updated,
+                   get_earliest_detection_date().isoformat(), datetime.now().strftime('%Y-%m-%d'))
+            etag = hashlib.sha1(repr(key).encode()).hexdigest()
+            last_modified = (datetime.strptime(updated, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+                             if updated else None)
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                since = request.if_modified_since
+                not_modified = bool(since and last_modified and last_modified <= since)
+            if not_modified:
+                response = app.response_class(status=304)
+            else:
+                with _page_cache_lock:
+                    body = _page_cache.get(key)
+                    if body is not None:
+                        _page_cache.move_to_end(key)
+                if body is None:
+                    body = view(**kwargs)
+                    with _page_cache_lock:
+                        _page_cache[key] = body
+                        while len(_page_cache) > config.get('webui', {}).get('page_cache_size', 256):
+                            _page_cache.popitem(last=False)
+                response = app.make_response(body)
+
+            response.set_etag(etag, weak=True)
+            if last_modified:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True  # always revalidate; it's cheap
+            return response
+        return wrapper
+    return decorator
+
+
 @app.route('/detections/by_hour/<date>/<int:hour>')
+@cached_page(lambda date, hour: (_parse_day(date),) * 2)
 def show_detections_by_hour(date, hour):
-    records = get_records_for_date_hour(date, hour)
-    return render_template('detections_by_hour.html', date=date, hour=hour, records=records)
+    records = get_records_for_date_hour(_parse_day(date), hour)
+    return render_template('detections_by_hour.html', date=date, hour=hour, records=records,
+                           sheets=page_sheets(records))
 
 
 @app.route('/detections/by_scientific_name/<scientific_name>/<date>', defaults={'end_date': None})
 @app.route('/detections/by_scientific_name/<scientific_name>/<date>/<end_date>')
+@cached_page(lambda scientific_name, date, end_date: (_parse_day(date), _parse_day(end_date or date)))
 def show_detections_by_scientific_name(scientific_name, date, end_date):
     day_obj = datetime.strptime(date, "%Y-%m-%d").date()
 
-    if end_date is None:
-        records = get_records_for_scientific_name_and_date(scientific_name, day_obj)
     if end_date:
         end_obj = datetime.strptime(end_date, "%Y-%m-%d").date()
         records = get_records_for_scientific_name_and_date(scientific_name, day_obj, end_obj)
@@ -191,10 +359,12 @@ def show_detections_by_scientific_name(scientific_name, date, end_date):
         records = get_records_for_scientific_name_and_date(scientific_name, day_obj)
 
     return render_template('detections_by_scientific_name.html', scientific_name=scientific_name, date=date,
-                               end_date=end_date, common_name=get_common_name(scientific_name), records=records)
+                               end_date=end_date, common_name=get_common_name(scientific_name), records=records,
+                               sheets=page_sheets(records))
 
 
 @app.route('/daily_summary/<date>')
+@cached_page(lambda date: (_parse_day(date),) * 2)
 def show_daily_summary(date):
     date_datetime = datetime.strptime(date, "%Y-%m-%d")
     daily_summary = get_daily_summary(date_datetime)
@@ -203,6 +373,55 @@ def show_daily_summary(date):
     return render_template('daily_summary.html', daily_summary=daily_summary, date=date, today=today,
                            earliest_date=earliest_date)
 
+def _trend_range():
+    """start/end query args (YYYY-MM-DD, inclusive); the last year by default."""
+    end = request.args.get('end')
+    end = datetime.strptime(end, "%Y-%m-%d").date() if end else datetime.now().date()
+    start = request.args.get('start')
+    start = datetime.strptime(start, "%Y-%m-%d").date() if start else end - timedelta(days=364)
+    if start > end:
+        raise ValueError("start is after end")
+    return start, end
+
+
+@app.route('/trends')
+def show_trends():
+    try:
+        start, end = _trend_range()
+    except ValueError:
+        abort(400)
+    return render_template('trends.html', start=start.isoformat(), end=end.isoformat(),
+                           species=request.args.get('species', ''), seen=get_first_last_seen())
+
+
+@app.route('/api/trends')
+def trends_json():
+    """Species × week counts as compact arrays."""
+    try:
+        start, end = _trend_range()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(start=start.isoformat(), end=end.isoformat(), **get_species_week_trend(start, end))
+
+
+@app.route('/api/heatmap')
+def heatmap_json():
+    """Hour-of-day × day-of-year counts, optionally for one species."""
+    try:
+        start, end = _trend_range()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    species = request.args.get('species') or None
+    return jsonify(start=start.isoformat(), end=end.isoformat(), species=species,
+                   **get_activity_heatmap(start, end, species))
+
+
+@app.route('/api/species_seen')
+def species_seen_json():
+    """First/last-seen day and total per species."""
+    return jsonify(species=get_first_last_seen())
+
+
 @app.route('/events/<event_id>/choices')
 def get_choices(event_id):
     db = get_db()
@@ -213,25 +432,69 @@ def get_choices(event_id):
 
     return jsonify([{"rank":r,"label":n,"score":s} for r,n,s in rows])
 
+# Most neighbours /detections/<id>/similar returns
+SIMILAR_LIMIT_MAX = 200
+
+@app.route('/detections/<event_id>/similar')
+def similar_detections(event_id):
+    """Detections whose model output looked most like this one's."""
+    limit = min(max(request.args.get('limit', 20, type=int), 1), SIMILAR_LIMIT_MAX)
+    # over-fetch: some neighbours may have been removed from detections since
+    matches = get_similarity_index().query([event_id], limit=limit * 2)[event_id]
+    found = get_detections_for_events([e for e, _ in matches] + [event_id])
+    records = [dict(found[e], similarity=sim) for e, sim in matches if e in found][:limit]
+
+    if request.args.get('format') == 'json':
+        return jsonify([{"event_id": r['frigate_event'], "label": r['display_name'],
+                         "score": r['score'], "similarity": r['similarity'],
+                         "detection_time": str(r['detection_time']), "camera": r['camera_name']}
+                        for r in records])
+    return render_template('similar_detections.html', detection=found.get(event_id),
+                           event_id=event_id, records=records)
+
+@app.route('/api/export')
+def export_detections():
+    """
+    Stream detections (with top-5 choices) as csv, ndjson or parquet.
+    Query args: format, start, end (YYYY-MM-DD, inclusive), camera,
+    species, reviewed (0/1), min_score, gzip (1 for csv/ndjson).
+    """
+    fmt = request.args.get('format', 'csv')
+    try:
+        start = request.args.get('start')
+        end = request.args.get('end')
+        start = datetime.strptime(start, "%Y-%m-%d").date() if start else None
+        end = datetime.strptime(end, "%Y-%m-%d").date() if end else None
+        reviewed = request.args.get('reviewed', type=int)
+        compress = request.args.get('gzip', 0, type=int) == 1
+        chunks = stream_export(DATABASE, fmt, gzip=compress, start=start, end=end,
+                               camera=request.args.get('camera'), species=request.args.get('species'),
+                               reviewed=None if reviewed is None else bool(reviewed),
+                               min_score=request.args.get('min_score', type=float))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    except RuntimeError as e:
+        return jsonify(error=str(e)), 501
+
+    filename = export_filename(fmt, compress, start, end)
+    response = Response(chunks, mimetype='application/gzip' if filename.endswith('.gz') else EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
 @app.route('/set_label', methods=['POST'])
 def set_label():
     event_id = request.form['event_id']
     sub_label = request.form['selected_label']
     db = get_db()
 
-    # 1) Update your own database record if desired
+    # 1) Update our own record and 2) queue the sub_label for Frigate in the
+    # same transaction; the ingest process's outbox sender delivers it.
     db.execute("UPDATE detections SET user_label = ? WHERE frigate_event = ?",
                (sub_label, event_id))
+    enqueue_sub_label(db, event_id, sub_label, source=SOURCE_USER)
     db.commit()
-    
-    # 2) Optionally, push sub_label back to Frigate
-    #r = requests.post(
-    #  f"{FRIGATE_API}/api/events/{event_id}/sub_label",
-    #  json={"subLabel": sub_label}
-    #)
-    #if not r.ok:
-    #    app.logger.error("Failed to set sub_label on Frigate API")
-    
+
     return redirect(request.referrer or url_for('index'))
 
 @app.route('/detections/<event_id>/review', methods=['POST'])
@@ -257,6 +520,153 @@ def unreview_detection(event_id):
     db.commit()
     return jsonify(success=True, reviewed=False)
 
+# Most changes one /detections/bulk request may carry
+BULK_MAX_CHANGES = 1000
+
+@app.route('/detections/bulk', methods=['POST'])
+def bulk_update_detections():
+    """
+    Apply many review flags and labels in one transaction.
+
+    Body: {"changes": [{"event_id": "...", "reviewed": true, "label": "..."}, ...]}
+    where `reviewed` and `label` are each optional. Later entries for the
+    same event win. Labels are queued for Frigate like /set_label does.
+    """
+    payload = request.get_json(force=True, silent=True) or {}
+    changes = payload.get('changes')
+    if not isinstance(changes, list) or len(changes) > BULK_MAX_CHANGES:
+        return jsonify(error=f"'changes' must be a list of at most {BULK_MAX_CHANGES} items"), 400
+
+    reviewed, labels = {}, {}
+    for change in changes:
+        event_id = change.get('event_id') if isinstance(change, dict) else None
+        if not isinstance(event_id, str) or not event_id:
+            return jsonify(error="every change needs an event_id"), 400
+        if 'reviewed' in change:
+            reviewed[event_id] = 1 if change['reviewed'] else 0
+        if isinstance(change.get('label'), str) and change['label']:
+            labels[event_id] = change['label']
+
+    db = get_db()
+    with db:
+        db.executemany("UPDATE detections SET reviewed = ? WHERE frigate_event = ?",
+                       [(flag, event_id) for event_id, flag in reviewed.items()])
+        for event_id, label in labels.items():
+            # only events that exist get a Frigate write; the rest come back as missing
+            if db.execute("UPDATE detections SET user_label = ? WHERE frigate_event = ?",
+                          (label, event_id)).rowcount:
+                enqueue_sub_label(db, event_id, label, source=SOURCE_USER)
+
+    touched = sorted(set(reviewed) | set(labels))
+    found = {}
+    for start in range(0, len(touched), 500):
+        chunk = touched[start:start + 500]
+        rows = db.execute(
+            f"SELECT frigate_event, reviewed, user_label FROM detections "
+            f"WHERE frigate_event IN ({','.join('?' * len(chunk))})", chunk)
+        found.update((r['frigate_event'], {'event_id': r['frigate_event'], 'reviewed': bool(r['reviewed']),
+                                           'user_label': r['user_label'] or None}) for r in rows)
+    return jsonify(success=True, updated=list(found.values()),
+                   missing=[event_id for event_id in touched if event_id not in found])
+
+
+# Written by the ingest process whenever it activates a classification context
+CLASSIFICATION_STATUS = os.path.join(os.path.dirname(__file__), 'data', 'status', 'classification.json')
+RELOAD_TRIGGER = os.path.join(os.path.dirname(__file__), 'data', 'reload')
+
+@app.route('/admin/classification')
+def classification_status():
+    """Report the classification context the ingest process is running."""
+    try:
+        with open(CLASSIFICATION_STATUS) as f:
+            return jsonify(json.load(f))
+    except FileNotFoundError:
+        return jsonify(error="ingest has not reported a classification context yet"), 404
+
+@app.route('/admin/classification/reload', methods=['POST'])
+def reload_classification():
+    """Ask ingest to rebuild its classification context from config.yml."""
+    # The ingest reloader watches this file's mtime
+    with open(RELOAD_TRIGGER, 'a'):
+        os.utime(RELOAD_TRIGGER, None)
+    return jsonify(success=True, requested_at=datetime.now().isoformat(timespec='seconds')), 202
+
+
+@app.route('/admin/ingest')
+def ingest_status():
+    """Per-camera queue depth, dispatch counts and wait times from each ingest node."""
+    status_dir = os.path.dirname(CLASSIFICATION_STATUS)
+    nodes = {}
+    if os.path.isdir(status_dir):
+        for name in sorted(os.listdir(status_dir)):
+            if not (name.startswith('ingest-') and name.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(status_dir, name)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            data['age_seconds'] = round(datetime.now().timestamp() - data.get('written_at', 0), 1)
+            nodes[name[len('ingest-'):-len('.json')]] = data
+    return jsonify(nodes=nodes)
+
+
+@app.route('/admin/frigate')
+def frigate_health():
+    """This web worker's Frigate breakers and how many media it currently treats as missing."""
+    return jsonify(pid=os.getpid(), breakers=breakers.status(), missing_media=len(missing_media))
+
+
+PROFILE_DIR = os.path.join(os.path.dirname(__file__), 'data', 'profile')
+
+@app.route('/admin/profile')
+def profile_status():
+    """Sampling state, per-process timing stats and captured profile files."""
+    out_dir = PROFILE_CFG.get('dir', PROFILE_DIR)
+    control, stats, files = None, [], []
+    if os.path.isdir(out_dir):
+        for name in sorted(os.listdir(out_dir)):
+            path = os.path.join(out_dir, name)
+            if name.endswith('.tmp'):
+                continue
+            if name == profiling.CONTROL_FILE or name.startswith('stats-'):
+                try:
+                    with open(path) as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if name == profiling.CONTROL_FILE:
+                    control = data
+                else:
+                    stats.append(data)
+            else:
+                files.append({'name': name, 'size': os.path.getsize(path),
+                              'url': url_for('profile_file', name=name)})
+    return jsonify(control=control, processes=stats, files=files)
+
+@app.route('/admin/profile', methods=['POST'])
+def profile_control():
+    """
+    {"action": "start", "duration": 30} samples every process for `duration`
+    seconds; {"action": "stop"} ends it early. Results appear in GET /admin/profile.
+    """
+    if not PROFILE_CFG.get('enabled', False):
+        return jsonify(error="profiling is disabled; set profiling.enabled in config.yml"), 409
+    body = request.get_json(force=True, silent=True) or {}
+    action = body.get('action', 'start')
+    if action not in ('start', 'stop'):
+        return jsonify(error="action must be 'start' or 'stop'"), 400
+    try:
+        duration = float(body.get('duration', PROFILE_CFG.get('sample_seconds', 30)))
+    except (TypeError, ValueError):
+        return jsonify(error="duration must be a number of seconds"), 400
+    control = profiling.write_control(PROFILE_CFG.get('dir', PROFILE_DIR), action == 'start', duration)
+    return jsonify(success=True, **control), 202
+
+@app.route('/admin/profile/files/<path:name>')
+def profile_file(name):
+    return send_from_directory(os.path.abspath(PROFILE_CFG.get('dir', PROFILE_DIR)), name, as_attachment=True)
+
 
 def load_config():
     global config
@@ -277,7 +687,102 @@ def close_db(exc):
 
 load_config()
 
+# Frigate thumbnails cached on disk, and list pages' contact sheets built from them
+THUMBNAIL_DIR = os.path.join(os.path.dirname(__file__), 'data', 'thumbnails')
+THUMBNAIL_CFG = config.get('webui', {}).get('thumbnails') or {}
+thumbnail_cache = ThumbnailCache(session, base_url, THUMBNAIL_CFG.get('dir', THUMBNAIL_DIR),
+                                 max_mb=THUMBNAIL_CFG.get('cache_mb', 500), timeout=FRIGATE_TIMEOUT,
+                                 breaker=breakers['thumbnail'], missing=missing_media)
+contact_sheets = ContactSheets(thumbnail_cache, tile=THUMBNAIL_CFG.get('tile', 100),
+                               columns=THUMBNAIL_CFG.get('columns', 10),
+                               per_sheet=THUMBNAIL_CFG.get('per_sheet', 100),
+                               workers=THUMBNAIL_CFG.get('fetch_concurrency', 8))
+
+# Per-route timings (see profiling.py); gunicorn forks after this, and each
+# worker starts its own profiler thread on its first request
+PROFILE_CFG = config.get('profiling') or {}
+if PROFILE_CFG.get('enabled', False):
+    profiling.init('web', PROFILE_CFG)
+
+@app.before_request
+def begin_request_trace():
+    if profiling.profiler is not None:
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        g._profile_trace = profiling.profiler.begin('request', f"{request.method} {rule}")
+
+@app.teardown_request
+def end_request_trace(exc):
+    record = g.pop('_profile_trace', None)
+    if record is not None:
+        record['attrs']['path'] = request.full_path
+        profiling.profiler.end(record)
+
+# Response compression for the text types the UI serves
+GZIP_MIMETYPES = {'text/html', 'application/json', 'text/css', 'application/javascript'}
+
+@app.after_request
+def gzip_response(response):
+    web_cfg = config.get('webui', {})
+    if not web_cfg.get('gzip', True):
+        return response
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code >= 300
+            or response.mimetype not in GZIP_MIMETYPES
+            or 'Content-Encoding' in response.headers
+            or 'gzip' not in request.headers.get('Accept-Encoding', '').lower()):
+        return response
+    data = response.get_data()
+    if len(data) < web_cfg.get('gzip_min_size', 1024):
+        return response
+    response.set_data(gzip.compress(data, compresslevel=web_cfg.get('gzip_level', 6)))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+class _GunicornApp(BaseApplication):
+    """Run `app` under gunicorn from inside our own process tree."""
+
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return app
+
+
+def serve(web_cfg):
+    """
+    Serve the UI with the server chosen in config.yml. The default,
+    gunicorn with threaded workers, handles many requests at once so slow
+    Frigate thumbnail proxies don't queue behind each other; "flask" keeps
+    the single-threaded development server.
+    """
+    host, port = web_cfg['host'], web_cfg['port']
+    if web_cfg.get('server', 'gunicorn') == 'flask':
+        app.run(debug=False, host=host, port=port)
+        return
+
+    workers = web_cfg.get('workers', 2)
+    threads = web_cfg.get('threads', 8)
+    # every thread may be waiting on Frigate, plus the contact-sheet fetchers; size the pool to match
+    session.mount('http://', HTTPAdapter(pool_connections=4,
+                                         pool_maxsize=threads + THUMBNAIL_CFG.get('fetch_concurrency', 8)))
+    _GunicornApp({
+        'bind': f"{host}:{port}",
+        'workers': workers,
+        'threads': threads,
+        'worker_class': 'gthread',
+        'keepalive': web_cfg.get('keepalive', 5),
+        'timeout': web_cfg.get('timeout', 60),
+        'accesslog': web_cfg.get('accesslog'),
+    }).run()
+
 
 if __name__ == '__main__':
     web_cfg = yaml.safe_load(open('config/config.yml'))['webui']
-    app.run(host=web_cfg['host'], port=web_cfg['port'])
+    serve(web_cfg)